@@ -0,0 +1,63 @@
+"""
+Helpers shared by the benchmark scripts in this directory.
+
+The benchmarks run against a throwaway test database created with the same
+settings as the test suite, so they work on SQLite by default and on
+PostgreSQL when the DATABASE environment variable is set just like for
+`./manage.py test` (see .travis.yml). Use `run` to call the benchmark, so
+that the test database is destroyed afterwards.
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+__runner__ = None
+__databases__ = None
+
+
+def setup():
+    global __runner__, __databases__
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test.settings")
+
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.runner import DiscoverRunner
+    __runner__ = DiscoverRunner(verbosity=0)
+    __databases__ = __runner__.setup_databases()
+    return connection.vendor
+
+
+def run(main):
+    """
+    Calls `main`, and then destroys the test database created by `setup`,
+    if any, just like the Django test runner does.
+    """
+    try:
+        main()
+    finally:
+        if __databases__ is not None:
+            __runner__.teardown_databases(__databases__)
+
+
+@contextmanager
+def timer(label, results):
+    start = time.perf_counter()
+    yield
+    results[label] = time.perf_counter() - start
+
+
+def report(title, results, unit='s'):
+    print(title)
+    print('-' * len(title))
+    width = max(len(label) for label in results)
+    for label, value in results.items():
+        print('%s: %10.3f%s' % (label.ljust(width), value, unit))
+    print()
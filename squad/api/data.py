@@ -11,8 +11,7 @@ from squad.http import auth
 
 @auth
 def get(request, group_slug, project_slug):
-    group = get_object_or_404(models.Group, slug=group_slug)
-    project = get_object_or_404(group.projects, slug=project_slug)
+    project = request.project
 
     metrics = request.GET.getlist('metric')
     environments = request.GET.getlist('environment')
@@ -13,6 +13,8 @@ from squad.core.models import slug_pattern
 urlpatterns = [
     url(r'^$', lambda request: redirect('/')),
     url(r'^submit/(%s)/(%s)/(%s)/(%s)' % ((slug_pattern,) * 4), views.add_test_run),
+    url(r'^submitbatch/(%s)/(%s)/(%s)$' % ((slug_pattern,) * 3), views.add_test_runs),
+    url(r'^receipt/([a-zA-Z0-9]+)$', views.receipt),
     url(r'^submitjob/(%s)/(%s)/(%s)/(%s)' % ((slug_pattern,) * 4), ci.submit_job),
     url(r'^watchjob/(%s)/(%s)/(%s)/(%s)' % ((slug_pattern,) * 4), ci.watch_job),
     url(r'^data/(%s)/(%s)' % ((slug_pattern,) * 2), data.get),
@@ -1,50 +1,67 @@
 from django.shortcuts import get_object_or_404
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponseForbidden
-from django.http import HttpResponse
+from django.http import HttpResponseForbidden, HttpResponseBadRequest
+from django.http import HttpResponse, JsonResponse
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
 import json
 import logging
+import re
+import shutil
+import tarfile
+import zipfile
 
 
-from squad.http import read_file_upload
-
-
-from squad.core.models import Group
-from squad.core.models import Project
-from squad.core.models import Build
-from squad.core.models import Environment
 from squad.core.models import TestRun
-from squad.core.models import Token
+from squad.core.models import token_acl
+from squad.core.models import Receipt
+from squad.core.models import slug_pattern
 
 
 from squad.core.tasks import ReceiveTestRun
+from squad.core.tasks import ReceiveTestRunBatch
+from squad.core.tasks import process_test_run
 from squad.core.tasks import exceptions
+from squad.http import get_project_or_404
 
 
 logger = logging.getLogger()
 
 
 def valid_token(token, project):
-    return project.tokens.filter(key=token).exists() or Token.objects.filter(project=None).exists()
+    return token_acl.permits(token, project)
 
 
-@csrf_exempt
-@require_http_methods(["POST"])
-def add_test_run(request, group_slug, project_slug, version, environment_slug):
-    group = get_object_or_404(Group, slug=group_slug)
-    project = get_object_or_404(group.projects, slug=project_slug)
-
-    # authenticate token X project
+def authentication_error(request, project):
+    """
+    Returns an error response if the request does not have a valid token
+    for `project`, or None if it does.
+    """
     token = request.META.get('HTTP_AUTH_TOKEN', None)
     if token:
         if valid_token(token, project):
-            pass
+            return None
         else:
             return HttpResponseForbidden()
     else:
         return HttpResponse('Authentication needed', status=401)
 
+
+def is_true(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def add_test_run(request, group_slug, project_slug, version, environment_slug):
+    project = get_project_or_404(group_slug, project_slug)
+
+    # authenticate token X project
+    error = authentication_error(request, project)
+    if error:
+        return error
+
     test_run_data = {
         'version': version,
         'environment_slug': environment_slug,
@@ -56,10 +73,11 @@ def add_test_run(request, group_slug, project_slug, version, environment_slug):
         'log_file': 'log',
         'metadata_file': 'metadata',
     }
+    # uploaded files are passed down as file objects (Django spools large
+    # ones to disk), and are only read when being stored.
     for key, field in uploads.items():
         if field in request.FILES:
-            f = request.FILES[field]
-            test_run_data[key] = read_file_upload(f).decode('utf-8')
+            test_run_data[key] = request.FILES[field]
         elif field in request.POST:
             test_run_data[key] = request.POST[field]
 
@@ -74,15 +92,167 @@ def add_test_run(request, group_slug, project_slug, version, environment_slug):
     if 'attachment' in request.FILES:
         attachments = {}
         for f in request.FILES.getlist('attachment'):
-            attachments[f.name] = read_file_upload(f)
+            attachments[f.name] = f
         test_run_data['attachments'] = attachments
 
+    asynchronous = is_true(request.POST.get('async', ''))
+
     receive = ReceiveTestRun(project)
 
     try:
-        receive(**test_run_data)
+        testrun = receive(process=not asynchronous, **test_run_data)
     except exceptions.invalid_input as e:
         logger.warning(request.get_full_path() + ": " + str(e))
         return HttpResponse(str(e), status=400)
 
+    if asynchronous:
+        if testrun.duplicate:
+            # nothing to process; hand back the receipt of the original
+            # submission, if there is one
+            receipt = testrun.receipts.order_by('id').first()
+            if not receipt:
+                receipt = Receipt.objects.create(test_run=testrun, status=Receipt.PROCESSED)
+        else:
+            receipt = Receipt.objects.create(test_run=testrun)
+            process_test_run.delay(receipt.id)
+        url = request.build_absolute_uri('/api/receipt/%s' % receipt.key)
+        response = JsonResponse({'receipt': receipt.key, 'url': url}, status=202)
+        response['Location'] = url
+        return response
+
+    if testrun.duplicate:
+        return JsonResponse({'id': testrun.id, 'job_id': testrun.job_id, 'duplicate': True}, status=200)
+
     return HttpResponse('', status=201)
+
+
+class InvalidArchive(Exception):
+    pass
+
+
+ARCHIVE_DATA_FILES = {
+    'metadata.json': 'metadata_file',
+    'metrics.json': 'metrics_file',
+    'tests.json': 'tests_file',
+    'log': 'log_file',
+}
+
+
+ARCHIVE_ENVIRONMENT = re.compile('^%s$' % slug_pattern)
+
+# members of tar archives up to this size are kept in memory
+ARCHIVE_SPOOL_SIZE = 1024 * 1024
+
+
+def read_test_run_archive(f):
+    """
+    Reads test runs from a tar (possibly compressed) or zip archive. Each
+    test run is a ENVIRONMENT/NAME/ directory with the files `metadata.json`,
+    `metrics.json`, `tests.json`, and `log`, all optional; any other file is
+    an attachment. ENVIRONMENT must be a valid slug, just like the
+    environment in the URL of a single submission.
+
+    Returns a list of (name, test_run_data) tuples, where test_run_data is
+    a dictionary with arguments for ReceiveTestRunBatch. Files are passed
+    on as file objects. Members of zip archives are only read when the test
+    run is stored; members of tar archives are not read in the same order
+    as they are stored, which for compressed archives would mean
+    decompressing them from the start over and over, so each of them is
+    read once, in archive order, and spooled to a temporary file if large.
+    """
+    if zipfile.is_zipfile(f):
+        archive = zipfile.ZipFile(f)
+        members = [
+            (info.filename, archive.open(info))
+            for info in archive.infolist()
+            if not info.filename.endswith('/')
+        ]
+    else:
+        f.seek(0)
+        archive = tarfile.open(fileobj=f, mode='r|*')
+        members = [
+            (member.name, spool(archive.extractfile(member)))
+            for member in archive
+            if member.isfile()
+        ]
+
+    test_runs = OrderedDict()
+    for path, data in sorted(members, key=lambda m: m[0]):
+        parts = [p for p in path.split('/') if p not in ('', '.')]
+        if len(parts) != 3:
+            raise InvalidArchive('%s: expected ENVIRONMENT/NAME/FILE' % path)
+        environment, name, filename = parts
+        if not ARCHIVE_ENVIRONMENT.match(environment) or len(environment) > 100:
+            raise InvalidArchive('%s: invalid environment slug: %s' % (path, environment))
+        test_run = test_runs.setdefault(
+            (environment, name),
+            {'environment_slug': environment, 'attachments': {}},
+        )
+        if filename in ARCHIVE_DATA_FILES:
+            test_run[ARCHIVE_DATA_FILES[filename]] = data
+        else:
+            test_run['attachments'][filename] = data
+
+    return [('%s/%s' % key, data) for key, data in test_runs.items()]
+
+
+def spool(data):
+    spooled = SpooledTemporaryFile(ARCHIVE_SPOOL_SIZE)
+    shutil.copyfileobj(data, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def add_test_runs(request, group_slug, project_slug, version):
+    project = get_project_or_404(group_slug, project_slug)
+
+    error = authentication_error(request, project)
+    if error:
+        return error
+
+    if 'archive' not in request.FILES:
+        return HttpResponseBadRequest('archive is required')
+
+    try:
+        test_runs = read_test_run_archive(request.FILES['archive'])
+    except (InvalidArchive, tarfile.TarError, zipfile.BadZipfile) as e:
+        return HttpResponseBadRequest('invalid archive: %s' % e)
+
+    atomic = is_true(request.POST.get('atomic', ''))
+
+    receive = ReceiveTestRunBatch(project)
+    try:
+        results = receive(version, [data for _, data in test_runs], atomic=atomic)
+    except exceptions.invalid_input as e:
+        logger.warning(request.get_full_path() + ": " + str(e))
+        return HttpResponseBadRequest(str(e))
+
+    response = []
+    for (name, _), result in zip(test_runs, results):
+        if isinstance(result, TestRun):
+            status = result.duplicate and 'duplicate' or 'created'
+            response.append({'name': name, 'status': status, 'id': result.id, 'job_id': result.job_id})
+        else:
+            logger.warning(request.get_full_path() + ": " + name + ": " + str(result))
+            response.append({'name': name, 'status': 'failed', 'error': str(result)})
+
+    failed = any(r['status'] == 'failed' for r in response)
+    return JsonResponse({'test_runs': response}, status=(failed and 400 or 201))
+
+
+@require_http_methods(["GET"])
+def receipt(request, key):
+    receipt = get_object_or_404(Receipt, key=key)
+    data = {
+        'status': receipt.status,
+        'error': receipt.error,
+        'test_run': None,
+    }
+    if receipt.test_run:
+        data['test_run'] = {
+            'id': receipt.test_run.id,
+            'job_id': receipt.test_run.job_id,
+        }
+    return JsonResponse(data)
@@ -0,0 +1,317 @@
+from collections import OrderedDict
+import pickle
+import threading
+import time
+import zlib
+
+
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import post_save, post_delete, post_migrate
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping of at most `maxsize` entries, that evicts the
+    least recently used entries when full.
+
+    If `maxbytes` is given, values must be bytes, and the least recently
+    used entries are also evicted when the total length of the values
+    exceeds it. Values longer than `maxbytes` are not stored at all.
+    """
+
+    def __init__(self, maxsize, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def set(self, key, value):
+        if self.maxbytes is not None and len(value) > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.__remove__(key)
+            self.entries[key] = value
+            self.size += self.__size__(value)
+            while len(self.entries) > self.maxsize or (self.maxbytes is not None and self.size > self.maxbytes):
+                self.__remove__(next(iter(self.entries)))
+
+    def __size__(self, value):
+        return len(value) if self.maxbytes is not None else 0
+
+    def __remove__(self, key):
+        self.size -= self.__size__(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedCache(object):
+    """
+    Base class for process-local caches of database contents, that are
+    invalidated when objects of `model` are saved or deleted.
+
+    Invalidating clears the cache, and also bumps a generation counter in
+    the Django cache (see the CACHES setting); other processes clear their
+    own caches when they see a new generation. That only works if CACHES
+    points to a backend shared by all processes, such as memcached (see the
+    SQUAD_CACHE_BACKEND setting); with the default local-memory backend,
+    other processes only see the change once their entries expire, `ttl`
+    seconds after being cached.
+    """
+
+    def __init__(self, model, maxsize, ttl):
+        self.model = model
+        self.entries = LRUCache(maxsize)
+        self.ttl = ttl
+        self.key = 'squad.core.cache.%s.%s' % (type(self).__name__, model._meta.label_lower)
+        self.generation = None
+        post_save.connect(self.__saved__, sender=model, weak=False)
+        post_delete.connect(self.__deleted__, sender=model, weak=False)
+        # e.g. on `manage.py flush`
+        post_migrate.connect(self.__migrated__, weak=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def invalidate(self):
+        """
+        Clears the cache in this process and in all of the others.
+        """
+        self.clear()
+        try:
+            self.generation = cache.incr(self.key)
+        except ValueError:
+            # not in the Django cache (yet, or anymore)
+            cache.add(self.key, 1)
+
+    def __check_generation__(self):
+        generation = cache.get(self.key, 0)
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def __read__(self, key):
+        """
+        Returns the cached value for `key`, or None if it is not cached or
+        has expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def __write__(self, key, value):
+        self.entries.set(key, (time.monotonic() + self.ttl, value))
+
+    def __saved__(self, instance, created, update_fields=None, **kwargs):
+        self.invalidate()
+
+    def __deleted__(self, instance, **kwargs):
+        self.invalidate()
+
+    def __migrated__(self, **kwargs):
+        self.clear()
+
+
+class IDCache(SharedCache):
+    """
+    Process-local cache of the IDs of the objects of `model` (Build,
+    Environment or Suite), by project and by the value of `field` (their
+    slug, or name).
+
+    Objects are looked up in the database with `project` and the keyword
+    arguments returned by `lookup(value)`, which by default is just `field`,
+    and created with `field` set to the value if they do not exist.
+
+    Objects are returned as instances with only `id`, `project` and `field`
+    loaded; any other field is loaded from the database on first access, as
+    with `QuerySet.only()`.
+
+    Mappings are only added to the cache after the transaction that read or
+    created the object is committed, so objects created by transactions that
+    are rolled back never make it into the cache. Renaming or deleting an
+    object invalidates the cache, and mappings are looked up in the
+    database again once they expire (see SharedCache).
+    """
+
+    MAXSIZE = 10000
+    TTL = 60
+
+    def __init__(self, model, field, lookup=None, maxsize=MAXSIZE, ttl=TTL):
+        super(IDCache, self).__init__(model, maxsize, ttl)
+        self.field = field
+        self.lookup = lookup or (lambda value: {field: value})
+
+    def get(self, project, value):
+        """
+        Returns the object with the given `field` value in `project`, or None
+        if it is not cached.
+        """
+        self.__check_generation__()
+        obj_id = self.__read__((project.id, value))
+        if obj_id is None:
+            return None
+        return self.__instance__(project, value, obj_id)
+
+    def get_many(self, project, values):
+        """
+        Returns a dictionary with the cached objects for `values`.
+        """
+        self.__check_generation__()
+        result = {}
+        for value in values:
+            obj_id = self.__read__((project.id, value))
+            if obj_id is not None:
+                result[value] = self.__instance__(project, value, obj_id)
+        return result
+
+    def get_or_create(self, project, value):
+        """
+        Same as `get_or_create` on the model (see above for the arguments),
+        but without touching the database if the object is cached.
+        """
+        obj = self.get(project, value)
+        if obj is None:
+            obj, _ = self.model.objects.get_or_create(
+                project=project,
+                defaults={self.field: value},
+                **self.lookup(value)
+            )
+            self.add(obj, value)
+        return obj
+
+    def add(self, obj, value=None):
+        """
+        Caches `obj` under `value`, which defaults to its `field`.
+        """
+        if value is None:
+            value = getattr(obj, self.field)
+        key = (obj.project_id, value)
+        obj_id = obj.id
+        transaction.on_commit(lambda: self.__put__(key, obj_id))
+
+    def __put__(self, key, obj_id):
+        self.__check_generation__()
+        self.__write__(key, obj_id)
+
+    def __instance__(self, project, value, obj_id):
+        db = router.db_for_read(self.model)
+        obj = self.model.from_db(db, ('id', 'project_id', self.field), (obj_id, project.id, value))
+        obj.project = project
+        return obj
+
+    def __saved__(self, instance, created, update_fields=None, **kwargs):
+        if created or (update_fields is not None and self.field not in update_fields):
+            return
+        self.invalidate()
+
+
+ALL_PROJECTS = 'all'
+
+
+class TokenCache(SharedCache):
+    """
+    Caches, for each token key, the IDs of the projects that the token gives
+    access to: the ID of its project, or ALL_PROJECTS for global tokens
+    (i.e. tokens without a project). Unknown keys map to no projects.
+
+    Saving or deleting any token invalidates the cache (see SharedCache for
+    how that reaches other processes), and entries expire after `ttl`
+    seconds in any case.
+    """
+
+    MAXSIZE = 10000
+    TTL = 60
+
+    def __init__(self, model, ttl=TTL, maxsize=MAXSIZE):
+        super(TokenCache, self).__init__(model, maxsize, ttl)
+
+    def projects(self, key):
+        self.__check_generation__()
+        projects = self.__read__(key)
+        if projects is None:
+            projects = frozenset()
+            for project_id in self.model.objects.filter(key=key).values_list('project_id', flat=True):
+                projects = ALL_PROJECTS if project_id is None else frozenset([project_id])
+            self.__write__(key, projects)
+        return projects
+
+    def permits(self, key, project, global_tokens=True):
+        """
+        Returns whether the token with the given key gives access to
+        `project`. If `global_tokens` is False, only tokens of `project`
+        itself do.
+        """
+        if not key:
+            return False
+        projects = self.projects(key)
+        if projects == ALL_PROJECTS:
+            return global_tokens
+        return project.id in projects
+
+
+class ResultCache(object):
+    """
+    Caches the results of expensive computations over data that does not
+    change, e.g. comparisons of builds whose test runs are all processed.
+    Keys must identify the data completely, so entries never need to be
+    invalidated: when the data changes, so does the key.
+
+    Values are pickled and compressed, and kept both in a process-local
+    LRUCache of at most `maxsize` entries and `maxbytes` bytes, and in the
+    Django cache (see the CACHES setting), so that other processes (and
+    this one, after evicting them locally) can reuse them. Values larger
+    than `max_entry_size` bytes once compressed are not cached.
+    """
+
+    MAXSIZE = 100
+    MAXBYTES = 64 * 1024 * 1024
+    # memcached does not take values larger than 1MB by default
+    MAX_ENTRY_SIZE = 1024 * 1024
+    TIMEOUT = 7 * 24 * 60 * 60
+
+    def __init__(self, prefix, maxsize=MAXSIZE, maxbytes=MAXBYTES, max_entry_size=MAX_ENTRY_SIZE, timeout=TIMEOUT):
+        self.prefix = prefix
+        self.entries = LRUCache(maxsize, maxbytes)
+        self.max_entry_size = max_entry_size
+        self.timeout = timeout
+
+    def get(self, key):
+        """
+        Returns the value for `key`, or None if it is not cached.
+        """
+        key = self.prefix + key
+        data = self.entries.get(key)
+        if data is None:
+            data = cache.get(key)
+            if data is None:
+                return None
+            self.entries.set(key, data)
+        return pickle.loads(zlib.decompress(data))
+
+    def set(self, key, value):
+        key = self.prefix + key
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if len(data) > self.max_entry_size:
+            return
+        self.entries.set(key, data)
+        cache.set(key, data, self.timeout)
+
+    def clear(self):
+        self.entries.clear()
@@ -1,10 +1,229 @@
+from array import array
 from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import groupby
+import hashlib
+import heapq
 
 
+from django.db.models import Case, When, Value, CharField, IntegerField, Count, Min, Max, Sum, F, Q, Func
+
+
+from squad.core.cache import ResultCache
 from squad.core.utils import join_name
 from squad.core.models import Build, Test
 
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# test results as integers, so that they can be aggregated in SQL
+RESULT_CODE = Case(
+    When(result=True, then=Value(1)),
+    When(result=False, then=Value(2)),
+    default=Value(3),
+    output_field=IntegerField(),
+)
+
+
+def count_if(**conditions):
+    return Sum(Case(When(then=Value(1), **conditions), default=Value(0), output_field=IntegerField()))
+
+
+class Binary(Func):
+    """
+    A string expression that sorts by code point (i.e. just like Python
+    sorts strings), whatever the collation of the database.
+    """
+    template = '%(expressions)s'
+
+    def __init__(self, expression, **extra):
+        super(Binary, self).__init__(expression, output_field=CharField(), **extra)
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='%(expressions)s COLLATE "C"')
+
+    def as_mysql(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='BINARY %(expressions)s')
+
+
+class ResultMatrix(object):
+    """
+    Test results as a matrix of small integers, with one row per test (in
+    the order of `tests`) and one column per (Build, environment slug) pair
+    (in the order of `columns`). Cells hold the index of the status in
+    STATUSES, i.e. MISSING (0) where a test has no result.
+
+    When NumPy is available, the row comparisons used by `differing_rows`
+    and `regressed_rows` are vectorized. Otherwise a pure Python
+    implementation is used, which gives the same results.
+    """
+
+    MISSING, PASS, FAIL, SKIP = range(4)
+    STATUSES = (None, Test.STATUSES[True], Test.STATUSES[False], Test.STATUSES[None])
+    CODES = {True: PASS, False: FAIL, None: SKIP}
+
+    def __init__(self, tests, columns, column_index=None):
+        self.tests = list(tests)
+        self.columns = list(columns)
+        self.test_index = {test: i for i, test in enumerate(self.tests)}
+        if column_index is None:
+            column_index = {column: j for j, column in enumerate(self.columns)}
+        self.column_index = column_index
+        self.data = array('b', bytes(len(self.tests) * len(self.columns)))
+
+    def set(self, test, column, result):
+        self.data[self.test_index[test] * len(self.columns) + self.column_index[column]] = self.CODES[result]
+
+    def get(self, row, column):
+        """
+        Returns the status of the test in `row`, in `column`, or None.
+        """
+        j = self.column_index.get(column)
+        if j is None:
+            return None
+        return self.STATUSES[self.data[row * len(self.columns) + j]]
+
+    def __pairs__(self, pairs):
+        """
+        Maps (before, after) column pairs to column indexes; columns that
+        are not in the matrix map to -1, i.e. the column of MISSING values
+        that is appended to each row.
+        """
+        return [(self.column_index.get(a, -1), self.column_index.get(b, -1)) for a, b in pairs]
+
+    def __rows__(self):
+        """
+        The matrix as a list of rows, each with an extra MISSING column.
+        """
+        n = len(self.columns)
+        return [self.data[i * n:(i + 1) * n] + array('b', [self.MISSING]) for i in range(len(self.tests))]
+
+    def __numpy__(self):
+        matrix = numpy.frombuffer(self.data, dtype=numpy.int8).reshape(len(self.tests), len(self.columns))
+        return numpy.hstack([matrix, numpy.zeros((len(self.tests), 1), dtype=numpy.int8)])
+
+    def differing_rows(self, pairs):
+        """
+        Returns the indexes of the rows that have different values in the
+        two columns of any of `pairs`, a list of (column, column) tuples.
+        """
+        pairs = self.__pairs__(pairs)
+        if not pairs or not self.tests:
+            return []
+        if numpy:
+            matrix = self.__numpy__()
+            a, b = zip(*pairs)
+            differ = (matrix[:, list(a)] != matrix[:, list(b)]).any(axis=1)
+            return numpy.flatnonzero(differ).tolist()
+        return [i for i, row in enumerate(self.__rows__()) if any(row[a] != row[b] for a, b in pairs)]
+
+    def regressed_rows(self, before, after):
+        """
+        Returns the indexes of the rows that pass in the `before` column, and
+        fail in the `after` one.
+        """
+        (a, b), = self.__pairs__([(before, after)])
+        if not self.tests:
+            return []
+        if numpy:
+            matrix = self.__numpy__()
+            regressed = (matrix[:, a] == self.PASS) & (matrix[:, b] == self.FAIL)
+            return numpy.flatnonzero(regressed).tolist()
+        return [i for i, row in enumerate(self.__rows__()) if (row[a], row[b]) == (self.PASS, self.FAIL)]
+
+    def subset(self, rows):
+        """
+        Returns a new ResultMatrix with only the given rows.
+        """
+        n = len(self.columns)
+        matrix = ResultMatrix([self.tests[i] for i in rows], self.columns)
+        for k, i in enumerate(rows):
+            matrix.data[k * n:(k + 1) * n] = self.data[i * n:(i + 1) * n]
+        return matrix
+
+    def dump(self):
+        """
+        Returns the matrix as a tuple of builtin types, with each Build in
+        the columns replaced by its ID.
+        """
+        return (self.tests, [(build.id, env) for build, env in self.columns], self.data.tobytes())
+
+    @classmethod
+    def load(cls, state, builds):
+        """
+        The reverse of `dump`; `builds` is the list of Build objects that
+        the IDs in the columns refer to.
+        """
+        tests, columns, data = state
+        builds = {build.id: build for build in builds}
+        matrix = cls(tests, [(builds[build_id], env) for build_id, env in columns])
+        matrix.data = array('b', data)
+        return matrix
+
+    def view(self, rows=None):
+        """
+        Returns a read-only mapping of test names to their results (see
+        ResultsView), for the given rows (default: all of them).
+        """
+        return ResultsView(self, range(len(self.tests)) if rows is None else rows)
+
+
+class ResultsView(Mapping):
+    """
+    Maps test names to the results of the tests in `rows` of a
+    ResultMatrix, in order. The results of each test are also a mapping
+    (see RowView), created on access.
+    """
+
+    def __init__(self, matrix, rows):
+        self.matrix = matrix
+        self.rows = list(rows)
+        self.row_set = set(self.rows)
+
+    def __getitem__(self, test):
+        row = self.matrix.test_index.get(test)
+        if row is None or row not in self.row_set:
+            raise KeyError(test)
+        return RowView(self.matrix, row)
+
+    def __iter__(self):
+        return (self.matrix.tests[row] for row in self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class RowView(Mapping):
+    """
+    Maps (Build, environment slug) pairs to the status of a test (e.g.
+    'pass'), for the pairs where the test has a result.
+    """
+
+    def __init__(self, matrix, row):
+        self.matrix = matrix
+        self.row = row
+
+    def __getitem__(self, column):
+        status = self.matrix.get(self.row, column)
+        if status is None:
+            raise KeyError(column)
+        return status
+
+    def __iter__(self):
+        return (c for c in self.matrix.columns if self.matrix.get(self.row, c) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+# comparison results, keyed by TestComparison.cache_key
+comparison_cache = ResultCache('squad.core.comparison.')
+
+
 class TestComparison(object):
     """
     Data structure:
@@ -37,16 +256,37 @@ class TestComparison(object):
     mapping, between Environment (the column) and the test result (the cells in
     the table). So results[testname][env] gives you the value of the cell at
     (testname, env)
+
+    Only tests that have results in at least one of the builds are included.
+    The results are stored in a ResultMatrix (`matrix`), loaded on first
+    access; `results` and `diff` are read-only mapping views over it. `diff`
+    and `regressions` find the rows they need with an aggregate query
+    grouped by (suite, test name, environment), and only load the results
+    for those rows, unless `matrix` is already loaded.
+
+    `matrix`, `diff` and `regressions` are cached in `comparison_cache`
+    once all test runs of the builds are processed. The cache key includes
+    the number of test runs of each build, and the ID and creation time of
+    its latest one, so a new test run in any of the builds makes for a
+    different key.
+
+    For comparisons too large to hold in memory, `iter_results`, `iter_diff`
+    and `iter_regressions` read the results as a stream instead;
+    notifications use them when the comparison cannot be cached.
     """
 
+    # maximum number of tests looked up by name in a single query
+    CHUNK_SIZE = 500
+
     def __init__(self, *builds):
         self.builds = list(builds)
         self.environments = OrderedDict()
         self.all_environments = set()
-        self.results = OrderedDict()
+        self.test_runs = OrderedDict()
 
         Build.prefetch_related(self.builds)
-        self.__extract_results__()
+        self.__extract_environments__()
+        self.cache_key = self.__cache_key__()
 
     @classmethod
     def compare_builds(cls, *builds):
@@ -58,9 +298,7 @@ class TestComparison(object):
         builds = [p.builds.last() for p in projects]
         return cls.compare_builds(*builds)
 
-    def __extract_results__(self):
-        for test in self.__all_tests__():
-            self.results[test] = OrderedDict()
+    def __extract_environments__(self):
         for build in self.builds:
             test_runs = list(build.test_runs.all())
             environments = [t.environment for t in test_runs]
@@ -68,24 +306,115 @@ class TestComparison(object):
                 self.all_environments.add(e.slug)
             self.environments[build] = sorted([e.slug for e in set(environments)])
             for test_run in test_runs:
-                self.__extract_test_results__(test_run)
-
-    def __extract_test_results__(self, test_run):
-        for test in test_run.tests.all():
-            key = (test_run.build, test_run.environment.slug)
-            self.results[test.full_name][key] = test.status
-
-    def __all_tests__(self):
-        data = Test.objects.filter(
-            test_run__build__project__in=[b.project for b in self.builds]
-        ).order_by(
-            'suite__slug',
-            'name',
-        ).values(
-            'suite__slug',
-            'name',
-        ).distinct()
-        return sorted([join_name(item['suite__slug'], item['name']) for item in data])
+                self.test_runs[test_run.id] = test_run
+
+    def __cache_key__(self):
+        """
+        Returns the key of this comparison in `comparison_cache`, or None if
+        it cannot be cached, i.e. if there are test runs whose tests were
+        not stored yet.
+        """
+        if not all(t.data_processed for t in self.test_runs.values()):
+            return None
+        key = []
+        for build in self.builds:
+            test_runs = sorted((t.id, t.created_at) for t in self.test_runs.values() if t.build_id == build.id)
+            latest = test_runs and '%d:%s' % test_runs[-1] or ''
+            key.append('%d:%d:%s' % (build.id, len(test_runs), latest))
+        return hashlib.sha1(','.join(key).encode()).hexdigest()
+
+    def __cached__(self, name, compute, dump=lambda v: v, load=lambda v: v):
+        """
+        Returns the value of `compute()` from the cache, computing and
+        caching it if needed.
+        """
+        if self.cache_key is None:
+            return compute()
+        key = name + ':' + self.cache_key
+        value = comparison_cache.get(key)
+        if value is not None:
+            return load(value)
+        value = compute()
+        comparison_cache.set(key, dump(value))
+        return value
+
+    def __cached_matrix__(self, name, compute):
+        return self.__cached__(
+            name,
+            compute,
+            dump=lambda matrix: matrix.dump(),
+            load=lambda state: ResultMatrix.load(state, self.builds),
+        )
+
+    def __tests__(self, *builds):
+        """
+        Returns the tests in `builds` (default: all of the compared builds).
+        """
+        builds = set(b.id for b in builds or self.builds)
+        test_runs = [t.id for t in self.test_runs.values() if t.build_id in builds]
+        return Test.objects.filter(test_run_id__in=test_runs)
+
+    def __columns__(self):
+        columns = OrderedDict()
+        for build in self.builds:
+            for env in self.environments[build]:
+                columns[(build, env)] = True
+        return columns.keys()
+
+    def __extract_results__(self, *querysets, keys=None):
+        """
+        Returns a ResultMatrix with the results of the tests in
+        `querysets`. If `keys` is given, only the tests whose (suite slug,
+        test name) is in it are included. When a test has more than one
+        result in the same build and environment, the one from the latest
+        test run is used.
+        """
+        data = []
+        for tests in querysets:
+            tests = tests.order_by('test_run_id', 'id').values_list('test_run_id', 'known_test__suite__slug', 'known_test__name', 'result')
+            for test_run_id, suite, name, result in tests:
+                if keys is None or (suite, name) in keys:
+                    data.append((test_run_id, join_name(suite, name), result))
+
+        matrix = ResultMatrix(sorted(set(test for _, test, _ in data)), self.__columns__())
+        for test_run_id, test, result in data:
+            test_run = self.test_runs[test_run_id]
+            matrix.set(test, (test_run.build, test_run.environment.slug), result)
+        return matrix
+
+    def __matrix_for__(self, keys):
+        """
+        Returns a ResultMatrix with the results of the tests in `keys`, a
+        set of (suite slug, test name) tuples, or the one with all results
+        if that was already loaded.
+        """
+        if self.__matrix__ is not None:
+            return self.__matrix__
+
+        keys = sorted(keys)
+        querysets = []
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i + self.CHUNK_SIZE]
+            querysets.append(self.__tests__().filter(
+                known_test__suite__slug__in=set(suite for suite, _ in chunk),
+                known_test__name__in=set(name for _, name in chunk),
+            ))
+        return self.__extract_results__(*querysets, keys=set(keys))
+
+    __matrix__ = None
+
+    @property
+    def matrix(self):
+        """
+        The ResultMatrix with all of the results.
+        """
+        if self.__matrix__ is None:
+            self.__matrix__ = self.__cached_matrix__('matrix', lambda: self.__extract_results__(self.__tests__()))
+        return self.__matrix__
+
+    @property
+    def results(self):
+        return self.matrix.view()
 
     __diff__ = None
 
@@ -93,47 +422,149 @@ class TestComparison(object):
     def diff(self):
         """
         Returns a subset of the rows, containing only the rows where results
-        differ between the builds.
-        """
-        if self.__diff__ is not None:
-            return self.__diff__
-
-        d = OrderedDict()
-        for test, results in self.results.items():
-            previous = None
-            for build in self.builds:
-                current = [results.get((build, e)) for e in self.environments[build]]
-                if previous and previous != current:
-                    d[test] = results
-                    break
-                previous = current
-
-        self.__diff__ = d
+        differ between the builds (in any environment, a test missing in one
+        build counting as a different result).
+        """
+        if self.__diff__ is None:
+            self.__diff__ = self.__cached_matrix__('diff', self.__extract_diff__).view()
         return self.__diff__
 
+    def __extract_diff__(self):
+        if len(self.builds) < 2:
+            return ResultMatrix([], self.__columns__())
+
+        # the results of a test in an environment are all the same iff the
+        # test is in all builds, and has a single result; if a build has
+        # different results for the test, the latest one may still be the
+        # same as in the other builds, so that is checked below
+        candidates = self.__tests__().values(
+            'known_test__suite__slug', 'known_test__name', 'test_run__environment__slug',
+        ).annotate(
+            low=Min(RESULT_CODE),
+            high=Max(RESULT_CODE),
+            builds=Count('test_run__build', distinct=True),
+        ).filter(
+            Q(low__lt=F('high')) | Q(builds__lt=len(set(b.id for b in self.builds)))
+        ).values_list('known_test__suite__slug', 'known_test__name')
+
+        columns = []
+        for before, after in zip(self.builds, self.builds[1:]):
+            for env in sorted(set(self.environments[before]) | set(self.environments[after])):
+                columns.append(((before, env), (after, env)))
+
+        matrix = self.__matrix_for__(set(candidates))
+        return matrix.subset(matrix.differing_rows(columns))
+
     __regressions__ = None
 
     @property
     def regressions(self):
-        if self.__regressions__ is not None:
-            return self.__regressions__
+        if self.__regressions__ is None:
+            self.__regressions__ = self.__cached__('regressions', self.__extract_regressions__)
+        return self.__regressions__
 
+    def __extract_regressions__(self):
         if len(self.builds) < 2:
-            self.__regressions__ = {}
-            return self.__regressions__
+            return {}
 
-        regressions = OrderedDict()
         after = self.builds[-1]  # last
         before = self.builds[-2]  # second to last
+
+        candidates = self.__tests__(before, after).filter(
+            test_run__environment__slug__in=self.environments[after],
+        ).values(
+            'known_test__suite__slug', 'known_test__name', 'test_run__environment__slug',
+        ).annotate(
+            passed_before=count_if(test_run__build=before, result=True),
+            failed_after=count_if(test_run__build=after, result=False),
+        ).filter(
+            passed_before__gt=0,
+            failed_after__gt=0,
+        ).values_list('known_test__suite__slug', 'known_test__name')
+        matrix = self.__matrix_for__(set(candidates))
+
+        regressions = OrderedDict()
         for env in self.environments[after]:
-            regression_list = []
-            for test, results in self.diff.items():
-                results_after = results.get((after, env))
-                results_before = results.get((before, env))
-                if (results_before, results_after) == ('pass', 'fail'):
-                    regression_list.append(test)
+            regression_list = [matrix.tests[i] for i in matrix.regressed_rows((before, env), (after, env))]
             if regression_list:
                 regressions[env] = regression_list
+        return regressions
 
-        self.__regressions__ = regressions
-        return self.__regressions__
+    def __column_stream__(self, j, build, env):
+        """
+        Yields (suite slug, test name, j, result code) for the tests of
+        `build` in `env`, sorted by suite slug and test name, reading them
+        through a server-side cursor where the database supports it.
+        """
+        test_runs = [
+            t.id for t in self.test_runs.values()
+            if t.build_id == build.id and t.environment.slug == env
+        ]
+        tests = Test.objects.filter(test_run_id__in=test_runs).order_by(
+            Binary('known_test__suite__slug'), Binary('known_test__name'), 'test_run_id', 'id',
+        ).values_list('known_test__suite__slug', 'known_test__name', 'result').iterator()
+        for (suite, name), results in groupby(tests, key=lambda t: t[:2]):
+            for _, _, result in results:
+                pass  # the latest one is used
+            yield suite, name, j, ResultMatrix.CODES[result]
+
+    def iter_results(self):
+        """
+        Yields (test name, results) for each test in the compared builds,
+        where `results` is in the same format as the values of `results`.
+
+        Unlike `results`, this does not load all of the results at once:
+        the tests of each (build, environment) column are read in order of
+        suite and test name, and the columns are merged as they are read,
+        so memory usage depends on the number of columns, not on the number
+        of tests. Tests come sorted by suite slug and test name.
+
+        That bound only holds when the database driver does not fetch all
+        rows of a query at once, i.e. with server-side cursors, which Django
+        only uses for `.iterator()` from 1.11 on, and only on PostgreSQL.
+        On Django 1.10, or on SQLite, each column is still read in full
+        (by the driver, or by Django itself on SQLite) before it is merged,
+        although never into a matrix of all results.
+        """
+        columns = list(self.__columns__())
+        column_index = {column: j for j, column in enumerate(columns)}
+        streams = [self.__column_stream__(j, build, env) for j, (build, env) in enumerate(columns)]
+        for (suite, name), items in groupby(heapq.merge(*streams), key=lambda item: item[:2]):
+            row = ResultMatrix([join_name(suite, name)], columns, column_index)
+            for _, _, j, code in items:
+                row.data[j] = code
+            yield row.tests[0], RowView(row, 0)
+
+    def iter_diff(self):
+        """
+        Same as `iter_results`, but only for the tests in `diff`.
+        """
+        if len(self.builds) < 2:
+            return
+        columns = {column: j for j, column in enumerate(self.__columns__())}
+        pairs = []
+        for before, after in zip(self.builds, self.builds[1:]):
+            for env in sorted(set(self.environments[before]) | set(self.environments[after])):
+                pairs.append((columns.get((before, env)), columns.get((after, env))))
+
+        def code(codes, j):
+            return ResultMatrix.MISSING if j is None else codes[j]
+
+        for test, results in self.iter_results():
+            codes = results.matrix.data
+            if any(code(codes, a) != code(codes, b) for a, b in pairs):
+                yield test, results
+
+    def iter_regressions(self):
+        """
+        Yields (environment slug, test name) for each regression (see
+        `regressions`), reading the results like `iter_results` does.
+        """
+        if len(self.builds) < 2:
+            return
+        after = self.builds[-1]
+        before = self.builds[-2]
+        for test, results in self.iter_results():
+            for env in self.environments[after]:
+                if (results.get((before, env)), results.get((after, env))) == ('pass', 'fail'):
+                    yield env, test
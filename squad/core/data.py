@@ -1,11 +1,237 @@
+import codecs
+from collections import OrderedDict
+import io
 import json
 import math
+import re
 from statistics import mean
 
 
 from squad.core.utils import parse_name
 
 
+class JSONObjectExpected(ValueError):
+    """
+    Raised when a document is valid JSON, but not a JSON object.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        super(JSONObjectExpected, self).__init__("%r is not an object ({})" % obj)
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+SIMPLE_KEY = re.compile(r'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*')
+MEMBER_END = re.compile(r'[ \t\n\r]*([,}])')
+NUMBER_TAIL = re.compile(r'[-+.eE0-9]*')
+
+
+class JSONObjectReader(object):
+    """
+    Reads the members of a JSON object incrementally, so that a document
+    with millions of members can be processed without ever having all of it
+    in memory at once. Only the top level object is parsed incrementally;
+    each value is decoded with the standard JSON decoder.
+
+    `data` can be a string, bytes, or a text or binary file-like object.
+    Malformed documents raise json.JSONDecodeError, just like json.loads,
+    with the position of the error in the whole document.
+
+    Members with duplicate keys are all yielded, in the order they appear;
+    see `unique_items`.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = io.StringIO(data)
+        elif isinstance(data, bytes):
+            data = io.BytesIO(data)
+        self.stream = data
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        # position of the start of the buffer in the document
+        self.offset = 0
+        self.lines = 0
+        self.column = 0
+
+    def __iter__(self):
+        try:
+            yield from self.read_members()
+        except json.JSONDecodeError as e:
+            raise self.absolute_error(e) from None
+
+    def read_members(self):
+        self.skip_whitespace()
+        if self.peek() != '{':
+            raise JSONObjectExpected(self.decode_value())
+        self.pos += 1
+
+        self.skip_whitespace()
+        if self.peek() == '}':
+            self.pos += 1
+        else:
+            last = False
+            while not last:
+                key, value, last = self.read_simple_member() or self.read_member()
+                yield key, value
+
+        self.skip_whitespace()
+        if self.peek() is not None:
+            self.error('Extra data')
+
+    def read_simple_member(self):
+        """
+        Fast path for reading the next member when it is entirely in the
+        buffer and its key has no escape sequences, which is by far the most
+        common case. Returns None if that is not the case.
+
+        Values that might have been cut at the end of the buffer are left
+        to the slow path too (see `cut`).
+        """
+        buf = self.buffer
+        key = SIMPLE_KEY.match(buf, self.pos)
+        if not key:
+            return None
+        try:
+            value, end = self.decoder.raw_decode(buf, key.end())
+        except json.JSONDecodeError:
+            return None
+        sep = MEMBER_END.match(buf, end)
+        if not sep or self.cut(end):
+            return None
+        self.pos = sep.end()
+        return key.group(1), value, sep.group(1) == '}'
+
+    def read_member(self):
+        self.skip_whitespace()
+        key = self.decode_value()
+        if not isinstance(key, str):
+            self.error('Expecting property name enclosed in double quotes')
+        self.skip_whitespace()
+        self.expect(':')
+        self.skip_whitespace()
+        value = self.decode_value()
+
+        self.skip_whitespace()
+        c = self.peek()
+        if c not in (',', '}'):
+            self.error("Expecting ',' delimiter")
+        self.pos += 1
+        return key, value, c == '}'
+
+    def fill(self):
+        chunk = self.stream.read(self.CHUNK_SIZE)
+        if isinstance(chunk, bytes):
+            text = self.utf8.decode(chunk, final=not chunk)
+        else:
+            text = chunk
+        if not chunk:
+            self.eof = True
+        consumed = self.buffer[:self.pos]
+        self.offset += len(consumed)
+        newlines = consumed.count('\n')
+        if newlines:
+            self.lines += newlines
+            self.column = len(consumed) - consumed.rindex('\n') - 1
+        else:
+            self.column += len(consumed)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+
+    def peek(self):
+        while self.pos >= len(self.buffer):
+            if self.eof:
+                return None
+            self.fill()
+        return self.buffer[self.pos]
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            self.error("Expecting '%s' delimiter" % char)
+        self.pos += 1
+
+    def decode_value(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if not self.cut(end):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def cut(self, end):
+        """
+        Tells whether the value decoded up to `end` might have been cut at
+        the end of the buffer, i.e. if it ends there (e.g. the number 12 out
+        of 123), or if it is followed only by what could still be part of a
+        number (e.g. 12 out of 12.5, or 1 out of 1e-3).
+        """
+        if self.eof:
+            return False
+        return NUMBER_TAIL.match(self.buffer, end).end() == len(self.buffer)
+
+    def error(self, msg):
+        raise json.JSONDecodeError(msg, self.buffer, self.pos)
+
+    def absolute_error(self, e):
+        """
+        Converts an error at a position in the buffer into one at the
+        corresponding position in the document.
+        """
+        pos = self.offset + e.pos
+        lineno = self.lines + e.doc.count('\n', 0, e.pos) + 1
+        if e.doc.rfind('\n', 0, e.pos) >= 0:
+            colno = e.colno
+        else:
+            colno = self.column + e.pos + 1
+        error = json.JSONDecodeError(e.msg, e.doc, e.pos)
+        error.pos, error.lineno, error.colno = pos, lineno, colno
+        error.args = ('%s: line %d column %d (char %d)' % (e.msg, lineno, colno, pos),)
+        return error
+
+
+def json_items(data):
+    """
+    Returns an iterator over the (key, value) pairs of a JSON object. `data`
+    can be the already decoded object, an iterable of pairs, or anything that
+    JSONObjectReader accepts. Just like with JSONObjectReader, duplicate keys
+    are not removed.
+    """
+    if data is None or data == '' or data == b'':
+        return iter([])
+    if isinstance(data, dict):
+        return iter(data.items())
+    if isinstance(data, (str, bytes)) or hasattr(data, 'read'):
+        return iter(JSONObjectReader(data))
+    return iter(data)
+
+
+def unique_items(items):
+    """
+    Returns the (key, value) pairs from `items`, keeping only the last value
+    of duplicate keys, at the position of the first one, like json.loads
+    does. This needs all of the pairs at once, so it is only meant for
+    parsers that return lists anyway; incremental consumers must handle
+    duplicates themselves (see squad.core.tasks.ParseTestRunData).
+    """
+    return list(OrderedDict(items).items())
+
+
 test_result_mapping = {'pass': True, 'fail': False}
 
 
@@ -16,24 +242,28 @@ def parse_test_result(value):
 
 class JSONTestDataParser(object):
     """
-    Parser for test data as JSON string
+    Parser for test data as JSON string, or as the already decoded JSON
+    object. See `json_items` for all the accepted input types.
     """
 
     @staticmethod
     def __call__(test_data):
-        if test_data is None or test_data == '':
-            return []
+        return list(JSONTestDataParser.iterate(unique_items(json_items(test_data))))
 
-        input_data = json.loads(test_data)
-        data = []
-        for key, value in input_data.items():
+    @staticmethod
+    def iterate(test_data):
+        """
+        Same as calling the parser, but yields the tests one by one as they
+        are parsed instead of returning a list, including the ones with
+        duplicate names (see `unique_items`).
+        """
+        for key, value in json_items(test_data):
             group_name, test_name = parse_name(key)
-            data.append({
+            yield {
                 "group_name": group_name,
                 "test_name": test_name,
                 "pass": parse_test_result(value),
-            })
-        return data
+            }
 
 
 def parse_metric(value):
@@ -45,26 +275,28 @@ def parse_metric(value):
 
 class JSONMetricDataParser(object):
     """
-    Parser for JSON metric data
+    Parser for JSON metric data, either as a string or as the already decoded
+    JSON object. See `json_items` for all the accepted input types.
     """
 
     @staticmethod
     def __call__(json_text):
-        if json_text is None or json_text == '':
-            return []
-
-        input_data = json.loads(json_text)
-        data = []
+        return list(JSONMetricDataParser.iterate(unique_items(json_items(json_text))))
 
-        for key, value in input_data.items():
+    @staticmethod
+    def iterate(json_text):
+        """
+        Same as calling the parser, but yields the metrics one by one as they
+        are parsed instead of returning a list, including the ones with
+        duplicate names (see `unique_items`).
+        """
+        for key, value in json_items(json_text):
             group_name, name = parse_name(key)
             result, measurements = parse_metric(value)
             if result and not (math.isnan(result) or math.isinf(result)):
-                data.append({
+                yield {
                     "name": name,
                     "group_name": group_name,
                     "result": result,
                     "measurements": measurements,
-                })
-
-        return data
+                }
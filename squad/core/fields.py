@@ -1,3 +1,7 @@
+from array import array
+import sys
+
+
 from django.db import models
 
 
@@ -8,3 +12,68 @@ class VersionField(models.TextField):
             return 'debversion'
         else:
             return super(VersionField, self).db_type(connection)
+
+
+def float_array(value):
+    """
+    Returns `value` as an array of floats (`array.array('d')`). `value` can
+    be an array, a list of numbers, a string with comma-separated numbers
+    (the format measurements used to be stored in), packed float64 data as
+    stored by FloatArrayField, or None.
+    """
+    if value is None:
+        return array('d')
+    if isinstance(value, array):
+        return value
+    if isinstance(value, str):
+        return array('d', (float(n) for n in value.split(',') if n))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        result = array('d')
+        result.frombytes(value)
+        if sys.byteorder == 'big':
+            result.byteswap()
+        return result
+    return array('d', value)
+
+
+def pack_floats(value):
+    """
+    Packs `value` (see `float_array`) as little-endian float64 values.
+    """
+    values = float_array(value)
+    if sys.byteorder == 'big':
+        values = array('d', values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class FloatArrayField(models.BinaryField):
+    """
+    Stores a list of floats as a packed array of little-endian float64
+    values. Values read from the database are `array.array('d')` objects,
+    which are decoded in a single pass over the buffer instead of one
+    number at a time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', b'')
+        super(FloatArrayField, self).__init__(*args, **kwargs)
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return float_array(value)
+
+    def to_python(self, value):
+        if value is None:
+            return value
+        return float_array(value)
+
+    def value_to_string(self, obj):
+        # serialized as comma-separated numbers, which to_python accepts
+        return ','.join(str(v) for v in float_array(self.value_from_object(obj)))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        return super(FloatArrayField, self).get_db_prep_value(pack_floats(value), connection, prepared)
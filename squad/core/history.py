@@ -1,8 +1,7 @@
 from collections import OrderedDict
 
 
-from squad.core.utils import parse_name
-from squad.core.models import Test
+from squad.core.models import KnownTest, Test
 
 
 class TestResult(object):
@@ -15,14 +14,10 @@ class TestResult(object):
 class TestHistory(object):
 
     def __init__(self, project, full_test_name):
-        suite, test_name = parse_name(full_test_name)
         self.test = full_test_name
 
-        tests = Test.objects.filter(
-            suite__slug=suite,
-            name=test_name,
-            test_run__build__project=project,
-        )
+        known_test = KnownTest.by_full_name(project, full_test_name)
+        tests = Test.objects.filter(known_test=known_test) if known_test else Test.objects.none()
         Test.prefetch_related(tests)
 
         environments = OrderedDict()
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+
+from squad.core.models import TestRun, Test, Metric
+
+
+class Command(BaseCommand):
+
+    help = """Fill in the project, environment, build and build datetime of
+    tests and metrics received before those were stored in them"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', '-b',
+            type=int,
+            default=100,
+            dest='batch_size',
+            help='number of test runs processed in each transaction (default: 100)',
+        )
+
+        parser.add_argument(
+            '--silent', '-s',
+            action='store_true',
+            dest='silent',
+            help='operate silently (i.e. don\'t output anything)',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+
+        testruns = TestRun.objects.order_by('id').select_related('build').only(
+            'id', 'environment_id', 'build_id', 'build__project_id', 'build__datetime',
+        )
+        total = testruns.count()
+        count = 0
+        rows = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                batch = list(testruns.filter(id__gt=last_id)[:self.options['batch_size']])
+                if not batch:
+                    break
+                for testrun in batch:
+                    fields = testrun.denormalized_fields()
+                    for model in (Test, Metric):
+                        rows += model.objects.filter(test_run=testrun, build__isnull=True).update(**fields)
+            count += len(batch)
+            last_id = batch[-1].id
+            self.log('%d/%d test runs processed (%d tests and metrics updated)' % (count, total, rows))
+
+    def log(self, msg):
+        if not self.options['silent']:
+            self.stdout.write(msg)
@@ -0,0 +1,100 @@
+from datetime import timedelta
+from itertools import islice
+import time
+
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+
+from squad.core.models import Blob
+from squad.core.storage import get_blob_store
+
+
+class Command(BaseCommand):
+
+    help = """Delete data files, logs and attachments that are not used by any
+    test run anymore from the blob store"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', '-b',
+            type=int,
+            default=1000,
+            dest='batch_size',
+            help='number of blobs to delete in each transaction (default: 1000)',
+        )
+
+        parser.add_argument(
+            '--grace-period', '-g',
+            type=float,
+            default=24,
+            dest='grace_period',
+            help='only delete blobs, and files without a corresponding blob in the database, if they were stored at least this many hours ago (default: 24)',
+        )
+
+        parser.add_argument(
+            '--silent', '-s',
+            action='store_true',
+            dest='silent',
+            help='operate silently (i.e. don\'t output anything)',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.store = get_blob_store()
+        self.delete_unreferenced_blobs()
+        self.delete_orphan_files()
+
+    def delete_unreferenced_blobs(self):
+        """
+        Deletes the blobs of test runs and attachments that were deleted,
+        e.g. test runs with invalid data that were processed asynchronously.
+        Recently stored blobs are kept, as the test run or attachment that
+        will refer to them might not have been created yet (see
+        BlobManager.store).
+        """
+        touched_before = timezone.now() - timedelta(hours=self.options['grace_period'])
+        count = 0
+        size = 0
+        while True:
+            with transaction.atomic():
+                unreferenced = Blob.objects.unreferenced().filter(touched_at__lt=touched_before)
+                batch = list(unreferenced.select_for_update()[:self.options['batch_size']])
+                if not batch:
+                    break
+                Blob.objects.filter(key__in=[blob.key for blob in batch]).delete()
+                # before committing, so that a concurrent BlobManager.store
+                # waiting on these rows stores the contents again afterwards
+                for blob in batch:
+                    self.store.delete(blob.storage_key)
+            count += len(batch)
+            size += sum(blob.stored_size for blob in batch)
+            self.log('blobs: %d deleted (%d bytes)' % (count, size))
+
+    def delete_orphan_files(self):
+        """
+        Deletes the files that were written to the blob store by transactions
+        that were rolled back, and so have no corresponding blob. Recently
+        written files are kept, as the transaction that wrote them might
+        still be running.
+        """
+        written_before = time.time() - self.options['grace_period'] * 3600
+        keys = self.store.keys(written_before=written_before)
+        count = 0
+        while True:
+            batch = list(islice(keys, self.options['batch_size']))
+            if not batch:
+                break
+            blobs = Blob.objects.filter(key__in=set(k[:64] for k in batch))
+            stored = set(blob.storage_key for blob in blobs)
+            for key in batch:
+                if key not in stored:
+                    self.store.delete(key)
+                    count += 1
+            self.log('orphan files: %d deleted' % count)
+
+    def log(self, msg):
+        if not self.options['silent']:
+            self.stdout.write(msg)
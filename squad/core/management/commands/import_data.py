@@ -1,15 +1,25 @@
+from contextlib import ExitStack
 from glob import glob
-import json
+from itertools import groupby
+import multiprocessing
 import os
 import re
-import sys
+import time
 from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
 
 
-from squad.core.models import Group
+from squad.core.models import Group, Project, build_ids, environment_ids
 from squad.core.tasks import ReceiveTestRun
 
 
+DATA_FILES = {
+    'metadata.json': 'metadata_file',
+    'metrics.json': 'metrics_file',
+    'tests.json': 'tests_file',
+}
+
+
 def build_key(path):
     name = os.path.basename(path)
     if re.match('^[0-9]+$', name):
@@ -20,6 +30,56 @@ def build_key(path):
         return 0
 
 
+def import_testrun(receive, build, environment, directory):
+    """
+    Imports the test run in `directory`, returning the number of bytes read.
+    Files are passed down open, so that attachments are read one at a time.
+    """
+    size = 0
+    with ExitStack() as files:
+        data = {'attachments': {}}
+        for f in sorted(glob(os.path.join(directory, '*'))):
+            name = os.path.basename(f)
+            size += os.path.getsize(f)
+            stream = files.enter_context(open(f, 'rb'))
+            if name in DATA_FILES:
+                data[DATA_FILES[name]] = stream
+            else:
+                data['attachments'][name] = stream
+        if 'metadata_file' not in data:
+            # mandatory
+            raise FileNotFoundError(os.path.join(directory, 'metadata.json'))
+        receive.receive(build, environment, **data)
+    return size
+
+
+def import_batch(batch):
+    """
+    Imports a batch of test runs from the same build and environment, in a
+    single transaction. `batch` is a (project_id, version, environment_slug,
+    directories) tuple.
+
+    Returns the list of imported directories and the number of bytes read.
+    This runs in the worker processes in parallel mode.
+    """
+    project_id, version, environment_slug, directories = batch
+    project = Project.objects.get(pk=project_id)
+    build = build_ids.get_or_create(project, version)
+    environment = environment_ids.get_or_create(project, environment_slug)
+    receive = ReceiveTestRun(project)
+
+    size = 0
+    with transaction.atomic():
+        for directory in directories:
+            size += import_testrun(receive, build, environment, directory)
+    return directories, size
+
+
+def init_worker():
+    # never share database connections with the parent process
+    connections.close_all()
+
+
 class Command(BaseCommand):
 
     help = """Import data from DIRECTORY into PROJECT. See
@@ -41,6 +101,30 @@ class Command(BaseCommand):
             help='operate silently (i.e. don\'t output anything)',
         )
 
+        parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=1,
+            dest='jobs',
+            help='number of worker processes importing in parallel (default: 1)',
+        )
+
+        parser.add_argument(
+            '--batch-size', '-b',
+            type=int,
+            default=10,
+            dest='batch_size',
+            help='number of test runs imported in each transaction (default: 10)',
+        )
+
+        parser.add_argument(
+            '--checkpoint', '-c',
+            dest='checkpoint',
+            help='file where imported test runs are recorded; test runs '
+            'already recorded there are skipped, so that an interrupted import '
+            'can be resumed by running the same command again',
+        )
+
         parser.add_argument(
             'PROJECT',
             help='Target project, on the form $group/$project',
@@ -58,7 +142,6 @@ class Command(BaseCommand):
             group_id, project_id = options['PROJECT'].split('/')
             self.group, _ = Group.objects.get_or_create(slug=group_id)
             self.project, _ = self.group.projects.get_or_create(slug=project_id)
-            self.receive_test_run = ReceiveTestRun(self.project)
 
         if not self.options['silent']:
             print()
@@ -67,51 +150,94 @@ class Command(BaseCommand):
             print('-' * len(msg))
             print()
 
-        builds = sorted(glob(os.path.join(options['DIRECTORY'], '*')), key=build_key)
-        for directory in builds:
-            self.import_build(directory)
+        done = self.read_checkpoint()
+        testruns = [t for t in self.find_testruns() if self.relative(t[2]) not in done]
+        if done and not self.options['silent']:
+            print("Skipping %d test runs already imported" % len(done))
 
-    def import_build(self, directory):
-        build_id = os.path.basename(directory)
-
-        for envdir in glob(os.path.join(directory, '*')):
-            self.import_environment(build_id, envdir)
-
-    def import_environment(self, build_id, directory):
-        environment_slug = os.path.basename(directory)
-
-        for testrundir in glob(os.path.join(directory, '*')):
-            self.import_testrun(build_id, environment_slug, testrundir)
-
-    def import_testrun(self, build_id, environment_slug, directory):
-        # mandatory
-        metadata = open(os.path.join(directory, 'metadata.json')).read()
-
-        try:
-            metrics = open(os.path.join(directory, 'metrics.json')).read()
-        except FileNotFoundError:
-            metrics = None
-
-        try:
-            tests = open(os.path.join(directory, 'tests.json')).read()
-        except FileNotFoundError:
-            tests = None
-
-        attachments = {}
-        for f in glob(os.path.join(directory, '*')):
-            name = os.path.basename(f)
-            if name not in ['metrics.json', 'metadata.json', 'tests.json']:
-                attachments[name] = open(f, 'rb').read()
-
-        if not self.options['silent']:
-            print("Importing test run: %s" % directory)
         if self.options['dry_run']:
+            for _, _, directory in testruns:
+                self.log("Importing test run: %s" % directory)
             return
-        self.receive_test_run(
-            version=build_id,
-            environment_slug=environment_slug,
-            metadata_file=metadata,
-            metrics_file=metrics,
-            tests_file=tests,
-            attachments=attachments,
-        )
+
+        batches = []
+        for (version, environment_slug), runs in groupby(testruns, key=lambda t: t[0:2]):
+            self.project.builds.get_or_create(version=version)
+            self.project.environments.get_or_create(slug=environment_slug)
+            directories = [t[2] for t in runs]
+            for i in range(0, len(directories), self.options['batch_size']):
+                batch = directories[i:i + self.options['batch_size']]
+                batches.append((self.project.id, version, environment_slug, batch))
+
+        self.total = len(testruns)
+        self.imported = 0
+        self.size = 0
+        self.start = time.time()
+
+        jobs = self.options['jobs']
+        if jobs > 1 and connection.vendor == 'sqlite':
+            self.log('SQLite does not support concurrent writes; importing serially')
+            jobs = 1
+
+        with self.open_checkpoint() as checkpoint:
+            if jobs > 1:
+                connections.close_all()
+                with multiprocessing.Pool(jobs, initializer=init_worker) as pool:
+                    for result in pool.imap_unordered(import_batch, batches):
+                        self.record(checkpoint, *result)
+            else:
+                for batch in batches:
+                    self.record(checkpoint, *import_batch(batch))
+
+    def find_testruns(self):
+        """
+        Returns (version, environment_slug, directory) for all the test runs
+        in the input directory, ordered by build, environment and name.
+        """
+        testruns = []
+        builds = sorted(glob(os.path.join(self.options['DIRECTORY'], '*')), key=build_key)
+        for builddir in builds:
+            for envdir in sorted(glob(os.path.join(builddir, '*'))):
+                for testrundir in sorted(glob(os.path.join(envdir, '*'))):
+                    testruns.append((os.path.basename(builddir), os.path.basename(envdir), testrundir))
+        return testruns
+
+    def relative(self, directory):
+        return os.path.relpath(directory, self.options['DIRECTORY'])
+
+    def read_checkpoint(self):
+        path = self.options['checkpoint']
+        if not path or not os.path.exists(path):
+            return set()
+        with open(path) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def open_checkpoint(self):
+        path = self.options['checkpoint'] or os.devnull
+        return open(path, 'a')
+
+    def record(self, checkpoint, directories, size):
+        """
+        Records a batch of test runs as imported, after it has been
+        committed, and reports progress.
+        """
+        for directory in directories:
+            self.log("Importing test run: %s" % directory)
+            checkpoint.write(self.relative(directory) + '\n')
+        if self.options['checkpoint']:
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+        self.imported += len(directories)
+        self.size += size
+        elapsed = max(time.time() - self.start, 1e-6)
+        self.log('Imported %d/%d test runs (%.1f runs/s, %.2f MB/s)' % (
+            self.imported,
+            self.total,
+            self.imported / elapsed,
+            self.size / elapsed / 2 ** 20,
+        ))
+
+    def log(self, msg):
+        if not self.options['silent']:
+            print(msg)
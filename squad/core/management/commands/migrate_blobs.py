@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+
+from squad.core.models import TestRun, Attachment, Blob
+
+
+class Command(BaseCommand):
+
+    help = """Move test run data files, logs and attachments that are still
+    stored in the database into the blob store"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', '-b',
+            type=int,
+            default=100,
+            dest='batch_size',
+            help='number of objects to move in each transaction (default: 100)',
+        )
+
+        parser.add_argument(
+            '--silent', '-s',
+            action='store_true',
+            dest='silent',
+            help='operate silently (i.e. don\'t output anything)',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        for model in (TestRun, Attachment):
+            self.migrate(model)
+
+    def migrate(self, model):
+        inline_fields = [name + '_inline' for name in model.PAYLOADS]
+        pending = Q()
+        for field in inline_fields:
+            pending |= Q(**{field + '__isnull': False})
+        queryset = model.objects.filter(pending).order_by('id').only('id', *inline_fields)
+
+        count = 0
+        size = 0
+        while True:
+            with transaction.atomic():
+                batch = list(queryset[:self.options['batch_size']])
+                if not batch:
+                    break
+                for obj in batch:
+                    fields = {}
+                    for name in model.PAYLOADS:
+                        data = getattr(obj, name + '_inline')
+                        if data is not None:
+                            blob = Blob.objects.store(bytes(data) if isinstance(data, memoryview) else data)
+                            fields[name + '_blob'] = blob
+                            fields[name + '_inline'] = None
+                            size += blob.size
+                    model.objects.filter(id=obj.id).update(**fields)
+            count += len(batch)
+            self.log('%s: %d moved (%d bytes)' % (model._meta.verbose_name_plural, count, size))
+
+    def log(self, msg):
+        if not self.options['silent']:
+            self.stdout.write(msg)
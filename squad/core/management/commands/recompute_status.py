@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+from squad.core.models import Project, TestRun
+from squad.core.tasks import RecomputeTestRunStatus
+
+
+class Command(BaseCommand):
+
+    help = """Recompute the status (test counts and metrics summaries) of all
+    test runs in PROJECT, or in all projects"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', '-b',
+            type=int,
+            default=100,
+            dest='batch_size',
+            help='number of test runs recomputed in each transaction (default: 100)',
+        )
+
+        parser.add_argument(
+            '--silent', '-s',
+            action='store_true',
+            dest='silent',
+            help='operate silently (i.e. don\'t output anything)',
+        )
+
+        parser.add_argument(
+            'PROJECT',
+            nargs='?',
+            help='Project, on the form $group/$project (default: all projects)',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+
+        testruns = TestRun.objects.order_by('id').only('id')
+        if options['PROJECT']:
+            try:
+                group_slug, project_slug = options['PROJECT'].split('/')
+                project = Project.objects.get(group__slug=group_slug, slug=project_slug)
+            except (ValueError, Project.DoesNotExist):
+                raise CommandError('No such project: %s' % options['PROJECT'])
+            testruns = testruns.filter(build__project=project)
+
+        total = testruns.count()
+        count = 0
+        last_id = 0
+        recompute = RecomputeTestRunStatus()
+        while True:
+            batch = list(testruns.filter(id__gt=last_id)[:self.options['batch_size']])
+            if not batch:
+                break
+            recompute(batch)
+            count += len(batch)
+            last_id = batch[-1].id
+            self.log('%d/%d test runs recomputed' % (count, total))
+
+    def log(self, msg):
+        if not self.options['silent']:
+            self.stdout.write(msg)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rename_to_inline(model_name, field_name, field):
+    """
+    Renames `field_name` to `<field_name>_inline`, keeping the same database
+    column, so no data needs to be touched.
+    """
+    field.db_column = field_name
+    return migrations.SeparateDatabaseAndState(
+        state_operations=[
+            migrations.RemoveField(model_name=model_name, name=field_name),
+            migrations.AddField(model_name=model_name, name=field_name + '_inline', field=field),
+        ],
+    )
+
+
+def blob_reference():
+    return models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='core.Blob')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_receipt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.BigIntegerField()),
+            ],
+        ),
+        rename_to_inline('testrun', 'tests_file', models.TextField(null=True)),
+        rename_to_inline('testrun', 'metrics_file', models.TextField(null=True)),
+        rename_to_inline('testrun', 'log_file', models.TextField(null=True)),
+        rename_to_inline('testrun', 'metadata_file', models.TextField(null=True)),
+        rename_to_inline('attachment', 'data', models.BinaryField(default=None)),
+        migrations.AlterField(
+            model_name='attachment',
+            name='data_inline',
+            field=models.BinaryField(db_column='data', null=True),
+        ),
+        migrations.AddField(model_name='testrun', name='tests_file_blob', field=blob_reference()),
+        migrations.AddField(model_name='testrun', name='metrics_file_blob', field=blob_reference()),
+        migrations.AddField(model_name='testrun', name='log_file_blob', field=blob_reference()),
+        migrations.AddField(model_name='testrun', name='metadata_file_blob', field=blob_reference()),
+        migrations.AddField(model_name='attachment', name='data_blob', field=blob_reference()),
+    ]
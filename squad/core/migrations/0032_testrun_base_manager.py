@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 20:48
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_blob_compression'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='testrun',
+            options={'base_manager_name': 'objects'},
+        ),
+    ]
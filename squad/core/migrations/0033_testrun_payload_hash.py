@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 20:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_testrun_base_manager'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicateSubmission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.BigIntegerField(default=0)),
+                ('rows', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='testrun',
+            name='payload_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='testrun',
+            unique_together=set([('build', 'job_id'), ('build', 'environment', 'payload_hash')]),
+        ),
+        migrations.AddField(
+            model_name='duplicatesubmission',
+            name='test_run',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duplicates', to='core.TestRun'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import Case, Value, When
+import squad.core.fields
+
+
+BATCH_SIZE = 1000
+
+
+def convert(Metric, source, target, field, convert_value):
+    """
+    Copies the measurements of all metrics from the `source` column to the
+    `target` one, converted with `convert_value`, BATCH_SIZE metrics at a
+    time. Each batch is updated with a single UPDATE statement, and
+    committed separately, so this does not hold locks on the whole metric
+    table.
+    """
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(Metric.objects.filter(id__gt=last_id).order_by('id').values_list('id', source)[:BATCH_SIZE])
+            if not batch:
+                break
+            values = Case(
+                *[When(id=metric_id, then=Value(convert_value(value), output_field=field)) for metric_id, value in batch],
+                output_field=field
+            )
+            Metric.objects.filter(id__in=[metric_id for metric_id, _ in batch]).update(**{target: values})
+            last_id = batch[-1][0]
+
+
+def pack_measurements(apps, schema_editor):
+    Metric = apps.get_model('core', 'Metric')
+    field = squad.core.fields.FloatArrayField()
+    convert(Metric, 'measurements', 'measurements_packed', field, squad.core.fields.float_array)
+
+
+def unpack_measurements(apps, schema_editor):
+    Metric = apps.get_model('core', 'Metric')
+    field = models.TextField()
+    convert(Metric, 'measurements_packed', 'measurements', field, lambda value: ','.join(str(m) for m in squad.core.fields.float_array(value)))
+
+
+class Migration(migrations.Migration):
+
+    # see convert
+    atomic = False
+
+    dependencies = [
+        ('core', '0033_testrun_payload_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metric',
+            name='measurements_packed',
+            field=squad.core.fields.FloatArrayField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='metric',
+            name='measurements',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(pack_measurements, reverse_code=unpack_measurements),
+        migrations.RemoveField(
+            model_name='metric',
+            name='measurements',
+        ),
+        migrations.RenameField(
+            model_name='metric',
+            old_name='measurements_packed',
+            new_name='measurements',
+        ),
+        migrations.AlterField(
+            model_name='metric',
+            name='measurements',
+            field=squad.core.fields.FloatArrayField(default=b''),
+        ),
+    ]
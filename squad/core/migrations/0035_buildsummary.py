@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_metric_packed_measurements'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('test_runs_total', models.IntegerField(default=0)),
+                ('tests_total', models.IntegerField(default=0)),
+                ('tests_pass', models.IntegerField(default=0)),
+                ('tests_fail', models.IntegerField(default=0)),
+                ('tests_missing', models.IntegerField(default=0)),
+                ('metrics_log_sum', models.FloatField(default=0.0)),
+                ('metrics_count', models.IntegerField(default=0)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='core.Build')),
+                ('environment', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Environment')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='buildsummary',
+            unique_together=set([('build', 'environment')]),
+        ),
+    ]
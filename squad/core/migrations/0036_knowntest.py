@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 21:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_buildsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KnownTest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=256)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='known_tests', to='core.Project')),
+                ('suite', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='known_tests', to='core.Suite')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='known_test',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tests', to='core.KnownTest'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='knowntest',
+            unique_together=set([('project', 'suite', 'name')]),
+        ),
+    ]
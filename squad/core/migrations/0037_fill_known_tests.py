@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction, IntegrityError
+
+
+BATCH_SIZE = 10000
+
+
+UPDATE_SQL = """
+UPDATE {test} SET known_test_id = (
+    SELECT k.id FROM {knowntest} k, {suite} s
+    WHERE s.id = {test}.suite_id
+      AND k.project_id = s.project_id
+      AND k.suite_id = {test}.suite_id
+      AND k.name = {test}.name
+)
+WHERE id BETWEEN %s AND %s AND known_test_id IS NULL
+"""
+
+
+def fill_known_tests(apps, schema_editor):
+    """
+    Creates the KnownTest objects for the existing tests, and points the
+    tests to them, BATCH_SIZE tests at a time. Each batch is committed
+    separately, so this does not hold locks on the whole test table, and if
+    interrupted, running the migration again continues from where it
+    stopped.
+
+    The missing KnownTest objects of each batch are created in bulk, and the
+    tests are then updated with a single UPDATE statement, written in SQL
+    since subqueries in updates are only available from Django 1.11 on.
+    """
+    Test = apps.get_model('core', 'Test')
+    KnownTest = apps.get_model('core', 'KnownTest')
+    Suite = apps.get_model('core', 'Suite')
+    update = UPDATE_SQL.format(
+        test=schema_editor.quote_name(Test._meta.db_table),
+        knowntest=schema_editor.quote_name(KnownTest._meta.db_table),
+        suite=schema_editor.quote_name(Suite._meta.db_table),
+    )
+
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            ids = list(Test.objects.filter(id__gt=last_id, known_test__isnull=True).order_by('id').values_list('id', flat=True)[:BATCH_SIZE])
+            if not ids:
+                break
+            tests = Test.objects.filter(id__gte=ids[0], id__lte=ids[-1], known_test__isnull=True)
+            keys = set(tests.values_list('suite__project_id', 'suite_id', 'name').distinct())
+
+            known = KnownTest.objects.filter(
+                suite_id__in=set(suite_id for _, suite_id, _ in keys),
+                name__in=set(name for _, _, name in keys),
+            ).values_list('project_id', 'suite_id', 'name')
+            missing = keys.difference(known)
+            try:
+                with transaction.atomic():
+                    KnownTest.objects.bulk_create([
+                        KnownTest(project_id=project_id, suite_id=suite_id, name=name)
+                        for project_id, suite_id, name in missing
+                    ])
+            except IntegrityError:
+                # tests received in the meantime created some of them
+                for project_id, suite_id, name in missing:
+                    KnownTest.objects.get_or_create(project_id=project_id, suite_id=suite_id, name=name)
+
+            schema_editor.execute(update, (ids[0], ids[-1]))
+            last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    # see fill_known_tests
+    atomic = False
+
+    dependencies = [
+        ('core', '0036_knowntest'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_known_tests, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 21:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_index(name, table, columns):
+    return migrations.RunSQL(
+        'CREATE INDEX %s ON %s (%s)' % (name, table, ', '.join(columns)),
+        reverse_sql='DROP INDEX %s' % name,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_fill_known_tests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metric',
+            name='build',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.Build'),
+        ),
+        migrations.AddField(
+            model_name='metric',
+            name='build_datetime',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='metric',
+            name='environment',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.Environment'),
+        ),
+        migrations.AddField(
+            model_name='metric',
+            name='project',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.Project'),
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='build',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.Build'),
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='build_datetime',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='environment',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.Environment'),
+        ),
+        migrations.AddField(
+            model_name='test',
+            name='project',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='core.Project'),
+        ),
+        # composite indexes are created with plain SQL, because
+        # models.Index is only available from Django 1.11 on
+        create_index('core_metric_project_a2f897_idx', 'core_metric', ['project_id', 'environment_id', 'suite_id', 'name']),
+        create_index('core_test_known_t_902eb3_idx', 'core_test', ['known_test_id', 'environment_id', 'build_datetime']),
+        create_index('core_test_build_i_0be154_idx', 'core_test', ['build_id', 'result']),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 21:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_test_metric_denormalized_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestTransition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('regression', 'Regression'), ('fix', 'Fix')], max_length=16)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transitions', to='core.Build')),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Environment')),
+                ('known_test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.KnownTest')),
+                ('previous_build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Build')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='testtransition',
+            unique_together=set([('build', 'environment', 'known_test')]),
+        ),
+    ]
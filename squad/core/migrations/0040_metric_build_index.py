@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_testtransition'),
+    ]
+
+    operations = [
+        # used when moving a build back in time updates the build datetime
+        # of its metrics (see ReceiveTestRun)
+        migrations.RunSQL(
+            'CREATE INDEX core_metric_build_id_idx ON core_metric (build_id)',
+            reverse_sql='DROP INDEX core_metric_build_id_idx',
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# tests received by older versions while 0037 was running, if any
+fill_known_tests = import_module('squad.core.migrations.0037_fill_known_tests').fill_known_tests
+
+
+def create_index(name, table, columns):
+    # SQLite removes columns by copying the table, which drops the indexes
+    # that 0038 created with plain SQL; they are kept on PostgreSQL
+    return migrations.RunSQL(
+        'CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table, ', '.join(columns)),
+        reverse_sql=migrations.RunSQL.noop,
+    )
+
+
+class Migration(migrations.Migration):
+
+    # see fill_known_tests; it also avoids updating tests and then altering
+    # their table in the same transaction, which PostgreSQL does not allow
+    atomic = False
+
+    dependencies = [
+        ('core', '0040_metric_build_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_known_tests, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='test',
+            name='known_test',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tests', to='core.KnownTest'),
+        ),
+        migrations.RemoveField(
+            model_name='test',
+            name='name',
+        ),
+        migrations.RemoveField(
+            model_name='test',
+            name='suite',
+        ),
+        create_index('core_test_known_t_902eb3_idx', 'core_test', ['known_test_id', 'environment_id', 'build_datetime']),
+        create_index('core_test_build_i_0be154_idx', 'core_test', ['build_id', 'result']),
+    ]
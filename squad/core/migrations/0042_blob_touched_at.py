@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 23:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0041_test_remove_suite_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='touched_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 00:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0042_blob_touched_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='block_offsets',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='block_size',
+            field=models.IntegerField(null=True),
+        ),
+    ]
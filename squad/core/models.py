@@ -1,11 +1,16 @@
+import hashlib
+import io
 import re
 import json
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from math import exp, log
+from tempfile import SpooledTemporaryFile
 
 
 from dateutil.relativedelta import relativedelta
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, F, Count, Case, When, Func
+from django.db.models.functions import Coalesce
 from django.db.models.query import prefetch_related_objects
 from django.contrib.auth.models import Group as UserGroup
 from django.core.validators import EmailValidator
@@ -13,8 +18,11 @@ from django.core.validators import RegexValidator
 from django.utils import timezone
 
 
-from squad.core.fields import VersionField
-from squad.core.utils import random_token, parse_name, join_name
+from squad.core.cache import IDCache, TokenCache
+from squad.core.fields import VersionField, FloatArrayField, float_array
+from squad.core.storage import get_blob_store, get_codec, get_compression
+from squad.core.storage import BlockReader, pack_offsets, unpack_offsets
+from squad.core.utils import random_token, parse_name, join_name, read_file, read_chunks
 
 
 slug_pattern = '[a-zA-Z0-9][a-zA-Z0-9_.-]*'
@@ -93,6 +101,10 @@ class Token(models.Model):
         return self.description
 
 
+# process-local cache of the projects each token gives access to
+token_acl = TokenCache(Token)
+
+
 class Build(models.Model):
     project = models.ForeignKey(Project, related_name='builds')
     name = models.CharField(max_length=100)
@@ -111,44 +123,68 @@ class Build(models.Model):
             self.name = self.version
             self.version = None
         if self.name and not self.version:
-            # -rc must be replaced with ~rc because 1.0-rc1 higher than 1.0,
-            # and we don't want that. 1.0~rc1 will sort lower than 1.0.
-            self.version = re.sub('-rc', '~rc', self.name)
+            self.version = Build.version_of(self.name)
         super(Build, self).save(*args, **kwargs)
 
+    @staticmethod
+    def version_of(name):
+        """
+        Returns the version of a build with the given name.
+        """
+        # -rc must be replaced with ~rc because 1.0-rc1 higher than 1.0,
+        # and we don't want that. 1.0~rc1 will sort lower than 1.0.
+        return re.sub('-rc', '~rc', name)
+
     def __str__(self):
         return '%s (%s)' % (self.version, self.datetime)
 
     @staticmethod
     def prefetch_related(builds):
+        # Django 1.10 cannot prefetch through relations that were already
+        # prefetched, e.g. when comparing the same builds again
+        builds = [b for b in builds if 'test_runs' not in getattr(b, '_prefetched_objects_cache', {})]
         prefetch_related_objects(
             builds,
             'project',
             'project__group',
             'test_runs',
             'test_runs__environment',
-            'test_runs__tests',
-            'test_runs__tests__suite',
         )
 
+    __summary__ = None
+
+    @property
+    def summary(self):
+        """
+        The overall BuildSummary of this build. Uses the prefetched
+        summaries, if any (i.e. `prefetch_related('summaries')`), and computes
+        them if they do not exist yet.
+        """
+        if self.__summary__ is None:
+            for summary in self.summaries.all():
+                if summary.environment_id is None:
+                    self.__summary__ = summary
+                    break
+            else:
+                self.__summary__ = BuildSummary.overall(self)
+        return self.__summary__
+
     @property
     def test_summary(self):
         summary = OrderedDict()
-        summary['total'] = 0
-        summary['pass'] = 0
-        summary['fail'] = 0
-        summary['missing'] = 0
+        summary['total'] = self.summary.tests_total
+        summary['pass'] = self.summary.tests_pass
+        summary['fail'] = self.summary.tests_fail
+        summary['missing'] = self.summary.tests_missing
         summary['failures'] = OrderedDict()
-        mapping = {True: 'pass', False: 'fail', None: 'missing'}
-        for run in self.test_runs.all():
-            for test in run.tests.all():
-                summary[mapping[test.result]] += 1
-                summary['total'] += 1
-                if not test.result and test.result is not None:
-                    env = test.test_run.environment.slug
-                    if env not in summary['failures']:
-                        summary['failures'][env] = []
-                    summary['failures'][env].append(test)
+        failures = Test.objects.filter(build=self, result=False).select_related('known_test__suite').prefetch_related(
+            'test_run__environment',
+        ).order_by('test_run_id', 'id')
+        for test in failures:
+            env = test.test_run.environment.slug
+            if env not in summary['failures']:
+                summary['failures'][env] = []
+            summary['failures'][env].append(test)
         return summary
 
     @property
@@ -182,14 +218,378 @@ class Environment(models.Model):
         return self.name or self.slug
 
 
+class BlobContents(object):
+    """
+    Contents read for storing as a Blob (see BlobManager.read), along with
+    their key and size. The contents are only kept in memory up to
+    `spool_size` bytes, and spooled to a temporary file otherwise.
+    """
+
+    def __init__(self, data, spool_size):
+        h = hashlib.sha256()
+        self.size = 0
+        self.file = SpooledTemporaryFile(spool_size)
+        for chunk in read_chunks(data):
+            h.update(chunk)
+            self.size += len(chunk)
+            self.file.write(chunk)
+        self.key = h.hexdigest()
+
+    def chunks(self):
+        self.file.seek(0)
+        return read_chunks(self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlobManager(models.Manager):
+
+    # contents up to this size are kept in memory while being stored
+    SPOOL_SIZE = 1024 * 1024
+
+    # contents are compressed in independent blocks of this size, so that
+    # they can be read from any position (see Blob.open)
+    BLOCK_SIZE = 1024 * 1024
+
+    def read(self, data):
+        """
+        Reads `data` (bytes, string, or file-like object) and returns the
+        corresponding BlobContents, without storing them. This way the key of
+        the contents is known before deciding whether to store them at all.
+        The caller must close the returned object.
+        """
+        return BlobContents(data, self.SPOOL_SIZE)
+
+    def store(self, data):
+        """
+        Stores `data` (bytes, string, file-like object, or BlobContents) in
+        the blob store, and returns the corresponding Blob. Contents that are
+        already stored are not stored again, nor compressed.
+
+        File-like objects are streamed into the blob store: they are hashed
+        as they are read, and then compressed, and only spooled to temporary
+        files if large, so that they never need to be in memory as a whole.
+        Each BLOCK_SIZE bytes are compressed independently, and the offsets
+        of the compressed blocks are kept in the Blob.
+
+        Note that the contents are written to the blob store right away, even
+        if the current transaction is later rolled back. Those are never
+        reached through the database, and are eventually removed by the
+        gc_blobs command.
+        """
+        if not isinstance(data, BlobContents):
+            with self.read(data) as contents:
+                return self.store(contents)
+
+        blob = self.__touch__(data.key)
+        if blob:
+            return blob
+
+        codec = get_compression()
+        blob = Blob(key=data.key, size=data.size, stored_size=data.size)
+        with SpooledTemporaryFile(self.SPOOL_SIZE) as compressed:
+            stored = data.file
+            if codec:
+                offsets = self.__compress__(codec, data.chunks(), compressed)
+                # already compressed data (e.g. images) is stored as is
+                if compressed.tell() < data.size:
+                    blob.compression = codec.name
+                    blob.stored_size = compressed.tell()
+                    blob.block_size = self.BLOCK_SIZE
+                    blob.block_offsets = pack_offsets(offsets)
+                    stored = compressed
+            stored.seek(0)
+            get_blob_store().put_file(blob.storage_key, stored)
+
+        blob, created = self.get_or_create(key=data.key, defaults={
+            'size': blob.size,
+            'stored_size': blob.stored_size,
+            'compression': blob.compression,
+            'block_size': blob.block_size,
+            'block_offsets': blob.block_offsets,
+        })
+        if not created:
+            self.filter(key=data.key).update(touched_at=timezone.now())
+        return blob
+
+    def __compress__(self, codec, chunks, output):
+        """
+        Writes `chunks` to `output`, compressed with `codec` in independent
+        blocks of BLOCK_SIZE bytes, and returns the offsets of the blocks in
+        `output`.
+        """
+        offsets = []
+        compressor = None
+        position = 0
+        for chunk in chunks:
+            while chunk:
+                if position % self.BLOCK_SIZE == 0:
+                    if compressor:
+                        output.write(compressor.flush())
+                    offsets.append(output.tell())
+                    compressor = codec.compressor()
+                n = self.BLOCK_SIZE - position % self.BLOCK_SIZE
+                output.write(compressor.compress(chunk[:n]))
+                position += len(chunk[:n])
+                chunk = chunk[n:]
+        if not compressor:
+            offsets.append(output.tell())
+            compressor = codec.compressor()
+        output.write(compressor.flush())
+        return offsets
+
+    def __touch__(self, key):
+        """
+        Returns the Blob with the given key, if any, marking it as just
+        stored, so that gc_blobs does not delete it before the test run or
+        attachment that is about to refer to it is created. Returns None if
+        the blob was deleted in the meantime.
+        """
+        blob = self.filter(key=key).first()
+        if blob and self.filter(key=key).update(touched_at=timezone.now()):
+            return blob
+        return None
+
+    def unreferenced(self):
+        """
+        Returns the blobs that no test run or attachment refers to.
+        """
+        blobs = self.all()
+        for model in (TestRun, Attachment):
+            for name in model.PAYLOADS:
+                referenced = model.objects.filter(**{name + '_blob__isnull': False}).values(name + '_blob')
+                blobs = blobs.exclude(key__in=referenced)
+        return blobs
+
+
+class Blob(models.Model):
+    """
+    Reference to contents kept in the blob store (see squad.core.storage),
+    by the SHA-256 hash of the (uncompressed) contents. `size` is the size of
+    the contents, and `stored_size` is the size actually used in the blob
+    store, after compression with the `compression` codec, if any.
+    `touched_at` is the last time the contents were stored.
+
+    Compressed contents are stored as independently compressed blocks of
+    `block_size` bytes, which start at `block_offsets` (packed with
+    squad.core.storage.pack_offsets) in the stored data. Contents compressed
+    before blocks were introduced have neither.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    stored_size = models.BigIntegerField()
+    compression = models.CharField(max_length=16, null=True)
+    touched_at = models.DateTimeField(default=timezone.now)
+    block_size = models.IntegerField(null=True)
+    block_offsets = models.BinaryField(null=True)
+
+    objects = BlobManager()
+
+    @property
+    def codec(self):
+        return get_codec(self.compression)
+
+    @property
+    def storage_key(self):
+        """
+        Key of the stored data in the blob store. Each codec, and each block
+        size, uses a different one, so that the same contents compressed
+        differently never clash.
+        """
+        codec = self.codec
+        if not codec:
+            return self.key
+        if self.block_size:
+            return '%s.%d%s' % (self.key, self.block_size, codec.suffix)
+        return self.key + codec.suffix
+
+    def open(self):
+        """
+        Returns a binary file object for reading the contents, decompressing
+        them on the fly if needed. Compressed contents stored in blocks can
+        be read from any position, after seeking to it, by decompressing
+        only the block that contains it.
+        """
+        codec = self.codec
+        if codec and self.block_offsets is not None:
+            offsets = unpack_offsets(self.block_offsets)
+            return BlockReader(self.open_stored, codec, self.size, self.block_size, offsets)
+        f = self.open_stored()
+        return codec and codec.decompressing_reader(f) or f
+
+    def open_stored(self):
+        """
+        Returns a binary file object for reading the data as stored, i.e.
+        compressed with the `compression` codec.
+        """
+        return get_blob_store().open(self.storage_key)
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+
+def blob_payload(name, binary=False):
+    """
+    Returns a property for a payload kept in the blob store, backed by two
+    model fields: `<name>_blob`, a reference to the Blob, and
+    `<name>_inline`, the legacy in-database storage, used for rows that have
+    not been moved to the blob store yet (see the migrate_blobs command).
+
+    Reading the property returns the contents, as a string or as bytes if
+    `binary` is True. Assigning to it only records the new contents, which
+    are written to the blob store when the object is saved.
+    """
+    def getter(self):
+        payloads = self.__dict__.setdefault('__payloads__', {})
+        if name not in payloads:
+            blob = getattr(self, name + '_blob')
+            if blob:
+                data = blob.read()
+                if not binary:
+                    data = data.decode('utf-8')
+            else:
+                data = getattr(self, name + '_inline')
+                if binary and data is not None:
+                    data = bytes(data)
+            payloads[name] = data
+        return payloads[name]
+
+    def setter(self, value):
+        self.__dict__.setdefault('__payloads__', {})[name] = value
+        self.__dict__.setdefault('__changed_payloads__', set()).add(name)
+
+    return property(getter, setter)
+
+
+def save_payloads(obj):
+    """
+    Writes the payloads assigned to `obj` since it was last saved to the
+    blob store. Must be called by the `save` method of models that use
+    `blob_payload`.
+    """
+    for name in obj.__dict__.pop('__changed_payloads__', ()):
+        data = obj.__dict__['__payloads__'][name]
+        if data is not None:
+            setattr(obj, name + '_blob', Blob.objects.store(data))
+            if hasattr(data, 'read'):
+                # streamed into the blob store; read back from there if needed
+                del obj.__dict__['__payloads__'][name]
+        else:
+            setattr(obj, name + '_blob', None)
+        setattr(obj, name + '_inline', None)
+
+
+def open_payload(obj, name):
+    """
+    Returns a binary file object for reading the given payload of `obj`,
+    streaming it from the blob store when possible, or None if `obj` has no
+    such payload.
+    """
+    blob = getattr(obj, name + '_blob')
+    if blob and name not in obj.__dict__.get('__payloads__', {}):
+        return blob.open()
+    data = getattr(obj, name)
+    if data is None:
+        return None
+    return io.BytesIO(read_file(data))
+
+
+def payload_size(obj, name):
+    """
+    Returns the size in bytes of the given payload of `obj`, without reading
+    it, or None if `obj` has no such payload.
+    """
+    if name not in obj.__dict__.get('__payloads__', {}):
+        blob = getattr(obj, name + '_blob')
+        if blob:
+            return blob.size
+    data = getattr(obj, name)
+    if data is None:
+        return None
+    return len(read_file(data))
+
+
+class OctetLength(Func):
+    """
+    The length of a text expression in bytes, as stored by the database
+    (i.e. UTF-8 encoded), instead of in characters like Length.
+    """
+    function = 'OCTET_LENGTH'
+
+    def __init__(self, expression, **extra):
+        super(OctetLength, self).__init__(expression, output_field=models.BigIntegerField(), **extra)
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='LENGTH(CAST(%(expressions)s AS BLOB))')
+
+
+class TestRunQuerySet(models.QuerySet):
+
+    def with_payloads(self):
+        """
+        Also loads the in-database payload columns, which are deferred by
+        default. Only worth it where the payloads are actually read.
+        """
+        return self.defer(None)
+
+    def only(self, *fields):
+        # only() on top of the default deferred columns would load all
+        # columns instead (this is also what loading a single deferred field
+        # does)
+        return super(TestRunQuerySet, self.defer(None)).only(*fields)
+
+    def payload_sizes(self):
+        """
+        Returns a dictionary mapping the ID of each test run to the sizes of
+        its payloads in bytes (see TestRun.payload_sizes), in a single query.
+        """
+        sizes = self.annotate(**{
+            p + '_size': Coalesce(p + '_blob__size', OctetLength(p + '_inline'), output_field=models.BigIntegerField())
+            for p in TestRun.PAYLOADS
+        }).values_list('id', *(p + '_size' for p in TestRun.PAYLOADS))
+        return {row[0]: dict(zip(TestRun.PAYLOADS, row[1:])) for row in sizes}
+
+
+class TestRunManager(models.Manager.from_queryset(TestRunQuerySet)):
+    """
+    Defers the legacy in-database payload columns (see `blob_payload`) by
+    default. For test runs that were not moved to the blob store yet, they
+    can be several MB each, and most queries never look at them.
+    """
+
+    def get_queryset(self):
+        return super(TestRunManager, self).get_queryset().defer(*TestRun.PAYLOAD_COLUMNS)
+
+
 class TestRun(models.Model):
     build = models.ForeignKey(Build, related_name='test_runs')
     environment = models.ForeignKey(Environment, related_name='test_runs')
     created_at = models.DateTimeField(auto_now_add=True)
-    tests_file = models.TextField(null=True)
-    metrics_file = models.TextField(null=True)
-    log_file = models.TextField(null=True)
-    metadata_file = models.TextField(null=True)
+
+    tests_file_inline = models.TextField(null=True, db_column='tests_file')
+    metrics_file_inline = models.TextField(null=True, db_column='metrics_file')
+    log_file_inline = models.TextField(null=True, db_column='log_file')
+    metadata_file_inline = models.TextField(null=True, db_column='metadata_file')
+    tests_file_blob = models.ForeignKey(Blob, null=True, related_name='+', on_delete=models.PROTECT)
+    metrics_file_blob = models.ForeignKey(Blob, null=True, related_name='+', on_delete=models.PROTECT)
+    log_file_blob = models.ForeignKey(Blob, null=True, related_name='+', on_delete=models.PROTECT)
+    metadata_file_blob = models.ForeignKey(Blob, null=True, related_name='+', on_delete=models.PROTECT)
+
+    tests_file = blob_payload('tests_file')
+    metrics_file = blob_payload('metrics_file')
+    log_file = blob_payload('log_file')
+    metadata_file = blob_payload('metadata_file')
+
+    PAYLOADS = ('tests_file', 'metrics_file', 'log_file', 'metadata_file')
+    PAYLOAD_COLUMNS = tuple(p + '_inline' for p in PAYLOADS)
 
     # fields that should be provided in a submitted metadata JSON
     datetime = models.DateTimeField(null=False)
@@ -202,35 +602,160 @@ class TestRun(models.Model):
     data_processed = models.BooleanField(default=False)
     status_recorded = models.BooleanField(default=False)
 
+    # hash of the submitted data files and attachments; see
+    # ReceiveTestRun.payload_hash
+    payload_hash = models.CharField(null=True, max_length=64)
+
+    objects = TestRunManager()
+
     class Meta:
-        unique_together = ('build', 'job_id')
+        unique_together = (
+            ('build', 'job_id'),
+            ('build', 'environment', 'payload_hash'),
+        )
+        # also used for related objects, e.g. `test.test_run`
+        base_manager_name = 'objects'
 
     def save(self, *args, **kwargs):
         if not self.datetime:
             self.datetime = timezone.now()
+        save_payloads(self)
         super(TestRun, self).save(*args, **kwargs)
 
     @property
     def project(self):
         return self.build.project
 
+    def denormalized_fields(self):
+        """
+        Returns the values of the fields that tests and metrics copy from
+        their test run, so that they can be filtered without joining with
+        the test run, build and environment tables.
+        """
+        return {
+            'project_id': self.build.project_id,
+            'environment_id': self.environment_id,
+            'build_id': self.build_id,
+            'build_datetime': self.build.datetime,
+        }
+
+    # set by ReceiveTestRun when an existing test run is returned for a
+    # duplicate submission
+    duplicate = False
+
+    __payload_sizes__ = None
+
+    @property
+    def payload_sizes(self):
+        """
+        Size of each of the payloads (None for missing ones), obtained
+        without loading the payloads themselves.
+        """
+        if self.__payload_sizes__ is None:
+            TestRun.prefetch_payload_sizes([self])
+        return self.__payload_sizes__
+
+    @staticmethod
+    def prefetch_payload_sizes(test_runs):
+        """
+        Loads the `payload_sizes` of all of `test_runs` in a single query.
+        """
+        test_runs = [t for t in test_runs if t.__payload_sizes__ is None]
+        if not test_runs:
+            return
+        sizes = TestRun.objects.filter(id__in=[t.id for t in test_runs]).payload_sizes()
+        for test_run in test_runs:
+            test_run.__payload_sizes__ = sizes[test_run.id]
+
+    __metadata__ = None
+
     @property
     def metadata(self):
-        if self.metadata_file:
-            return json.loads(self.metadata_file)
-        else:
-            return {}
+        if self.__metadata__ is None:
+            if self.metadata_file:
+                self.__metadata__ = json.loads(self.metadata_file)
+            else:
+                self.__metadata__ = {}
+        return self.__metadata__
+
+    @metadata.setter
+    def metadata(self, value):
+        self.__metadata__ = value
 
     def __str__(self):
         return self.job_id and ('#%s' % self.job_id) or ('(%s)' % self.id)
 
 
+class Receipt(models.Model):
+    """
+    Tracks a test run submitted for asynchronous processing. The key is
+    handed back to the client, which can use it to poll for the processing
+    status.
+
+    Receipts that are still queued after QUEUED_TIMEOUT are assumed to have
+    been lost (e.g. if the worker processing them died), and their test
+    runs are processed by ProcessAllTestRuns instead (see `queued`).
+    """
+    QUEUED = 'queued'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+
+    QUEUED_TIMEOUT = relativedelta(hours=1)
+
+    key = models.CharField(max_length=64, unique=True)
+    test_run = models.ForeignKey(TestRun, related_name='receipts', null=True, on_delete=models.SET_NULL)
+    status = models.CharField(
+        max_length=16,
+        choices=((QUEUED, 'Queued'), (PROCESSED, 'Processed'), (FAILED, 'Failed')),
+        default=QUEUED,
+    )
+    error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def save(self, **kwargs):
+        if not self.key:
+            self.key = random_token(64)
+        super(Receipt, self).save(**kwargs)
+
+    @classmethod
+    def queued(cls):
+        """
+        Returns the receipts that are queued, and not stale yet.
+        """
+        return cls.objects.filter(status=cls.QUEUED, created_at__gt=timezone.now() - cls.QUEUED_TIMEOUT)
+
+    def __str__(self):
+        return self.key
+
+
+class DuplicateSubmission(models.Model):
+    """
+    Records a submission that was identical to an existing test run, and
+    therefore was not stored or processed again. `size` is the number of
+    bytes submitted, and `rows` the number of tests and metrics that would
+    have been stored again.
+    """
+    test_run = models.ForeignKey(TestRun, related_name='duplicates')
+    size = models.BigIntegerField(default=0)
+    rows = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class Attachment(models.Model):
     test_run = models.ForeignKey(TestRun, related_name='attachments')
     filename = models.CharField(null=False, max_length=1024)
-    data = models.BinaryField(default=None)
+    data_inline = models.BinaryField(null=True, db_column='data')
+    data_blob = models.ForeignKey(Blob, null=True, related_name='+', on_delete=models.PROTECT)
     length = models.IntegerField(default=None)
 
+    data = blob_payload('data', binary=True)
+
+    PAYLOADS = ('data',)
+
+    def save(self, *args, **kwargs):
+        save_payloads(self)
+        super(Attachment, self).save(*args, **kwargs)
+
 
 class Suite(models.Model):
     project = models.ForeignKey(Project, related_name='suites')
@@ -244,27 +769,100 @@ class Suite(models.Model):
         return self.name or self.slug
 
 
+# process-local caches of build, environment and suite IDs, used when
+# receiving test runs. Builds are cached by the name they were submitted
+# with, and looked up by the corresponding version.
+build_ids = IDCache(Build, 'name', lookup=lambda name: {'version': Build.version_of(name)})
+environment_ids = IDCache(Environment, 'slug')
+suite_ids = IDCache(Suite, 'slug')
+
+
+class KnownTest(models.Model):
+    """
+    A test that has been seen in a project, identified by its suite and
+    name. Tests refer to it by ID, so comparing and grouping results of the
+    same test across test runs is an integer equality instead of a string
+    one.
+    """
+    project = models.ForeignKey(Project, related_name='known_tests')
+    suite = models.ForeignKey(Suite, related_name='known_tests')
+    name = models.CharField(max_length=256)
+
+    class Meta:
+        unique_together = ('project', 'suite', 'name',)
+
+    def __str__(self):
+        return self.full_name
+
+    @property
+    def full_name(self):
+        return join_name(self.suite.slug, self.name)
+
+    @classmethod
+    def by_full_name(cls, project, full_name):
+        """
+        Returns the KnownTest with the given full name (i.e. "suite/test")
+        in `project`, or None if there is no such test.
+        """
+        suite, name = parse_name(full_name)
+        return cls.objects.filter(project=project, suite__slug=suite, name=name).first()
+
+
 class Test(models.Model):
+    """
+    The result of a test in a test run. The suite and name of the test are
+    in its KnownTest, which is shared by the results of the same test in
+    all test runs of the project.
+    """
     test_run = models.ForeignKey(TestRun, related_name='tests')
-    suite = models.ForeignKey(Suite)
-    name = models.CharField(max_length=256)
+    known_test = models.ForeignKey(KnownTest, related_name='tests')
     result = models.NullBooleanField()
 
+    # copies of the test run's (see TestRun.denormalized_fields); NULL for
+    # tests received before they existed, until `squad-admin
+    # fill_denormalized_fields` is run
+    project = models.ForeignKey(Project, null=True, related_name='+', on_delete=models.DO_NOTHING, db_index=False)
+    environment = models.ForeignKey(Environment, null=True, related_name='+', on_delete=models.DO_NOTHING, db_index=False)
+    build = models.ForeignKey(Build, null=True, related_name='+', on_delete=models.DO_NOTHING, db_index=False)
+    build_datetime = models.DateTimeField(null=True)
+
+    # there are also indexes on (known_test, environment, build_datetime) and
+    # (build, result), created by migrations 0038 and 0041 (Meta.indexes
+    # needs Django 1.11)
+
     def __str__(self):
         return "%s: %s" % (self.name, self.status)
 
+    def save(self, *args, **kwargs):
+        if self.build_id is None:
+            for field, value in self.test_run.denormalized_fields().items():
+                setattr(self, field, value)
+        super(Test, self).save(*args, **kwargs)
+
+    STATUSES = {True: 'pass', False: 'fail', None: 'skip/unknown'}
+
     @property
     def status(self):
-        return {True: 'pass', False: 'fail', None: 'skip/unknown'}[self.result]
+        return Test.STATUSES[self.result]
+
+    @property
+    def suite(self):
+        return self.known_test.suite
+
+    @property
+    def name(self):
+        return self.known_test.name
 
     @property
     def full_name(self):
-        return join_name(self.suite.slug, self.name)
+        return self.known_test.full_name
 
     @staticmethod
     def prefetch_related(tests):
         prefetch_related_objects(
             tests,
+            'known_test',
+            'known_test__suite',
             'test_run',
             'test_run__environment',
             'test_run__build',
@@ -283,13 +881,11 @@ class Test(models.Model):
         if self.__history__:
             return self.__history__
 
-        date = self.test_run.build.datetime
         previous_tests = Test.objects.filter(
-            suite=self.suite,
-            name=self.name,
-            test_run__build__datetime__lt=date,
-            test_run__environment=self.test_run.environment,
-        ).exclude(id=self.id).order_by("-test_run__build__datetime")
+            known_test_id=self.known_test_id,
+            environment_id=self.environment_id,
+            build_datetime__lt=self.build_datetime,
+        ).exclude(id=self.id).order_by("-build_datetime")
         since = None
         count = 0
         last_different = None
@@ -304,6 +900,56 @@ class Test(models.Model):
         return self.__history__
 
 
+class TestTransition(models.Model):
+    """
+    A change in the result of a test in `build` and `environment`, relative
+    to `previous_build`, the latest build before it with test runs in that
+    environment: a regression (pass → fail) or a fix (fail → pass).
+
+    Recorded incrementally as test runs are processed (see
+    squad.core.tasks.RecordTestTransitions), so that the regressions of a
+    build can be read without comparing it to the previous one. When a
+    build is received out of order, or moved back in time, the transitions
+    of the builds after it are recorded again.
+    """
+    REGRESSION = 'regression'
+    FIX = 'fix'
+
+    build = models.ForeignKey(Build, related_name='transitions')
+    environment = models.ForeignKey(Environment, related_name='+')
+    known_test = models.ForeignKey(KnownTest, related_name='+')
+    previous_build = models.ForeignKey(Build, related_name='+')
+    kind = models.CharField(
+        max_length=16,
+        choices=((REGRESSION, 'Regression'), (FIX, 'Fix')),
+    )
+
+    class Meta:
+        unique_together = ('build', 'environment', 'known_test',)
+
+    @classmethod
+    def by_environment(cls, build, kind, previous_build=None):
+        """
+        Returns an OrderedDict mapping the slug of each environment of
+        `build` with transitions of the given kind to the sorted list of
+        the full names of the tests. If `previous_build` is given, only the
+        transitions relative to it are included.
+        """
+        transitions = cls.objects.filter(build=build, kind=kind)
+        if previous_build is not None:
+            transitions = transitions.filter(previous_build=previous_build)
+        data = transitions.values_list('environment__slug', 'known_test__suite__slug', 'known_test__name')
+
+        result = OrderedDict()
+        for env, suite, name in sorted(data):
+            if env not in result:
+                result[env] = []
+            result[env].append(join_name(suite, name))
+        for tests in result.values():
+            tests.sort()
+        return result
+
+
 class MetricManager(models.Manager):
 
     def by_full_name(self, name):
@@ -316,16 +962,28 @@ class Metric(models.Model):
     suite = models.ForeignKey(Suite)
     name = models.CharField(max_length=100)
     result = models.FloatField()
-    measurements = models.TextField()  # comma-separated float numbers
+    measurements = FloatArrayField()
+
+    # see the corresponding fields in Test
+    project = models.ForeignKey(Project, null=True, related_name='+', on_delete=models.DO_NOTHING, db_index=False)
+    environment = models.ForeignKey(Environment, null=True, related_name='+', on_delete=models.DO_NOTHING, db_index=False)
+    build = models.ForeignKey(Build, null=True, related_name='+', on_delete=models.DO_NOTHING, db_index=False)
+    build_datetime = models.DateTimeField(null=True)
 
     objects = MetricManager()
 
+    # there are also indexes on (project, environment, suite, name) and
+    # (build), created by migrations 0038 and 0040; see Test
+
+    def save(self, *args, **kwargs):
+        if self.build_id is None:
+            for field, value in self.test_run.denormalized_fields().items():
+                setattr(self, field, value)
+        super(Metric, self).save(*args, **kwargs)
+
     @property
     def measurement_list(self):
-        if self.measurements:
-            return [float(n) for n in self.measurements.split(',')]
-        else:
-            return []
+        return float_array(self.measurements).tolist()
 
     @property
     def full_name(self):
@@ -378,7 +1036,7 @@ class Status(models.Model):
 
     @property
     def tests(self):
-        return self.test_run.tests.filter(suite=self.suite)
+        return self.test_run.tests.filter(known_test__suite=self.suite).select_related('known_test__suite')
 
     @property
     def metrics(self):
@@ -400,6 +1058,146 @@ class Status(models.Model):
         return '%s: %f, %d%% pass' % (name, self.metrics_summary, self.pass_percentage)
 
 
+class BuildSummary(models.Model):
+    """
+    Test totals and metrics summary of a build, both overall (with
+    `environment` set to None) and per environment. They are updated in the
+    same transaction in which each test run gets its status recorded, so
+    reading them never needs to go through the tests themselves. Test runs
+    that do not have their status recorded yet are not accounted for.
+
+    The metrics summary is the geometric mean of the metrics summaries of
+    the test runs; its sum of logarithms and count are stored, so that it
+    can be updated incrementally.
+    """
+    build = models.ForeignKey(Build, related_name='summaries')
+    environment = models.ForeignKey(Environment, null=True, related_name='+')
+
+    test_runs_total = models.IntegerField(default=0)
+    tests_total = models.IntegerField(default=0)
+    tests_pass = models.IntegerField(default=0)
+    tests_fail = models.IntegerField(default=0)
+    tests_missing = models.IntegerField(default=0)
+    metrics_log_sum = models.FloatField(default=0.0)
+    metrics_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('build', 'environment',)
+
+    @property
+    def metrics_summary(self):
+        if not self.metrics_count:
+            return 0
+        return exp(self.metrics_log_sum / self.metrics_count)
+
+    @classmethod
+    def add_test_run(cls, test_run, tests_pass, tests_fail, tests_missing, metrics_summary):
+        """
+        Adds the totals of a test run that just had its status recorded to
+        the summaries of its build. The build row is locked, so that
+        concurrent updates to the summaries of the same build are
+        serialized.
+        """
+        cls.__lock__(test_run.build_id)
+        build = test_run.build
+        if not cls.objects.filter(build=build).exists():
+            # also accounts for `test_run` itself
+            cls.__recompute__(build)
+            return
+
+        positive = metrics_summary > 0
+        for environment_id in (None, test_run.environment_id):
+            summary, _ = cls.objects.get_or_create(build=build, environment_id=environment_id)
+            cls.objects.filter(id=summary.id).update(
+                test_runs_total=F('test_runs_total') + 1,
+                tests_total=F('tests_total') + tests_pass + tests_fail + tests_missing,
+                tests_pass=F('tests_pass') + tests_pass,
+                tests_fail=F('tests_fail') + tests_fail,
+                tests_missing=F('tests_missing') + tests_missing,
+                metrics_log_sum=F('metrics_log_sum') + (positive and log(metrics_summary) or 0),
+                metrics_count=F('metrics_count') + (positive and 1 or 0),
+            )
+
+    @classmethod
+    def overall(cls, build):
+        """
+        Returns the overall summary of `build`, computing its summaries if
+        they do not exist yet (e.g. for builds received before summaries
+        were introduced). The existence check is repeated with the build row
+        locked, so that it does not race with `add_test_run`.
+        """
+        summary = cls.objects.filter(build=build, environment=None).first()
+        if summary is not None:
+            return summary
+        with transaction.atomic():
+            cls.__lock__(build.id)
+            summary = cls.objects.filter(build=build, environment=None).first()
+            if summary is not None:
+                return summary
+            return cls.recompute(build)
+
+    @classmethod
+    def recompute(cls, build):
+        """
+        Recomputes the summaries of `build` from scratch, and returns the
+        overall one. The build row is locked while doing so, like in
+        `add_test_run`, so that test runs that get their status recorded in
+        the meantime are not lost.
+        """
+        with transaction.atomic():
+            cls.__lock__(build.id)
+            return cls.__recompute__(build)
+
+    @staticmethod
+    def __lock__(build_id):
+        """
+        Locks the row of a build until the end of the current transaction.
+        A no-op UPDATE is used instead of SELECT ... FOR UPDATE because on
+        PostgreSQL the latter also waits for the transactions that are
+        inserting test runs (or anything else) that reference the build,
+        and two of those locking the build in turn would deadlock.
+        """
+        Build.objects.filter(id=build_id).update(datetime=F('datetime'))
+
+    @classmethod
+    def __recompute__(cls, build):
+        test_runs = build.test_runs.filter(status_recorded=True)
+        summaries = defaultdict(lambda: cls(build=build))
+
+        def add(environment_id, **values):
+            for env in (None, environment_id):
+                summary = summaries[env]
+                summary.environment_id = env
+                for field, value in values.items():
+                    setattr(summary, field, getattr(summary, field) + value)
+
+        for row in test_runs.values('environment_id').annotate(n=Count('id')):
+            add(row['environment_id'], test_runs_total=row['n'])
+
+        tests = Test.objects.filter(test_run__in=test_runs).values('test_run__environment_id').annotate(
+            total=Count('id'),
+            passes=Count(Case(When(result=True, then=1))),
+            fails=Count(Case(When(result=False, then=1))),
+        )
+        for row in tests:
+            add(
+                row['test_run__environment_id'],
+                tests_total=row['total'],
+                tests_pass=row['passes'],
+                tests_fail=row['fails'],
+                tests_missing=row['total'] - row['passes'] - row['fails'],
+            )
+
+        statuses = Status.objects.overall().filter(test_run__in=test_runs, metrics_summary__gt=0)
+        for environment_id, metrics_summary in statuses.values_list('test_run__environment_id', 'metrics_summary'):
+            add(environment_id, metrics_log_sum=log(metrics_summary), metrics_count=1)
+
+        summaries[None].environment_id = None
+        cls.objects.filter(build=build).delete()
+        cls.objects.bulk_create(summaries.values())
+        return summaries[None]
+
+
 class ProjectStatus(models.Model):
     """
     Represents a "checkpoint" of a project status in time. It is used by the
@@ -1,10 +1,13 @@
+from collections import OrderedDict
+
+
 from django.db import models
 from django.core.mail import send_mail
 from django.conf import settings
 from django.template.loader import render_to_string
 
 
-from squad.core.models import Project, ProjectStatus, Build
+from squad.core.models import Project, ProjectStatus, Build, TestRun, TestTransition
 from squad.core.comparison import TestComparison
 
 
@@ -29,9 +32,51 @@ class Notification(object):
             )
         return self.__comparison__
 
+    __diff__ = None
+
     @property
     def diff(self):
-        return self.comparison.diff
+        """
+        List of (test name, results) for the tests whose results changed.
+
+        When the comparison can be cached, this comes from
+        `comparison.diff`, which is cached (see TestComparison). Otherwise
+        the results are read as a stream (see TestComparison.iter_diff), and
+        only the changed rows are kept, so the results of large builds are
+        never all in memory at once. Either way, the results are only read
+        once per notification.
+        """
+        if self.__diff__ is None:
+            if self.comparison.cache_key is not None:
+                self.__diff__ = list(self.comparison.diff.items())
+            else:
+                self.__diff__ = list(self.comparison.iter_diff())
+        return self.__diff__
+
+    @property
+    def has_changes(self):
+        return len(self.diff) > 0
+
+    @property
+    def regressions(self):
+        """
+        Reads the regressions from the ones recorded when the test runs
+        were processed (see TestTransition), which are relative to the
+        build right before this one. Falls back to comparing the builds
+        when comparing to an older build.
+        """
+        if self.previous_build is None:
+            return {}
+        intermediate = self.build.project.builds.filter(
+            datetime__gt=self.previous_build.datetime,
+            datetime__lt=self.build.datetime,
+        )
+        if intermediate.exists():
+            regressions = OrderedDict((env, []) for env in self.comparison.environments[self.build])
+            for env, test in self.comparison.iter_regressions():
+                regressions[env].append(test)
+            return OrderedDict((env, tests) for env, tests in regressions.items() if tests)
+        return TestTransition.by_environment(self.build, TestTransition.REGRESSION, self.previous_build)
 
 
 def get_notifications(status):
@@ -48,7 +93,7 @@ def get_notifications(status):
     elif strategy == Project.NOTIFY_ON_CHANGE:
         if status.previous:
             notification = Notification(status.build, status.previous.build)
-            if notification.diff:
+            if notification.has_changes:
                 __notifications__.append(notification)
     else:
         raise RuntimeError("Invalid notification strategy: \"%s\"" % strategy)
@@ -83,13 +128,17 @@ def __send_notification__(project, notification):
     build = notification.build
     metadata = dict(sorted(build.metadata.items())) if build.metadata is not None else dict()
     summary = notification.build.test_summary
+    # each failure links to the log of its test run, if there is one
+    TestRun.prefetch_payload_sizes(set(
+        test.test_run for tests in summary['failures'].values() for test in tests
+    ))
     subject = '%s, build %s: %d tests, %d failed, %d passed' % (project, build.version, summary['total'], summary['fail'], summary['pass'])
 
     context = {
         'build': build,
         'metadata': metadata,
         'previous_build': notification.previous_build,
-        'regressions': notification.comparison.regressions,
+        'regressions': notification.regressions,
         'subject': subject,
         'summary': summary,
         'notification': notification,
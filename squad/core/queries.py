@@ -1,4 +1,5 @@
 from squad.core import models
+from squad.core.utils import parse_name
 
 
 def get_metric_data(project, metrics, environments):
@@ -13,20 +14,36 @@ def get_metric_data(project, metrics, environments):
 
 
 def get_metric_series(project, metric, environments):
-    entry = {}
-    for environment in environments:
-        series = models.Metric.objects.by_full_name(metric).filter(
-            test_run__build__project=project,
-            test_run__environment__slug=environment,
+    """
+    Returns the results of `metric` in each of the given environments,
+    ordered by build datetime. Filters on the ids copied to the metrics
+    (see TestRun.denormalized_fields), so that the index on (project,
+    environment, suite, name) is used, and reads the build versions
+    separately instead of joining every metric with its build.
+    """
+    entry = {environment: [] for environment in environments}
+    (suite_slug, name) = parse_name(metric)
+    suite = project.suites.filter(slug=suite_slug).first()
+    if suite is None:
+        return entry
+    environment_ids = project.environments.filter(slug__in=environments).values_list('slug', 'id')
+    for environment, environment_id in environment_ids:
+        series = list(models.Metric.objects.filter(
+            project_id=project.id,
+            environment_id=environment_id,
+            suite_id=suite.id,
+            name=name,
         ).order_by(
-            'test_run__datetime',
-        ).values(
-            'test_run__datetime',
-            'test_run__build__version',
+            'build_datetime', 'id',
+        ).values_list(
+            'build_datetime',
+            'build_id',
             'result',
-        )
+        ))
+        builds = set(build_id for _, build_id, _ in series)
+        versions = dict(models.Build.objects.filter(id__in=builds).values_list('id', 'version'))
         entry[environment] = [
-            [int(p['test_run__datetime'].timestamp()), p['result'], p['test_run__build__version']] for p in series
+            [int(datetime.timestamp()), result, versions[build_id]] for datetime, build_id, result in series
         ]
     return entry
 
@@ -0,0 +1,329 @@
+from array import array
+import errno
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BlobStore(object):
+    """
+    Base class for blob stores. A blob store keeps arbitrary binary contents
+    out of the database, addressed by the SHA-256 hash of the contents, so
+    that identical contents are only stored once.
+
+    Subclasses must implement `put`, `open`, `exists`, `delete` and
+    `keys`, and should implement `put_file` without reading the whole file
+    into memory.
+    """
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, key, data):
+        """
+        Stores `data` (bytes) under `key`. Storing contents that are already
+        in the store must only mark them as just written (see `keys`).
+        """
+        raise NotImplementedError
+
+    def put_file(self, key, f):
+        """
+        Same as `put`, but reads the contents from the binary file object `f`.
+        """
+        self.put(key, f.read())
+
+    def open(self, key):
+        """
+        Returns a binary file object for reading the blob with the given key.
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self, written_before=None):
+        """
+        Yields the keys of all blobs in the store, or only of the ones last
+        written (see `put`) before the `written_before` timestamp.
+        """
+        raise NotImplementedError
+
+    def read(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    Stores blobs as files in a local directory, fanned out in two levels of
+    subdirectories so that no single directory gets too large.
+
+    Blobs are written to a temporary file first and then renamed into place,
+    so readers never see partially written blobs, and concurrent writers of
+    the same contents (possibly in different processes) do not conflict.
+    Writing contents that are already stored only updates the modification
+    time of their file.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[0:2], key[2:4], key)
+
+    def put(self, key, data):
+        self.__put__(key, lambda f: f.write(data))
+
+    def put_file(self, key, f):
+        self.__put__(key, lambda dest: shutil.copyfileobj(f, dest))
+
+    def __put__(self, key, write):
+        path = self.path(key)
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except:  # noqa
+            os.unlink(tmp)
+            raise
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def keys(self, written_before=None):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.startswith('.tmp'):
+                    continue
+                if written_before is not None:
+                    try:
+                        if os.stat(os.path.join(directory, name)).st_mtime >= written_before:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                yield name
+
+
+class GzipCodec(object):
+    name = 'gzip'
+    suffix = '.gz'
+    content_encoding = 'gzip'
+
+    @staticmethod
+    def compress(data):
+        return gzip.compress(data, compresslevel=6)
+
+    @staticmethod
+    def compressor():
+        # same format and level as `compress`
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    @staticmethod
+    def decompressing_reader(f):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+
+
+class ZstdCodec(object):
+    name = 'zstd'
+    suffix = '.zst'
+    content_encoding = 'zstd'
+
+    @staticmethod
+    def compress(data):
+        return zstandard.ZstdCompressor(level=3, write_content_size=True).compress(data)
+
+    @staticmethod
+    def compressor():
+        return zstandard.ZstdCompressor(level=3).compressobj()
+
+    @staticmethod
+    def decompressing_reader(f):
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+
+
+CODECS = {GzipCodec.name: GzipCodec}
+if zstandard:
+    CODECS[ZstdCodec.name] = ZstdCodec
+
+
+def get_codec(name):
+    """
+    Returns the codec with the given name, or None if `name` is None.
+    Raises ValueError for unknown or unavailable codecs.
+    """
+    if name is None:
+        return None
+    if name not in CODECS:
+        raise ValueError('Compression codec not available: %s' % name)
+    return CODECS[name]
+
+
+def get_compression():
+    """
+    Returns the codec configured in the SQUAD_BLOB_COMPRESSION setting for
+    compressing new blobs, or None if compression is disabled.
+    """
+    return get_codec(settings.SQUAD_BLOB_COMPRESSION)
+
+
+def pack_offsets(offsets):
+    """
+    Packs a list of offsets as little-endian 64-bit unsigned integers.
+    """
+    values = array('Q', offsets)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_offsets(data):
+    """
+    Returns the list of offsets packed in `data` (see `pack_offsets`).
+    """
+    values = array('Q')
+    values.frombytes(bytes(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+
+class BlockReader(io.RawIOBase):
+    """
+    Reads contents that were compressed in independent blocks of
+    `block_size` bytes each (the last one possibly shorter), stored one
+    after the other, starting at the given `offsets` of the stored data.
+    `open_stored` is called to open the stored data again when seeking.
+
+    Seeking only decompresses the block that contains the new position, up
+    to it, so reading the end of large contents (e.g. to follow a log as it
+    grows) does not need to go through all of it.
+    """
+
+    def __init__(self, open_stored, codec, size, block_size, offsets, chunk_size=64 * 1024):
+        self.open_stored = open_stored
+        self.codec = codec
+        self.size = size
+        self.block_size = block_size
+        self.offsets = offsets
+        self.chunk_size = chunk_size
+        self.pos = 0
+        self.reader = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        if pos != self.pos:
+            self.__close_reader__()
+            self.pos = pos
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        chunks = []
+        while size > 0 and self.pos < self.size:
+            opened = self.reader is None
+            if opened:
+                self.__open_reader__()
+            chunk = self.reader.read(size)
+            if not chunk:
+                # end of a block, for codecs whose readers stop there
+                self.__close_reader__()
+                if opened:
+                    break
+                continue
+            self.pos += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def readall(self):
+        return self.read()
+
+    def __open_reader__(self):
+        block = min(self.pos // self.block_size, len(self.offsets) - 1)
+        f = self.open_stored()
+        f.seek(self.offsets[block])
+        self.stored = f
+        self.reader = self.codec.decompressing_reader(f)
+        skip = self.pos - block * self.block_size
+        while skip > 0:
+            skipped = len(self.reader.read(min(self.chunk_size, skip)))
+            if not skipped:
+                break
+            skip -= skipped
+
+    def __close_reader__(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.stored.close()
+            self.reader = None
+
+    def close(self):
+        self.__close_reader__()
+        super(BlockReader, self).close()
+
+
+__store__ = {}
+
+
+def get_blob_store():
+    """
+    Returns the blob store configured in the SQUAD_BLOB_STORE setting.
+    """
+    config = settings.SQUAD_BLOB_STORE
+    key = (config['BACKEND'], tuple(sorted(config.get('OPTIONS', {}).items())))
+    if key not in __store__:
+        backend = import_string(config['BACKEND'])
+        __store__[key] = backend(**config.get('OPTIONS', {}))
+    return __store__[key]
@@ -1,15 +1,25 @@
-from collections import defaultdict
+from array import array
+from collections import OrderedDict, defaultdict
+from contextlib import ExitStack
+import hashlib
+from itertools import chain, islice
 import json
 import logging
 import uuid
 
 
-from django.db import transaction
+from django.db import transaction, IntegrityError
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
 
 
-from squad.core.models import TestRun, Suite, Test, Metric, Status
+from squad.celery import app as celery
+from squad.core.models import Build, Environment, BuildSummary, TestRun, Blob, Suite, KnownTest, Test, TestTransition, Metric, Status, Receipt, DuplicateSubmission
+from squad.core.models import build_ids, environment_ids, suite_ids, open_payload
 from squad.core.data import JSONTestDataParser, JSONMetricDataParser
-from squad.core.statistics import geomean
+from squad.core.data import JSONObjectReader, JSONObjectExpected
+from squad.core.statistics import logarithms, geomean_of_logs
+from squad.core.utils import read_text
 from . import exceptions
 
 
@@ -20,17 +30,69 @@ test_parser = JSONTestDataParser
 metric_parser = JSONMetricDataParser
 
 
+class Submission(object):
+    """
+    The data files of a test run submission. The metadata is decoded once,
+    by ValidateTestRun, and the decoded data is then used all the way
+    through processing. Tests and metrics are decoded incrementally, and
+    validated as they are decoded, when `tests` and `metrics` are iterated
+    over; this way they are decoded only once as well, but never need to be
+    held in memory as a whole.
+
+    Tests and metrics can be given as strings, or as the Blobs they were
+    stored in, which are then read from the blob store as they are decoded.
+    """
+
+    def __init__(self, metadata_file=None, metrics_file=None, tests_file=None):
+        self.metadata_file = metadata_file
+        self.metrics_file = metrics_file
+        self.tests_file = tests_file
+        self.metadata = None
+
+    @property
+    def metrics(self):
+        if self.metrics_file:
+            return self.__read__(ValidateTestRun.metrics, self.metrics_file)
+        return None
+
+    @property
+    def tests(self):
+        if self.tests_file:
+            return self.__read__(ValidateTestRun.tests, self.tests_file)
+        return None
+
+    @staticmethod
+    def __read__(validate, data):
+        if not isinstance(data, Blob):
+            yield from validate(data)
+        elif data.size:
+            with data.open() as f:
+                yield from validate(f)
+
+
 class ValidateTestRun(object):
 
-    def __call__(self, metadata_file=None, metrics_file=None, tests_file=None):
+    def __call__(self, metadata_file=None, metrics_file=None, tests_file=None, deferred=False):
+        """
+        Validates the given data files, and returns the corresponding
+        Submission.
+
+        If `deferred` is True, tests and metrics are not validated right
+        away. Instead they are validated while being parsed from the returned
+        Submission, and the caller must be ready to handle validation errors
+        at that point.
+        """
+        submission = Submission(metadata_file, metrics_file, tests_file)
+
         if metadata_file:
-            self.__validate_metadata__(metadata_file)
+            submission.metadata = self.__validate_metadata__(metadata_file)
 
-        if metrics_file:
-            self.__validate_metrics(metrics_file)
+        if not deferred:
+            for data in (submission.metrics, submission.tests):
+                for _ in (data or []):
+                    pass
 
-        if tests_file:
-            self.__validate_tests__(tests_file)
+        return submission
 
     def __validate_metadata__(self, metadata_json):
         try:
@@ -44,33 +106,70 @@ class ValidateTestRun(object):
         if "job_id" not in metadata.keys():
             raise exceptions.InvalidMetadata("job_id is mandatory in metadata")
         elif '/' in metadata['job_id']:
-                raise exceptions.InvalidMetadata('job_id cannot contain the "/" character')
+            raise exceptions.InvalidMetadata('job_id cannot contain the "/" character')
 
-    def __validate_metrics(self, metrics_file):
+        return metadata
+
+    @staticmethod
+    def metrics(metrics_file):
+        """
+        Yields the (name, value) pairs from `metrics_file`, validating each
+        one of them.
+        """
         try:
-            metrics = json.loads(metrics_file)
+            for key, value in JSONObjectReader(metrics_file):
+                if type(value) not in [int, float, list]:
+                    raise exceptions.InvalidMetricsData.value(value)
+                if type(value) is list:
+                    for item in value:
+                        if type(item) not in [int, float]:
+                            raise exceptions.InvalidMetricsData.value(value)
+                yield key, value
+        except JSONObjectExpected as e:
+            raise exceptions.InvalidMetricsData.type(e.obj)
         except json.decoder.JSONDecodeError as e:
-            raise exceptions.InvalidMetricsDataJSON("metrics is not valid JSON: " + str(e) + "\n" + metrics_file)
-
-        if type(metrics) != dict:
-            raise exceptions.InvalidMetricsData.type(metrics)
+            raise exceptions.InvalidMetricsDataJSON("metrics is not valid JSON: " + str(e) + "\n" + ValidateTestRun.__input__(metrics_file))
 
-        for key, value in metrics.items():
-            if type(value) not in [int, float, list]:
-                raise exceptions.InvalidMetricsData.value(value)
-            if type(value) is list:
-                for item in value:
-                    if type(item) not in [int, float]:
-                        raise exceptions.InvalidMetricsData.value(value)
-
-    def __validate_tests__(self, tests_file):
+    @staticmethod
+    def tests(tests_file):
+        """
+        Yields the (name, result) pairs from `tests_file`, validating the
+        file structure along the way.
+        """
         try:
-            tests = json.loads(tests_file)
+            for key, value in JSONObjectReader(tests_file):
+                yield key, value
+        except JSONObjectExpected as e:
+            raise exceptions.InvalidTestsData.type(e.obj)
         except json.decoder.JSONDecodeError as e:
-            raise exceptions.InvalidTestsDataJSON("tests is not valid JSON: " + str(e) + "\n" + tests_file)
+            raise exceptions.InvalidTestsDataJSON("tests is not valid JSON: " + str(e) + "\n" + ValidateTestRun.__input__(tests_file))
 
-        if type(tests) != dict:
-            raise exceptions.InvalidTestsData.type(tests)
+    # files with invalid JSON are only included up to this size in the error
+    # messages
+    MAX_INPUT_IN_ERRORS = 64 * 1024
+
+    @staticmethod
+    def __input__(data):
+        """
+        Returns the given data file as a string, to include in the error
+        message when it is not valid JSON. File objects are read again from
+        the start, if possible, but only up to MAX_INPUT_IN_ERRORS.
+        """
+        if isinstance(data, str):
+            return data
+        if isinstance(data, bytes):
+            return data.decode('utf-8', 'replace')
+        limit = ValidateTestRun.MAX_INPUT_IN_ERRORS
+        try:
+            data.seek(0)
+            text = data.read(limit + 1)
+        except (OSError, ValueError):
+            return ''
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        if len(text) > limit:
+            text = text[:limit] + '...'
+        return text
 
 
 class ReceiveTestRun(object):
@@ -87,15 +186,66 @@ class ReceiveTestRun(object):
         "resubmit_url",
     )
 
-    def __call__(self, version, environment_slug, metadata_file=None, metrics_file=None, tests_file=None, log_file=None, attachments={}):
-        build, _ = self.project.builds.get_or_create(version=version)
-        environment, _ = self.project.environments.get_or_create(slug=environment_slug)
+    @transaction.atomic
+    def __call__(self, version, environment_slug, metadata_file=None, metrics_file=None, tests_file=None, log_file=None, attachments={}, process=True):
+        """
+        The data files can be passed either as strings or as file-like
+        objects (e.g. uploaded files, or text streams); the same goes for the values in the
+        `attachments` dictionary. Files other than the metadata are streamed
+        into the blob store, and tests and metrics are then parsed from
+        there, so they are never held in memory as a whole.
+
+        Tests and metrics are validated while being processed, and nothing
+        is stored if they turn out to be invalid.
+
+        If `process` is False, only the metadata is validated, and the test
+        run is stored without being processed. It must be processed later,
+        e.g. with the `process_test_run` task.
+        """
+        build = build_ids.get_or_create(self.project, version)
+        environment = environment_ids.get_or_create(self.project, environment_slug)
+        return self.receive(build, environment, metadata_file, metrics_file, tests_file, log_file, attachments, process)
+
+    @transaction.atomic
+    def receive(self, build, environment, metadata_file=None, metrics_file=None, tests_file=None, log_file=None, attachments={}, process=True):
+        """
+        Same as calling the object, but with already resolved Build and
+        Environment objects.
+
+        Submissions are idempotent: if a test run with exactly the same data
+        files and attachments was already received for the same build and
+        environment, nothing is parsed or stored, and that test run is
+        returned instead, with its `duplicate` attribute set to True.
+        """
+        metadata_file = read_text(metadata_file)
+        payloads = {
+            'metadata_file': metadata_file,
+            'metrics_file': metrics_file,
+            'tests_file': tests_file,
+            'log_file': log_file,
+        }
+        # the contents are hashed first, and only stored if the submission
+        # is not a duplicate
+        with ExitStack() as stack:
+            contents = {name: stack.enter_context(Blob.objects.read(data)) for name, data in payloads.items() if data is not None}
+            attachments = {f: stack.enter_context(Blob.objects.read(data)) for f, data in attachments.items()}
+
+            payload_hash, size = self.payload_hash(contents, attachments)
+            existing = build.test_runs.filter(environment=environment, payload_hash=payload_hash).first()
+            if existing:
+                return self.__duplicate__(existing, size)
+
+            # Contents that are stored in vain (e.g. for invalid submissions)
+            # are either already referenced, or removed from the blob store
+            # by the gc_blobs command.
+            blobs = {name + '_blob': name in contents and Blob.objects.store(contents[name]) or None for name in payloads}
+            attachments = {f: Blob.objects.store(c) for f, c in attachments.items()}
 
         validate = ValidateTestRun()
-        validate(metadata_file, metrics_file, tests_file)
+        submission = validate(metadata_file, blobs['metrics_file_blob'], blobs['tests_file_blob'], deferred=True)
 
-        if metadata_file:
-            data = json.loads(metadata_file)
+        if submission.metadata:
+            data = submission.metadata
 
             fields = self.SPECIAL_METADATA_FIELDS
             metadata_fields = {k: data[k] for k in fields if data.get(k)}
@@ -110,71 +260,396 @@ class ReceiveTestRun(object):
         if 'job_id' not in metadata_fields:
             metadata_fields['job_id'] = uuid.uuid4()
 
-        testrun = build.test_runs.create(
-            environment=environment,
-            tests_file=tests_file,
-            metrics_file=metrics_file,
-            log_file=log_file,
-            metadata_file=metadata_file,
-            **metadata_fields
-        )
+        try:
+            with transaction.atomic():
+                testrun = build.test_runs.create(
+                    environment=environment,
+                    payload_hash=payload_hash,
+                    **blobs,
+                    **metadata_fields
+                )
+        except IntegrityError:
+            # the same data was submitted concurrently
+            existing = build.test_runs.filter(environment=environment, payload_hash=payload_hash).first()
+            if existing:
+                return self.__duplicate__(existing, size)
+            raise
+        testrun.metadata = submission.metadata or {}
 
-        for f, data in attachments.items():
-            testrun.attachments.create(filename=f, data=data, length=len(data))
+        for f, blob in attachments.items():
+            testrun.attachments.create(filename=f, data_blob=blob, length=blob.size)
 
         testrun.refresh_from_db()
 
-        if not build.datetime or testrun.datetime < build.datetime:
-            build.datetime = testrun.datetime
-            build.save()
+        # updated in the database directly, so that `build` does not need to
+        # be fully loaded (see squad.core.cache); the update only ever moves
+        # the datetime back, so concurrent submissions to the same build only
+        # wait for each other when they both do that
+        build.datetime = Build.objects.filter(pk=build.pk).values_list('datetime', flat=True).get()
+        if testrun.datetime < build.datetime:
+            # the environments are locked before the build row, like
+            # everywhere else (see RecordTestTransitions.lock), and the
+            # datetime is read again once nobody else can move the build in
+            # them
+            RecordTestTransitions.lock(build.test_runs.values_list('environment_id', flat=True))
+            old_datetime = Build.objects.filter(pk=build.pk).values_list('datetime', flat=True).get()
+            build.datetime = old_datetime
+            moved = Build.objects.filter(pk=build.pk, datetime__gt=testrun.datetime).update(datetime=testrun.datetime)
+            if moved:
+                build.datetime = testrun.datetime
+                build_id = build.id
+                moved_from = old_datetime.isoformat()
+                transaction.on_commit(lambda: update_build_datetime.delay(build_id, old_datetime=moved_from))
+
+        if process:
+            processor = ProcessTestRun()
+            processor(testrun, submission)
+        return testrun
 
-        processor = ProcessTestRun()
-        processor(testrun)
+    @staticmethod
+    def payload_hash(files, attachments):
+        """
+        Returns the SHA-256 hash of the given data files and attachments, and
+        their total size in bytes, from their BlobContents (or Blobs). Each
+        file is represented by its size and its own hash (i.e. its Blob key),
+        and each item is prefixed with its length, so that moving data from
+        one file to another changes the hash, and a missing file hashes
+        differently from an empty one.
+        """
+        h = hashlib.sha256()
+        size = 0
+
+        def update(data):
+            if data is None:
+                h.update(b'-\n')
+            else:
+                h.update(b'%d\n' % len(data))
+                h.update(data)
+
+        def update_blob(blob):
+            update(blob and b'%d %s' % (blob.size, blob.key.encode()))
+
+        for name in ('metadata_file', 'metrics_file', 'tests_file', 'log_file'):
+            blob = files.get(name)
+            update_blob(blob)
+            size += blob and blob.size or 0
+        for f in sorted(attachments):
+            update(f.encode('utf-8'))
+            update_blob(attachments[f])
+            size += attachments[f].size
+
+        return h.hexdigest(), size
+
+    def __duplicate__(self, testrun, size):
+        rows = testrun.tests.count() + testrun.metrics.count()
+        DuplicateSubmission.objects.create(test_run=testrun, size=size, rows=rows)
+        testrun.duplicate = True
         return testrun
 
 
+class ReceiveTestRunBatch(object):
+    """
+    Receives several test runs for the same build at once. The build, and
+    each of the environments, are looked up only once for the whole batch.
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.receive_test_run = ReceiveTestRun(project)
+
+    def __call__(self, version, test_runs, atomic=False):
+        """
+        `test_runs` is a list of dictionaries with the same arguments that
+        ReceiveTestRun takes, except for `version`.
+
+        Returns a list with, for each test run, either the created TestRun
+        object, or the exception raised if its data was invalid. If `atomic`
+        is True, the first invalid test run aborts the whole batch instead,
+        and nothing is stored.
+        """
+        if atomic:
+            with transaction.atomic():
+                return self.__receive__(version, test_runs, atomic)
+        return self.__receive__(version, test_runs, atomic)
+
+    def __receive__(self, version, test_runs, atomic):
+        build = build_ids.get_or_create(self.project, version)
+        environments = {}
+        if atomic:
+            # all of the test runs are committed together, so their
+            # environments are locked in advance, before the build row (see
+            # RecordTestTransitions.lock)
+            for slug in set(data['environment_slug'] for data in test_runs):
+                environments[slug] = environment_ids.get_or_create(self.project, slug)
+            RecordTestTransitions.lock(e.id for e in environments.values())
+        results = []
+        for data in test_runs:
+            data = dict(data)
+            slug = data.pop('environment_slug')
+            if slug not in environments:
+                environments[slug] = environment_ids.get_or_create(self.project, slug)
+            try:
+                results.append(self.receive_test_run.receive(build, environments[slug], **data))
+            except exceptions.invalid_input as e:
+                if atomic:
+                    raise
+                results.append(e)
+        return results
+
+
+def get_suites(project, slugs):
+    """
+    Returns a dict mapping each slug in `slugs` to the corresponding Suite in
+    `project`. Suites that are not in `suite_ids` are fetched in a single
+    query, and the missing ones are created in bulk.
+    """
+    slugs = set(slugs)
+    suites = suite_ids.get_many(project, slugs)
+
+    uncached = [s for s in slugs if s not in suites]
+    if uncached:
+        for suite in project.suites.filter(slug__in=uncached):
+            suites[suite.slug] = suite
+            suite_ids.add(suite)
+
+    missing = [s for s in slugs if s not in suites]
+    if missing:
+        try:
+            with transaction.atomic():
+                Suite.objects.bulk_create([Suite(project=project, slug=s) for s in missing])
+        except IntegrityError:
+            # some other process created one of them in the meantime
+            for slug in missing:
+                Suite.objects.get_or_create(project=project, slug=slug)
+        # bulk_create does not set primary keys on all databases
+        for suite in project.suites.filter(slug__in=missing):
+            suites[suite.slug] = suite
+            suite_ids.add(suite)
+
+    return suites
+
+
+def get_known_tests(project, keys):
+    """
+    Returns a dict mapping each (suite ID, test name) pair in `keys` to the
+    ID of the corresponding KnownTest in `project`. The existing ones are
+    fetched in a single query, and the missing ones are created in bulk.
+    """
+    keys = set(keys)
+
+    def fetch(keys):
+        known = KnownTest.objects.filter(
+            project=project,
+            suite_id__in=set(suite_id for suite_id, _ in keys),
+            name__in=set(name for _, name in keys),
+        ).values_list('suite_id', 'name', 'id')
+        return {(suite_id, name): known_test_id for suite_id, name, known_test_id in known if (suite_id, name) in keys}
+
+    known_tests = fetch(keys)
+
+    missing = keys.difference(known_tests)
+    if missing:
+        try:
+            with transaction.atomic():
+                KnownTest.objects.bulk_create([
+                    KnownTest(project=project, suite_id=suite_id, name=name)
+                    for suite_id, name in missing
+                ])
+        except IntegrityError:
+            # some other process created one of them in the meantime
+            for suite_id, name in missing:
+                KnownTest.objects.get_or_create(project=project, suite_id=suite_id, name=name)
+        # bulk_create does not set primary keys on all databases
+        known_tests.update(fetch(missing))
+
+    return known_tests
+
+
+def batches(iterable, size):
+    """
+    Splits `iterable` into lists of at most `size` items, consuming it
+    lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
 class ParseTestRunData(object):
+    """
+    Creates the Test and Metric objects from the test run data files. If a
+    StatusRecorder is passed, it is fed with each test and metric as they are
+    parsed, so that the status of the test run can be recorded without
+    reading them back from the database.
+
+    If the Submission that originated the test run is passed, tests and
+    metrics are read from it, and validated while being parsed.
+
+    Tests and metrics are parsed incrementally and written in batches of
+    BATCH_SIZE, so memory usage does not depend on the size of the test run.
+    """
+
+    BATCH_SIZE = 1000
 
     @staticmethod
     @transaction.atomic
-    def __call__(test_run):
+    def __call__(test_run, recorder=None, submission=None):
         if test_run.data_processed:
             return
 
+        if submission:
+            tests = submission.tests
+            metrics = submission.metrics
+        else:
+            tests = open_payload(test_run, 'tests_file')
+            metrics = open_payload(test_run, 'metrics_file')
+
         project = test_run.project
-        for test in test_parser()(test_run.tests_file):
-            suite = None
-            if test['group_name']:
-                suite, _ = Suite.objects.get_or_create(
-                    project=project,
-                    slug=test['group_name'],
-                )
-            Test.objects.create(
-                test_run=test_run,
-                suite=suite,
-                name=test['test_name'],
-                result=test['pass'],
-            )
-        for metric in metric_parser()(test_run.metrics_file):
-            suite = None
-            if metric['group_name']:
-                suite, _ = Suite.objects.get_or_create(
-                    project=project,
-                    slug=metric['group_name']
-                )
-            Metric.objects.create(
-                test_run=test_run,
-                suite=suite,
-                name=metric['name'],
-                result=metric['result'],
-                measurements=','.join([str(m) for m in metric['measurements']]),
-            )
+        denormalized_fields = test_run.denormalized_fields()
+        suites = {}
+
+        def resolve_suites(batch, key):
+            missing = set(item[key] for item in batch if item[key] and item[key] not in suites)
+            if missing:
+                suites.update(get_suites(project, missing))
+
+        for batch in batches(test_parser.iterate(tests), ParseTestRunData.BATCH_SIZE):
+            resolve_suites(batch, 'group_name')
+            known_tests = get_known_tests(project, ((suites[t['group_name']].id, t['test_name']) for t in batch))
+            objects = []
+            for test in batch:
+                suite = suites.get(test['group_name'])
+                if recorder:
+                    recorder.add_test(suite and suite.id, test['pass'])
+                objects.append(Test(
+                    test_run=test_run,
+                    result=test['pass'],
+                    known_test_id=known_tests[(suite.id, test['test_name'])],
+                    **denormalized_fields
+                ))
+            Test.objects.bulk_create(objects)
+
+        for batch in batches(metric_parser.iterate(metrics), ParseTestRunData.BATCH_SIZE):
+            resolve_suites(batch, 'group_name')
+            objects = []
+            for metric in batch:
+                suite = suites.get(metric['group_name'])
+                if recorder:
+                    recorder.add_metric(suite and suite.id, metric['measurements'])
+                objects.append(Metric(
+                    test_run=test_run,
+                    suite=suite,
+                    name=metric['name'],
+                    result=metric['result'],
+                    measurements=metric['measurements'],
+                    **denormalized_fields
+                ))
+            Metric.objects.bulk_create(objects)
+
+        # Duplicate test or metric names are valid JSON, and json.loads kept
+        # only the last value of each; do the same, without keeping track of
+        # all names while parsing.
+        duplicates = 0
+        for model, fields in ((Test, ('known_test_id',)), (Metric, ('suite_id', 'name'))):
+            rows = model.objects.filter(test_run=test_run)
+            latest = rows.values(*fields).annotate(latest=Max('id')).values('latest')
+            duplicates += rows.exclude(id__in=latest).delete()[0]
+        if duplicates and recorder:
+            recorder.reload()
+
+        # the build datetime may be moved back by a test run received in the
+        # meantime (see ReceiveTestRun), and the tests and metrics stored
+        # after that one was committed need to be updated too
+        build_id = test_run.build_id
+        test_run_id = test_run.id
+        build_datetime = denormalized_fields['build_datetime']
+        transaction.on_commit(lambda: UpdateBuildDatetime.check(build_id, build_datetime, test_run_id))
 
         test_run.data_processed = True
         test_run.save()
 
 
+class StatusRecorder(object):
+    """
+    Accumulates pass/fail counts and the metrics summary (the geometric
+    mean of the measurements) for a test run, both overall and per suite,
+    and then writes all of the corresponding Status objects at once. The
+    measurements of each suite are kept as a packed array of floats, and
+    their geometric means are all calculated at the end (see
+    squad.core.statistics.logarithms).
+    """
+
+    def __init__(self, test_run):
+        self.test_run = test_run
+        self.reset()
+
+    def reset(self):
+        self.status = defaultdict(lambda: Status(test_run=self.test_run))
+        self.metrics = defaultdict(lambda: array('d'))
+        self.tests_missing = 0
+
+    def reload(self):
+        """
+        Starts over from the tests and metrics of the test run that are in
+        the database.
+        """
+        self.reset()
+        for suite_id, result in Test.objects.filter(test_run=self.test_run).values_list('known_test__suite_id', 'result'):
+            self.add_test(suite_id, result)
+        for suite_id, measurements in Metric.objects.filter(test_run=self.test_run).values_list('suite_id', 'measurements'):
+            self.add_metric(suite_id, measurements)
+
+    def add_test(self, suite_id, result):
+        if result is None:
+            self.tests_missing += 1
+        for sid in (None, suite_id):
+            if result:
+                self.status[sid].tests_pass += 1
+            else:
+                self.status[sid].tests_fail += 1
+
+    def add_metric(self, suite_id, measurements):
+        self.metrics[suite_id].extend(measurements)
+
+    def statuses(self):
+        if self.metrics:
+            logs = {sid: logarithms(values) for sid, values in self.metrics.items()}
+            for sid, suite_logs in logs.items():
+                self.status[sid].metrics_summary = geomean_of_logs(suite_logs)
+            self.status[None].metrics_summary = geomean_of_logs(list(chain.from_iterable(logs.values())))
+
+        for sid, s in self.status.items():
+            s.suite_id = sid
+        return list(self.status.values())
+
+    def save(self):
+        statuses = self.statuses()
+        Status.objects.bulk_create(statuses)
+
+        self.test_run.status_recorded = True
+        self.test_run.save()
+
+        overall = self.status[None]
+        BuildSummary.add_test_run(
+            self.test_run,
+            tests_pass=overall.tests_pass,
+            tests_fail=overall.tests_fail - self.tests_missing,
+            tests_missing=self.tests_missing,
+            metrics_summary=overall.metrics_summary,
+        )
+
+
 class RecordTestRunStatus(object):
+    """
+    Records the status of a test run whose data has already been parsed,
+    reading its tests and metrics back from the database. Test runs that are
+    processed from scratch get their status recorded while being parsed (see
+    ProcessTestRun); this is only needed for test runs that were parsed
+    before that.
+    """
 
     @staticmethod
     @transaction.atomic
@@ -182,50 +657,348 @@ class RecordTestRunStatus(object):
         if testrun.status_recorded:
             return
 
-        status = defaultdict(lambda: Status(test_run=testrun))
+        recorder = StatusRecorder(testrun)
+        for suite_id, result in testrun.tests.values_list('known_test__suite_id', 'result'):
+            recorder.add_test(suite_id, result)
+        for suite_id, measurements in testrun.metrics.values_list('suite_id', 'measurements'):
+            recorder.add_metric(suite_id, measurements)
+        recorder.save()
 
-        for test in testrun.tests.all():
-            sid = test.suite_id
-            if test.result:
-                status[None].tests_pass = status[None].tests_pass + 1
-                status[sid].tests_pass = status[sid].tests_pass + 1
-            else:
-                status[None].tests_fail = status[None].tests_fail + 1
-                status[sid].tests_fail = status[sid].tests_fail + 1
 
-        metrics = defaultdict(lambda: [])
-        for metric in testrun.metrics.all():
-            sid = metric.suite_id
-            for v in metric.measurement_list:
-                metrics[None].append(v)
-                metrics[sid].append(v)
+class RecomputeTestRunStatus(object):
+    """
+    Recomputes the status of several test runs at once, replacing any
+    status already recorded for them. Tests and metrics are read for all of
+    the test runs in one query each, and all of the Status objects are
+    written in bulk. The regressions and fixes of the test runs are
+    recorded again too.
+    """
 
-        for sid, values in metrics.items():
-            status[sid].metrics_summary = geomean(values)
+    @staticmethod
+    @transaction.atomic
+    def __call__(testruns):
+        RecordTestTransitions.lock(t.environment_id for t in testruns)
+        recorders = {t.id: StatusRecorder(t) for t in testruns}
+        ids = list(recorders.keys())
+
+        tests = Test.objects.filter(test_run_id__in=ids)
+        for test_run_id, suite_id, result in tests.values_list('test_run_id', 'known_test__suite_id', 'result'):
+            recorders[test_run_id].add_test(suite_id, result)
+        metrics = Metric.objects.filter(test_run_id__in=ids)
+        for test_run_id, suite_id, measurements in metrics.values_list('test_run_id', 'suite_id', 'measurements'):
+            recorders[test_run_id].add_metric(suite_id, measurements)
+
+        Status.objects.filter(test_run_id__in=ids).delete()
+        statuses = []
+        for recorder in recorders.values():
+            statuses += recorder.statuses()
+        Status.objects.bulk_create(statuses)
+        TestRun.objects.filter(id__in=ids).update(status_recorded=True)
+
+        for build in Build.objects.filter(test_runs__id__in=ids).distinct():
+            BuildSummary.recompute(build)
+
+        # transitions only depend on the tests, which did not change, so the
+        # ones of the following builds are still valid
+        for testrun in sorted(testruns, key=lambda t: t.id):
+            RecordTestTransitions.record(testrun)
+
+
+class RecordTestTransitions(object):
+    """
+    Records the regressions and fixes (see TestTransition) of the tests in a
+    test run, relative to the latest previous build with test runs in the
+    same environment. Only the results of the tests in the test run are
+    read, along with the previous result of each of them, BATCH_SIZE tests
+    at a time.
+
+    The test run is assumed to be the latest one in its build and
+    environment, so its results replace the transitions previously recorded
+    for the same tests.
+
+    Builds are not necessarily received in order, so the transitions of the
+    next build with test runs in the same environment, if any, are recorded
+    again as well, now relative to the test run's build. Transitions only
+    relate builds in the same environment, so the environment row is locked
+    while doing so: test runs of different builds in the same environment
+    that are processed concurrently see each other's results, while test
+    runs in other environments, of the same build or not, are processed in
+    parallel.
+    """
+
+    BATCH_SIZE = 1000
 
-        for sid, s in status.items():
-            s.suite_id = sid
-            s.save()
+    @staticmethod
+    def lock(environment_ids):
+        """
+        Locks the given environments until the end of the current
+        transaction. They are always locked in the same order, and before
+        the row of any of their builds (see BuildSummary.add_test_run), so
+        that concurrent transactions never deadlock.
+        """
+        environments = Environment.objects.select_for_update().filter(id__in=set(environment_ids))
+        list(environments.order_by('id').values_list('id', flat=True))
+
+    @staticmethod
+    @transaction.atomic
+    def __call__(testrun):
+        build = testrun.build
+        environment_id = testrun.environment_id
+        RecordTestTransitions.lock([environment_id])
+        RecordTestTransitions.record(testrun)
+        following = RecordTestTransitions.__following__(build, build.datetime, environment_id)
+        if following:
+            RecordTestTransitions.rebuild(following, environment_id)
+
+    @staticmethod
+    def record(testrun):
+        """
+        Records the transitions of the tests in `testrun` only, leaving the
+        ones of other builds alone.
+        """
+        build = testrun.build
+        environment_id = testrun.environment_id
+        tests = Test.objects.filter(test_run=testrun).order_by('id')
+        previous = RecordTestTransitions.__previous__(build, environment_id)
+        if previous is None:
+            return
+        last_id = 0
+        while True:
+            batch = list(tests.filter(id__gt=last_id).values_list('id', 'known_test_id', 'result')[:RecordTestTransitions.BATCH_SIZE])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            current = OrderedDict((known_test_id, result) for _, known_test_id, result in batch)
+            TestTransition.objects.filter(build=build, environment_id=environment_id, known_test_id__in=current.keys()).delete()
+            RecordTestTransitions.__record__(build, environment_id, previous, current)
+
+    @staticmethod
+    def rebuild(build, environment_id):
+        """
+        Records all of the transitions of `build` in the given environment
+        again, from all of its test runs there. Tests that are in more than
+        one of those test runs count with their latest result.
+        """
+        TestTransition.objects.filter(build=build, environment_id=environment_id).delete()
+        tests = Test.objects.filter(test_run__build=build, test_run__environment_id=environment_id)
+        known_test_ids = tests.order_by('known_test_id').values_list('known_test_id', flat=True).distinct()
+        previous = RecordTestTransitions.__previous__(build, environment_id)
+        if previous is None:
+            return
+        last_id = 0
+        while True:
+            batch = list(known_test_ids.filter(known_test_id__gt=last_id)[:RecordTestTransitions.BATCH_SIZE])
+            if not batch:
+                break
+            last_id = batch[-1]
+            current = OrderedDict(tests.filter(known_test_id__in=batch).order_by('test_run_id', 'id').values_list('known_test_id', 'result'))
+            RecordTestTransitions.__record__(build, environment_id, previous, current)
+
+    @staticmethod
+    def moved(build, old_datetime):
+        """
+        Records again the transitions affected by `build` having been moved
+        back in time from `old_datetime` (see UpdateBuildDatetime): in each
+        of its environments, the ones of the build itself, of the build that
+        now follows it, and of the one that followed it before. Each
+        environment is done in its own transaction, so that only one of them
+        is locked at a time.
+        """
+        environment_ids = set(build.test_runs.values_list('environment_id', flat=True))
+        for environment_id in sorted(environment_ids):
+            with transaction.atomic():
+                RecordTestTransitions.__moved__(build, old_datetime, environment_id)
+
+    @staticmethod
+    def __moved__(build, old_datetime, environment_id):
+        RecordTestTransitions.lock([environment_id])
+        # the build can not be moved again while its environment is locked
+        # (see ReceiveTestRun)
+        build.datetime = Build.objects.filter(pk=build.pk).values_list('datetime', flat=True).get()
+        RecordTestTransitions.rebuild(build, environment_id)
+        following = set()
+        for datetime in (build.datetime, old_datetime):
+            following.add(RecordTestTransitions.__following__(build, datetime, environment_id))
+        for b in following - {None, build}:
+            RecordTestTransitions.rebuild(b, environment_id)
+
+    @staticmethod
+    def __following__(build, datetime, environment_id):
+        return Build.objects.filter(
+            project_id=build.project_id,
+            datetime__gt=datetime,
+            test_runs__environment_id=environment_id,
+        ).order_by('datetime', 'id').first()
 
-        testrun.status_recorded = True
-        testrun.save()
+    @staticmethod
+    def __previous__(build, environment_id):
+        previous = Build.objects.filter(
+            project_id=build.project_id,
+            datetime__lt=build.datetime,
+            test_runs__environment_id=environment_id,
+        ).order_by('-datetime', '-id').first()
+        if previous is None:
+            return None
+        return previous, list(previous.test_runs.filter(environment_id=environment_id).values_list('id', flat=True))
+
+    @staticmethod
+    def __record__(build, environment_id, previous, current):
+        """
+        Creates the transitions of `build` for a batch of its tests, given
+        their current results (a known_test_id -> result mapping), relative
+        to `previous`, as returned by `__previous__`.
+        """
+        previous_build, previous_test_runs = previous
+
+        tests = Test.objects.filter(
+            test_run_id__in=previous_test_runs,
+            known_test_id__in=current.keys(),
+        ).order_by('test_run_id', 'id').values_list('known_test_id', 'result')
+        previous_results = dict(tests)
+
+        kinds = {(True, False): TestTransition.REGRESSION, (False, True): TestTransition.FIX}
+        transitions = []
+        for known_test_id, result in current.items():
+            kind = kinds.get((previous_results.get(known_test_id), result))
+            if kind:
+                transitions.append(TestTransition(
+                    build_id=build.id,
+                    environment_id=environment_id,
+                    known_test_id=known_test_id,
+                    previous_build=previous_build,
+                    kind=kind,
+                ))
+        TestTransition.objects.bulk_create(transitions)
 
 
 class ProcessTestRun(object):
 
     @staticmethod
-    def __call__(testrun):
-        ParseTestRunData()(testrun)
-        RecordTestRunStatus()(testrun)
+    @transaction.atomic
+    def __call__(testrun, submission=None):
+        if testrun.data_processed:
+            RecordTestRunStatus()(testrun)
+            return
+
+        recorder = None
+        if not testrun.status_recorded:
+            recorder = StatusRecorder(testrun)
+        ParseTestRunData()(testrun, recorder, submission)
+        # the environment is locked before the build row (see
+        # RecordTestTransitions.lock)
+        RecordTestTransitions()(testrun)
+        if recorder:
+            recorder.save()
+
+
+class UpdateBuildDatetime(object):
+    """
+    Copies the datetime of a build to its tests and metrics (see
+    TestRun.denormalized_fields), after the build was moved back in time by
+    ReceiveTestRun. This is done outside of the transaction that moved it,
+    BATCH_SIZE rows at a time, each batch in its own transaction, so that
+    the rows of a large build are never all locked at once.
+
+    Builds are only ever moved back, so only rows with a later datetime are
+    updated; that way, updates for successive moves can run in any order.
+
+    When given the datetime the build was moved from (as an ISO 8601
+    string), the test transitions affected by the move are recorded again
+    as well (see RecordTestTransitions.moved).
+    """
+
+    BATCH_SIZE = 1000
+
+    @staticmethod
+    def __call__(build_id, test_run_id=None, old_datetime=None):
+        build = Build.objects.filter(pk=build_id).first()
+        if build is None:
+            return
+        build_datetime = build.datetime
+        for model in (Test, Metric):
+            rows = model.objects.filter(build_id=build_id)
+            if test_run_id is not None:
+                rows = rows.filter(test_run_id=test_run_id)
+            last_id = 0
+            while True:
+                ids = list(rows.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:UpdateBuildDatetime.BATCH_SIZE])
+                if not ids:
+                    break
+                with transaction.atomic():
+                    model.objects.filter(id__in=ids, build_datetime__gt=build_datetime).update(build_datetime=build_datetime)
+                last_id = ids[-1]
+        if old_datetime is not None:
+            RecordTestTransitions.moved(build, parse_datetime(old_datetime))
+
+    @staticmethod
+    def check(build_id, build_datetime, test_run_id):
+        """
+        Updates the tests and metrics of a test run that were stored with
+        `build_datetime`, if the build was moved back in the meantime. Must
+        be called after they are committed.
+        """
+        if Build.objects.filter(pk=build_id, datetime__lt=build_datetime).exists():
+            update_build_datetime.delay(build_id, test_run_id)
+
+
+@celery.task
+def update_build_datetime(build_id, test_run_id=None, old_datetime=None):
+    UpdateBuildDatetime()(build_id, test_run_id, old_datetime)
+
+
+@celery.task
+def process_all_test_runs():
+    ProcessAllTestRuns()()
+
+
+@celery.task
+def process_test_run(receipt_id):
+    """
+    Processes a test run that was received for asynchronous processing,
+    recording the outcome in its Receipt. Test runs with invalid data are
+    removed, just as they would never have been stored if processed
+    synchronously. On any other error, the receipt is marked as failed too,
+    but the test run is kept, so that ProcessAllTestRuns can process it
+    later, and the error is raised again.
+    """
+    receipt = Receipt.objects.get(pk=receipt_id)
+    testrun = receipt.test_run
+    submission = Submission(
+        metrics_file=testrun.metrics_file_blob or testrun.metrics_file,
+        tests_file=testrun.tests_file_blob or testrun.tests_file,
+    )
+    try:
+        ProcessTestRun()(testrun, submission)
+        receipt.status = Receipt.PROCESSED
+    except exceptions.invalid_input as e:
+        testrun.delete()
+        receipt.test_run = None
+        receipt.status = Receipt.FAILED
+        receipt.error = str(e)
+    except Exception as e:
+        receipt.status = Receipt.FAILED
+        receipt.error = 'internal error: %s' % e
+        receipt.save()
+        raise
+    receipt.save()
 
 
 class ProcessAllTestRuns(object):
+    """
+    Processes all test runs that were not processed yet, except the ones
+    still queued for asynchronous processing (see process_test_run). Test
+    runs whose receipts have been queued for too long are processed too,
+    and their receipts marked as processed (see Receipt.QUEUED_TIMEOUT).
+    """
 
     @staticmethod
     def __call__():
-        for testrun in TestRun.objects.filter(data_processed=False).all():
-            parser = ParseTestRunData()
-            parser(testrun)
+        testruns = TestRun.objects.with_payloads().filter(data_processed=False)
+        for testrun in testruns.exclude(receipts__in=Receipt.queued()):
+            processor = ProcessTestRun()
+            processor(testrun)
+            testrun.receipts.filter(status=Receipt.QUEUED).update(status=Receipt.PROCESSED)
+        # test runs parsed before status recording was done in the same pass
         for testrun in TestRun.objects.filter(status_recorded=False).all():
             recorder = RecordTestRunStatus()
             recorder(testrun)
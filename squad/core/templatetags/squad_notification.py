@@ -1,3 +1,7 @@
+from collections.abc import Mapping
+from itertools import chain
+
+
 from django import template
 
 
@@ -6,9 +10,19 @@ register = template.Library()
 
 @register.simple_tag
 def tabulate_test_comparison(comparison, test_results=None):
+    """
+    Formats test results as a text table. `test_results` can be a mapping
+    like TestComparison.results, or an iterable of (test name, results)
+    pairs like TestComparison.iter_results (the default), which is only
+    read once, row by row.
+    """
     if test_results is None:
-        test_results = comparison.results
-    if not test_results:
+        test_results = comparison.iter_results()
+    elif isinstance(test_results, Mapping):
+        test_results = test_results.items()
+    test_results = iter(test_results)
+    first = next(test_results, None)
+    if first is None:
         return '(none)'
 
     text = []
@@ -27,7 +41,7 @@ def tabulate_test_comparison(comparison, test_results=None):
 
     text.append(header_sep)
 
-    for test, results in test_results.items():
+    for test, results in chain([first], test_results):
         row = []
         for build, env in header:
             row.append(results.get((build, env), 'n/a'))
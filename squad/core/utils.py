@@ -1,3 +1,4 @@
+import io
 import random
 import string
 
@@ -31,3 +32,51 @@ def join_name(group, name):
         return name
     else:
         return "/".join([group, name])
+
+
+CHUNK_SIZE = io.DEFAULT_BUFFER_SIZE * 16
+
+
+def read_chunks(data):
+    """
+    Yields the contents of `data` (see `read_file`) as bytes, in chunks of at
+    most CHUNK_SIZE bytes (or characters, for text streams) for file-like
+    objects.
+    """
+    if data is None:
+        return
+    if isinstance(data, (bytes, str)):
+        yield read_file(data)
+        return
+    while True:
+        chunk = data.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
+
+def read_file(data):
+    """
+    Returns the contents of `data` as bytes. `data` can be bytes, a string
+    or a text stream (which are encoded as UTF-8), or a file-like object
+    such as an uploaded file.
+    """
+    if data is None or isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    buf = io.BytesIO()
+    for chunk in read_chunks(data):
+        buf.write(chunk)
+    return buf.getvalue()
+
+
+def read_text(data):
+    """
+    Same as `read_file`, but returns a string decoded from UTF-8.
+    """
+    if data is None or isinstance(data, str):
+        return data
+    return read_file(data).decode('utf-8')
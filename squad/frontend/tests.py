@@ -8,8 +8,7 @@ from squad.core.history import TestHistory
 
 @auth
 def tests(request, group_slug, project_slug):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
 
     context = {
         "project": project,
@@ -24,8 +23,7 @@ def tests(request, group_slug, project_slug):
 
 @auth
 def test_history(request, group_slug, project_slug, full_test_name):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
 
     history = TestHistory(project, full_test_name)
     context = {
@@ -1,18 +1,20 @@
 from collections import defaultdict
+import hashlib
+import io
 import json
 import mimetypes
 import os
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, Http404
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, Http404
 from django.shortcuts import render, get_object_or_404, redirect
 
 from squad.ci.models import TestJob
-from squad.core.models import Group, Project, Metric
+from squad.core.models import Group, Project, Metric, TestTransition, payload_size
 from squad.core.queries import get_metric_data
-from squad.core.utils import join_name
+from squad.core.utils import join_name, read_file
 from squad.frontend.utils import file_type
-from squad.http import auth
+from squad.http import auth, accepts_encoding, etag_matches, parse_range, RangeNotSatisfiable
 
 
 def home(request):
@@ -33,8 +35,7 @@ def group(request, group_slug):
 
 @auth
 def project(request, group_slug, project_slug):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
     context = {
         'project': project,
     }
@@ -43,9 +44,8 @@ def project(request, group_slug, project_slug):
 
 @auth
 def builds(request, group_slug, project_slug):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
-    builds = project.builds.prefetch_related('test_runs').reverse().all()
+    project = request.project
+    builds = project.builds.prefetch_related('test_runs', 'summaries').reverse().all()
     context = {
         'project': project,
         'builds': builds,
@@ -55,22 +55,22 @@ def builds(request, group_slug, project_slug):
 
 @auth
 def build(request, group_slug, project_slug, version):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
     build = project.builds.prefetch_related('test_runs', 'test_runs__status', 'test_runs__status__suite', 'test_runs__status__test_run__environment').get(version=version)
 
     context = {
         'project': project,
         'build': build,
         'metadata': sorted(build.metadata.items()),
+        'regressions': TestTransition.by_environment(build, TestTransition.REGRESSION),
+        'fixes': TestTransition.by_environment(build, TestTransition.FIX),
     }
     return render(request, 'squad/build.html', context)
 
 
 @auth
 def test_run(request, group_slug, project_slug, build_version, job_id):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
     build = project.builds.get(version=build_version)
     test_run = build.test_runs.get(job_id=job_id)
 
@@ -96,83 +96,164 @@ def test_run(request, group_slug, project_slug, build_version, job_id):
     return render(request, 'squad/test_run.html', context)
 
 
-def __download__(filename, data, content_type=None):
+def __iter_range__(f, start, length, chunk_size=64 * 1024):
+    try:
+        if f.seekable():
+            f.seek(start)
+        else:
+            # e.g. decompressing readers; skip through the data instead
+            while start > 0:
+                skipped = len(f.read(min(chunk_size, start)))
+                if not skipped:
+                    break
+                start -= skipped
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def __download__(request, filename, obj, payload, content_type=None):
+    """
+    Streams the given payload of `obj` (see squad.core.models.blob_payload)
+    as a file download, with support for conditional (ETag) and range
+    requests.
+
+    Compressed payloads are sent as stored, with the corresponding
+    Content-Encoding, if the client accepts it; otherwise they are
+    decompressed on the fly. Ranges always refer to the decompressed
+    payload, so range requests are answered with it too; for compressed
+    payloads, only the block where the range starts is decompressed up to
+    it (see squad.core.models.Blob.open).
+    """
     if not content_type:
         content_type, _ = mimetypes.guess_type(filename)
         if content_type is None:
             content_type = 'application/octet-stream'
-    response = HttpResponse(data, content_type=content_type)
+
+    blob = getattr(obj, payload + '_blob')
+    if blob:
+        key = blob.key
+        size = blob.size
+        open_data = blob.open
+    else:
+        # not moved to the blob store yet
+        data = read_file(getattr(obj, payload)) or b''
+        key = hashlib.sha256(data).hexdigest()
+        size = len(data)
+        open_data = lambda: io.BytesIO(data)  # noqa
+
+    codec = blob and blob.codec
+    encoding = None
+    if codec and 'HTTP_RANGE' not in request.META and accepts_encoding(request, codec.content_encoding):
+        encoding = codec.content_encoding
+        key = key + '-' + encoding
+        size = blob.stored_size
+        open_data = blob.open_stored
+    etag = '"%s"' % key
+
+    if etag_matches(request, etag):
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    try:
+        byte_range = parse_range(request, size, etag)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            __iter_range__(open_data(), start, end - start + 1),
+            content_type=content_type,
+            status=206,
+        )
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(open_data(), content_type=content_type)
+        response['Content-Length'] = size
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
     return response
 
 
 @auth
 def test_run_log(request, group_slug, project_slug, build_version, job_id):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
+    group = project.group
     build = project.builds.get(version=build_version)
-    test_run = build.test_runs.get(job_id=job_id)
+    test_run = build.test_runs.with_payloads().get(job_id=job_id)
 
-    if not test_run.log_file:
+    if not payload_size(test_run, 'log_file'):
         raise Http404("No log file available for this test run")
 
     filename = '%s_%s_%s_%s.log' % (group.slug, project.slug, build.version, test_run.job_id)
-    return __download__(filename, test_run.log_file, 'text/plain')
+    return __download__(request, filename, test_run, 'log_file', 'text/plain')
 
 
 @auth
 def test_run_tests(request, group_slug, project_slug, build_version, job_id):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
+    group = project.group
     build = project.builds.get(version=build_version)
-    test_run = build.test_runs.get(job_id=job_id)
+    test_run = build.test_runs.with_payloads().get(job_id=job_id)
 
     filename = '%s_%s_%s_%s_tests.json' % (group.slug, project.slug, build.version, test_run.job_id)
-    return __download__(filename, test_run.tests_file)
+    return __download__(request, filename, test_run, 'tests_file')
 
 
 @auth
 def test_run_metrics(request, group_slug, project_slug, build_version, job_id):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
+    group = project.group
     build = project.builds.get(version=build_version)
-    test_run = build.test_runs.get(job_id=job_id)
+    test_run = build.test_runs.with_payloads().get(job_id=job_id)
 
     filename = '%s_%s_%s_%s_metrics.json' % (group.slug, project.slug, build.version, test_run.job_id)
-    return __download__(filename, test_run.metrics_file)
+    return __download__(request, filename, test_run, 'metrics_file')
 
 
 @auth
 def test_run_metadata(request, group_slug, project_slug, build_version, job_id):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
+    group = project.group
     build = project.builds.get(version=build_version)
-    test_run = build.test_runs.get(job_id=job_id)
+    test_run = build.test_runs.with_payloads().get(job_id=job_id)
 
     filename = '%s_%s_%s_%s_metadata.json' % (group.slug, project.slug, build.version, test_run.job_id)
-    return __download__(filename, test_run.metadata_file)
+    return __download__(request, filename, test_run, 'metadata_file')
 
 
 @auth
 def attachment(request, group_slug, project_slug, build_version, job_id, fname):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
     build = project.builds.get(version=build_version)
     test_run = build.test_runs.get(job_id=job_id)
 
     attachment = test_run.attachments.get(filename=fname)
-    return __download__(attachment.filename, attachment.data)
+    return __download__(request, attachment.filename, attachment, 'data')
 
 
 @auth
 def metrics(request, group_slug, project_slug):
-    group = Group.objects.get(slug=group_slug)
-    project = group.projects.get(slug=project_slug)
+    project = request.project
 
     environments = [{"name": e.slug} for e in project.environments.order_by('id').all()]
 
     metric_set = Metric.objects.filter(
-        test_run__environment__project=project
+        project=project
     ).values('suite__slug', 'name').order_by('suite__slug', 'name').distinct()
 
     metrics = [{"name": ":tests:", "label": "Test pass %", "max": 100, "min": 0}]
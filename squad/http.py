@@ -1,3 +1,6 @@
+import re
+
+
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 
@@ -5,14 +8,30 @@ from django.shortcuts import get_object_or_404
 from squad.core import models
 
 
+def get_project_or_404(group_slug, project_slug):
+    """
+    Returns the project with the given slugs, with its group, in a single
+    query.
+    """
+    projects = models.Project.objects.select_related('group')
+    return get_object_or_404(projects, group__slug=group_slug, slug=project_slug)
+
+
 def auth(func):
+    """
+    Checks that the request has access to the project identified by the
+    group and project slugs in the view arguments, with either a token of
+    that project (see `squad.core.models.token_acl`; global tokens are only
+    for submitting data) or a logged in user. The project is made
+    available to the view as `request.project`.
+    """
     def auth_wrapper(*args, **kwargs):
         request = args[0]
         group_slug = args[1]
         project_slug = args[2]
 
-        group = get_object_or_404(models.Group, slug=group_slug)
-        project = get_object_or_404(group.projects, slug=project_slug)
+        project = get_project_or_404(group_slug, project_slug)
+        request.project = project
 
         token = request.META.get('HTTP_AUTH_TOKEN', None)
         user = request.user
@@ -20,7 +39,7 @@ def auth(func):
         if not (project.is_public or user.is_authenticated or token):
             return HttpResponse('Authentication needed', status=401)
 
-        if project.is_public or project.tokens.filter(key=token).exists() or project.accessible_to(user):
+        if project.is_public or models.token_acl.permits(token, project, global_tokens=False) or project.accessible_to(user):
             # authentication OK, call the original view
             return func(*args, **kwargs)
         else:
@@ -32,8 +51,89 @@ def auth(func):
     return auth_wrapper
 
 
+def accepts_encoding(request, encoding):
+    """
+    Returns whether the client accepts responses with the given
+    Content-Encoding, according to the Accept-Encoding request header.
+    """
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = [p.strip() for p in item.split(';')]
+        if params[0].lower() not in (encoding, '*'):
+            continue
+        for p in params[1:]:
+            name, _, value = p.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def etag_matches(request, etag):
+    """
+    Returns whether the If-None-Match request header matches `etag` (a
+    quoted ETag), i.e. whether the client already has the current version
+    of the resource.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            # If-None-Match uses the weak comparison
+            tag = tag[2:]
+        if tag in ('*', etag):
+            return True
+    return False
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(request, size, etag=None):
+    """
+    Returns the byte range requested in the Range request header, as a
+    (start, end) tuple, where `end` is inclusive, for a resource with `size`
+    bytes and the given ETag (to check against If-Range).
+
+    Returns None if the whole resource must be sent instead; that is the case
+    when there is no Range header, the If-Range condition does not match, or
+    multiple ranges were requested (which are not supported). Raises
+    RangeNotSatisfiable if the requested range is not inside the resource.
+    """
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        return None
+
+    match = BYTE_RANGE.match(header.replace(' ', ''))
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # suffix range, i.e. the last N bytes
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        start = int(first)
+        if last != '' and int(last) < start:
+            return None
+        if start >= size:
+            raise RangeNotSatisfiable()
+        end = min(int(last), size - 1) if last != '' else size - 1
+    return start, end
+
+
 def read_file_upload(stream):
-    data = bytes()
-    for chunk in stream.chunks():
-        data = data + chunk
-    return data
+    return b''.join(stream.chunks())
@@ -123,6 +123,34 @@ if database_config:
     db_from_env = dict(x.split('=') for x in database_config.split(':'))
     DATABASES['default'].update(db_from_env)
 
+# Cache shared by all SQUAD processes (web workers, background workers,
+# etc). Besides caching expensive results, it is how each process learns
+# that the builds, environments, suites and tokens it keeps cached (see
+# squad.core.cache) have changed in another process. The default
+# local-memory cache is not shared, so with it those changes only become
+# visible to other processes after their cached copies expire.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('SQUAD_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('SQUAD_CACHE_LOCATION', ''),
+    }
+}
+
+# Test run data files, logs and attachments are stored outside of the
+# database, in a content-addressed blob store.
+SQUAD_BLOB_STORE = {
+    'BACKEND': 'squad.core.storage.FileSystemBlobStore',
+    'OPTIONS': {
+        'root': os.getenv('SQUAD_BLOB_STORE_ROOT', os.path.join(DATA_DIR, 'blobs')),
+    },
+}
+
+# Compression codec for new blobs: 'gzip', 'zstd' (needs the zstandard
+# package), or 'none'.
+SQUAD_BLOB_COMPRESSION = os.getenv('SQUAD_BLOB_COMPRESSION', 'gzip')
+if SQUAD_BLOB_COMPRESSION == 'none':
+    SQUAD_BLOB_COMPRESSION = None
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -52,10 +52,17 @@ class ApiDataTest(TestCase):
         first = json['bar/baz']['env1'][0]
         second = json['bar/baz']['env1'][1]
         self.assertEqual([1472688000, 2.0], first[0:2])
-        self.assertEqual([1472774400, 3.0], second[0:2])
+        self.assertEqual([1472774400, 3.0, '2016-09-02'], second)
 
         self.assertEqual('application/json; charset=utf-8', resp.http['Content-Type'])
 
+    def test_unknown_metric_and_environment(self):
+        self.receive("2016-09-01", metrics={"foo": 1})
+
+        resp = self.client.get_json('/api/data/mygroup/myproject?metric=foo&metric=bar/baz&environment=env1&environment=env2')
+        self.assertEqual({'env1': [[1472688000, 1.0, '2016-09-01']], 'env2': []}, resp.data['foo'])
+        self.assertEqual({'env1': [], 'env2': []}, resp.data['bar/baz'])
+
     def test_tests(self):
         self.receive("2017-01-01", tests={
             "foo": "pass",
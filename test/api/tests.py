@@ -1,5 +1,9 @@
+import json
 import os
-from io import StringIO
+import tarfile
+import zipfile
+from io import BytesIO, StringIO
+from unittest.mock import patch
 
 
 from django.test import TestCase
@@ -7,6 +11,7 @@ from django.test import Client
 from test.api import APIClient
 
 
+from squad.api.views import read_test_run_archive
 from squad.core import models
 
 
@@ -20,6 +25,28 @@ def invalid_json():
     return StringIO('{')
 
 
+def tar_archive(files):
+    data = BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as archive:
+        for name, contents in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            archive.addfile(info, BytesIO(contents))
+    data.seek(0)
+    data.name = 'archive.tar.gz'
+    return data
+
+
+def zip_archive(files):
+    data = BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        for name, contents in files.items():
+            archive.writestr(name, contents)
+    data.seek(0)
+    data.name = 'archive.zip'
+    return data
+
+
 class ApiTest(TestCase):
 
     def setUp(self):
@@ -194,6 +221,12 @@ class ApiTest(TestCase):
         self.assertEqual(201, response.status_code)
         self.assertEqual(1, models.TestRun.objects.count())
 
+    def test_global_token_does_not_allow_other_tokens(self):
+        models.Token.objects.create()
+        self.client.token = 'wrongtoken'
+        response = self.client.post('/api/submit/mygroup/myproject/1.0.0/myenvironment')
+        self.assertEqual(403, response.status_code)
+
     def test_404_on_non_existing_group(self):
         response = self.client.post('/api/submit/mygrouppp/myproject/1.0.0/myenv')
         self.assertEqual(404, response.status_code)
@@ -239,11 +272,28 @@ class ApiTest(TestCase):
         self.assertEqual(400, response.status_code)
 
     def test_reject_submission_with_existing_job_id(self):
+        def post(tests):
+            return self.client.post(
+                '/api/submit/mygroup/myproject/1.0.0/myenvironment',
+                {
+                    'metadata': open(metadata_file),
+                    'tests': tests,
+                }
+            )
+
+        first = post('{"test1": "pass"}')
+        second = post('{"test1": "fail"}')
+
+        self.assertEqual(201, first.status_code)
+        self.assertEqual(400, second.status_code)
+
+    def test_duplicate_submission(self):
         def post():
             return self.client.post(
                 '/api/submit/mygroup/myproject/1.0.0/myenvironment',
                 {
                     'metadata': open(metadata_file),
+                    'tests': open(tests_file),
                 }
             )
 
@@ -251,7 +301,203 @@ class ApiTest(TestCase):
         second = post()
 
         self.assertEqual(201, first.status_code)
-        self.assertEqual(400, second.status_code)
+        self.assertEqual(200, second.status_code)
+        testrun = models.TestRun.objects.get()
+        data = json.loads(second.content.decode('utf-8'))
+        self.assertEqual({'id': testrun.id, 'job_id': testrun.job_id, 'duplicate': True}, data)
+
+    def test_duplicate_async_submission(self):
+        def post():
+            return self.client.post(
+                '/api/submit/mygroup/myproject/1.0.0/myenvironment',
+                {
+                    'tests': open(tests_file),
+                    'async': '1',
+                }
+            )
+
+        first = json.loads(post().content.decode('utf-8'))
+        with patch('squad.api.views.process_test_run.delay') as process:
+            response = post()
+        process.assert_not_called()
+
+        self.assertEqual(202, response.status_code)
+        second = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(first['receipt'], second['receipt'])
+        self.assertEqual(1, models.TestRun.objects.count())
+
+    def test_async_submission(self):
+        response = self.client.post(
+            '/api/submit/mygroup/myproject/1.0.0/myenvironment',
+            {
+                'tests': open(tests_file),
+                'metadata': open(metadata_file),
+                'async': '1',
+            }
+        )
+        self.assertEqual(202, response.status_code)
+        receipt = json.loads(response.content.decode('utf-8'))['receipt']
+        self.assertTrue(response['Location'].endswith('/api/receipt/' + receipt))
+
+        status = self.client.get_json('/api/receipt/' + receipt)
+        self.assertEqual('processed', status.data['status'])
+        testrun = models.TestRun.objects.get(pk=status.data['test_run']['id'])
+        self.assertTrue(testrun.data_processed)
+        self.assertTrue(testrun.status_recorded)
+        self.assertNotEqual(0, testrun.tests.count())
+
+    def test_async_submission_with_invalid_tests(self):
+        response = self.client.post(
+            '/api/submit/mygroup/myproject/1.0.0/myenvironment',
+            {
+                'tests': invalid_json(),
+                'async': '1',
+            }
+        )
+        self.assertEqual(202, response.status_code)
+        receipt = json.loads(response.content.decode('utf-8'))['receipt']
+
+        status = self.client.get_json('/api/receipt/' + receipt)
+        self.assertEqual('failed', status.data['status'])
+        self.assertIsNotNone(status.data['error'])
+        self.assertIsNone(status.data['test_run'])
+        self.assertEqual(0, models.TestRun.objects.count())
+
+    def test_async_submission_with_invalid_metadata(self):
+        response = self.client.post(
+            '/api/submit/mygroup/myproject/1.0.0/myenvironment',
+            {
+                'metadata': invalid_json(),
+                'async': '1',
+            }
+        )
+        self.assertEqual(400, response.status_code)
+
+    def test_receipt_not_found(self):
+        response = self.client.get('/api/receipt/doesnotexist')
+        self.assertEqual(404, response.status_code)
+
+    def test_batch_submission(self):
+        archive = tar_archive({
+            'env1/run1/tests.json': b'{"test1": "pass"}',
+            'env1/run1/metadata.json': b'{"job_id": "1"}',
+            'env1/run1/screenshot.png': b'PNG',
+            'env2/run1/tests.json': b'{"test1": "fail", "test2": "pass"}',
+            'env2/run1/metrics.json': b'{"m1": 1}',
+            'env2/run1/log': b'log text',
+        })
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(201, response.status_code)
+
+        test_runs = json.loads(response.content.decode('utf-8'))['test_runs']
+        self.assertEqual(['env1/run1', 'env2/run1'], [t['name'] for t in test_runs])
+        self.assertEqual(['created', 'created'], [t['status'] for t in test_runs])
+        self.assertEqual('1', test_runs[0]['job_id'])
+
+        build = self.project.builds.get(version='1.0.0')
+        env1 = build.test_runs.get(environment__slug='env1')
+        env2 = build.test_runs.get(environment__slug='env2')
+        self.assertEqual(1, env1.tests.count())
+        self.assertEqual(b'PNG', bytes(env1.attachments.get(filename='screenshot.png').data))
+        self.assertEqual(2, env2.tests.count())
+        self.assertEqual(1, env2.metrics.count())
+        self.assertEqual('log text', env2.log_file)
+
+    def test_batch_submission_reads_tar_archive_in_order(self):
+        archive = tar_archive({
+            'env2/run1/tests.json': b'{"test1": "fail"}',
+            'env1/run1/tests.json': b'{"test1": "pass"}',
+            'env1/run1/log': b'log line\n' * 10000,
+            'env1/run1/metadata.json': b'{"job_id": "1"}',
+        })
+        seeks = []
+        seek = archive.seek
+
+        def logged_seek(pos, whence=0):
+            seeks.append((pos, whence))
+            return seek(pos, whence)
+        archive.seek = logged_seek
+
+        test_runs = read_test_run_archive(archive)
+        self.assertEqual(['env1/run1', 'env2/run1'], [name for name, _ in test_runs])
+        read = len(seeks)
+        # the test runs are sorted, but reading them does not rewind the
+        # archive to decompress it again
+        self.assertEqual(b'{"job_id": "1"}', test_runs[0][1]['metadata_file'].read())
+        self.assertEqual(b'{"test1": "pass"}', test_runs[0][1]['tests_file'].read())
+        self.assertEqual(b'{"test1": "fail"}', test_runs[1][1]['tests_file'].read())
+        self.assertEqual(read, len(seeks))
+
+    def test_batch_submission_with_zip_archive(self):
+        archive = zip_archive({
+            'env1/run1/tests.json': '{"test1": "pass"}',
+            'env1/run2/tests.json': '{"test1": "fail"}',
+        })
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(2, models.TestRun.objects.filter(environment__slug='env1').count())
+
+    def test_batch_submission_partial_failure(self):
+        archive = tar_archive({
+            'env1/run1/tests.json': b'{"test1": "pass"}',
+            'env2/run1/tests.json': b'{',
+        })
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(400, response.status_code)
+
+        test_runs = json.loads(response.content.decode('utf-8'))['test_runs']
+        self.assertEqual(['created', 'failed'], [t['status'] for t in test_runs])
+        self.assertIn('error', test_runs[1])
+        self.assertEqual(1, models.TestRun.objects.count())
+
+    def test_batch_submission_atomic(self):
+        archive = tar_archive({
+            'env1/run1/tests.json': b'{"test1": "pass"}',
+            'env2/run1/tests.json': b'{',
+        })
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive, 'atomic': '1'})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, models.TestRun.objects.count())
+        self.assertEqual(0, models.Build.objects.count())
+
+    def test_batch_submission_duplicated_job_id(self):
+        archive = tar_archive({
+            'env1/run1/metadata.json': b'{"job_id": "1"}',
+            'env1/run2/metadata.json': b'{"job_id": "1"}',
+            'env1/run2/tests.json': b'{"test1": "pass"}',
+        })
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(400, response.status_code)
+        test_runs = json.loads(response.content.decode('utf-8'))['test_runs']
+        self.assertEqual(['created', 'failed'], [t['status'] for t in test_runs])
+
+    def test_batch_submission_duplicated_test_run(self):
+        archive = tar_archive({
+            'env1/run1/metadata.json': b'{"job_id": "1"}',
+            'env1/run2/metadata.json': b'{"job_id": "1"}',
+        })
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(201, response.status_code)
+        test_runs = json.loads(response.content.decode('utf-8'))['test_runs']
+        self.assertEqual(['created', 'duplicate'], [t['status'] for t in test_runs])
+        self.assertEqual(test_runs[0]['id'], test_runs[1]['id'])
+
+    def test_batch_submission_invalid_layout(self):
+        archive = tar_archive({'tests.json': b'{}'})
+        response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(400, response.status_code)
+
+    def test_batch_submission_invalid_environment(self):
+        for environment in ('..', 'my env', '-env', 'e' * 101):
+            archive = tar_archive({environment + '/run1/tests.json': b'{}'})
+            response = self.client.post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+            self.assertEqual(400, response.status_code)
+        self.assertEqual(0, models.Environment.objects.count())
+
+    def test_batch_submission_needs_authentication(self):
+        archive = tar_archive({'env1/run1/tests.json': b'{}'})
+        response = Client().post('/api/submitbatch/mygroup/myproject/1.0.0', {'archive': archive})
+        self.assertEqual(401, response.status_code)
 
 
 class TestApiUpperCaseSlug(TestCase):
@@ -140,7 +140,7 @@ class BackendFetchTest(BackendTestBase):
             1,
             core_models.Test.objects.filter(
                 test_run=test_run,
-                name="foo",
+                known_test__name="foo",
                 result=True,
             ).count()
         )
@@ -4,6 +4,7 @@ from django.utils import timezone
 
 
 from squad.core.models import Group, Build
+from squad.core.tasks import RecordTestRunStatus
 
 
 class BuildTest(TestCase):
@@ -34,10 +35,10 @@ class BuildTest(TestCase):
         env = self.project.environments.create(slug='env')
         suite = self.project.suites.create(slug='tests')
         test_run = build.test_runs.create(environment=env)
-        test_run.tests.create(name='foo', suite=suite, result=True)
-        test_run.tests.create(name='bar', suite=suite, result=False)
-        test_run.tests.create(name='baz', suite=suite, result=None)
-        test_run.tests.create(name='qux', suite=suite, result=False)
+        for name, result in (('foo', True), ('bar', False), ('baz', None), ('qux', False)):
+            known_test = self.project.known_tests.create(suite=suite, name=name)
+            test_run.tests.create(known_test=known_test, result=result)
+        RecordTestRunStatus()(test_run)
 
         summary = build.test_summary
         self.assertEqual(4, summary['total'])
@@ -0,0 +1,86 @@
+from django.test import TestCase
+
+
+from squad.core.models import Group, BuildSummary, Status
+from squad.core.statistics import geomean
+from squad.core.tasks import ReceiveTestRun, RecomputeTestRunStatus
+
+
+class BuildSummaryTest(TestCase):
+
+    def setUp(self):
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        self.receive = ReceiveTestRun(self.project)
+        self.receive('1', 'env1', tests_file='{"a/t1": "pass", "a/t2": "fail", "a/t3": "skip"}', metrics_file='{"m1": 4}')
+        self.receive('1', 'env2', tests_file='{"a/t1": "pass", "a/t2": "pass"}', metrics_file='{"m1": 1}')
+        self.receive('1', 'env1', tests_file='{"b/t1": "fail"}')
+        self.build = self.project.builds.get(version='1')
+
+    def summaries(self):
+        env = lambda s: s.environment and s.environment.slug  # noqa
+        return {
+            env(s): (s.test_runs_total, s.tests_total, s.tests_pass, s.tests_fail, s.tests_missing, s.metrics_count, round(s.metrics_summary, 6))
+            for s in BuildSummary.objects.filter(build=self.build)
+        }
+
+    def test_updated_incrementally(self):
+        self.assertEqual(
+            {
+                None: (3, 6, 3, 2, 1, 2, round(geomean([4, 1]), 6)),
+                'env1': (2, 4, 1, 2, 1, 1, 4.0),
+                'env2': (1, 2, 2, 0, 0, 1, 1.0),
+            },
+            self.summaries(),
+        )
+
+    def test_same_as_recompute(self):
+        expected = self.summaries()
+        BuildSummary.recompute(self.build)
+        self.assertEqual(expected, self.summaries())
+
+    def test_duplicate_submission_is_not_counted(self):
+        expected = self.summaries()
+        self.receive('1', 'env2', tests_file='{"a/t1": "pass", "a/t2": "pass"}', metrics_file='{"m1": 1}')
+        self.assertEqual(expected, self.summaries())
+
+    def test_computed_on_first_access(self):
+        expected = self.summaries()
+        BuildSummary.objects.all().delete()
+        build = self.project.builds.get(version='1')
+        self.assertEqual(6, build.summary.tests_total)
+        self.assertEqual(expected, self.summaries())
+
+    def test_computed_on_first_test_run_after_existing_ones(self):
+        BuildSummary.objects.all().delete()
+        self.receive('1', 'env2', tests_file='{"c/t1": "pass"}')
+        self.assertEqual((4, 7, 4, 2, 1, 2), self.summaries()[None][:-1])
+        self.assertEqual((2, 3, 3, 0, 0, 1), self.summaries()['env2'][:-1])
+
+    def test_recompute_test_run_status(self):
+        expected = self.summaries()
+        BuildSummary.objects.update(tests_total=0)
+        Status.objects.all().delete()
+        RecomputeTestRunStatus()(list(self.build.test_runs.all()))
+        self.assertEqual(expected, self.summaries())
+
+    def test_test_summary(self):
+        build = self.project.builds.get(version='1')
+        build.summary
+        # failing tests, their test runs and environments
+        with self.assertNumQueries(3):
+            summary = build.test_summary
+        self.assertEqual(6, summary['total'])
+        self.assertEqual(3, summary['pass'])
+        self.assertEqual(2, summary['fail'])
+        self.assertEqual(1, summary['missing'])
+        self.assertEqual(['env1'], list(summary['failures'].keys()))
+        self.assertEqual(['a/t2', 'b/t1'], [t.full_name for t in summary['failures']['env1']])
+
+    def test_computed_on_first_access_only_once(self):
+        BuildSummary.objects.all().delete()
+        build = self.project.builds.get(version='1')
+        build.summary
+        build = self.project.builds.get(version='1')
+        with self.assertNumQueries(1):
+            self.assertEqual(6, build.summary.tests_total)
+        self.assertEqual(3, BuildSummary.objects.filter(build=build).count())
@@ -0,0 +1,255 @@
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from unittest.mock import patch
+import time
+
+
+from squad.core.cache import LRUCache, ResultCache, ALL_PROJECTS
+from squad.core.models import Group, Build, Token, build_ids, environment_ids, suite_ids, token_acl
+from squad.core.tasks import ReceiveTestRun
+
+
+class LRUCacheTest(TestCase):
+
+    def test_get_set(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(0, lru.get('b', 0))
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(2, len(lru))
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+
+    def test_evicts_by_size(self):
+        lru = LRUCache(10, maxbytes=10)
+        lru.set('a', b'1234')
+        lru.set('b', b'1234')
+        lru.set('a', b'12345')
+        self.assertEqual(9, lru.size)
+        lru.set('c', b'1234')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(b'12345', lru.get('a'))
+        self.assertEqual(9, lru.size)
+
+    def test_does_not_store_values_larger_than_maxbytes(self):
+        lru = LRUCache(10, maxbytes=10)
+        lru.set('a', b'1234')
+        lru.set('b', b'12345678901')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(b'1234', lru.get('a'))
+
+
+class ResultCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_set(self):
+        results = ResultCache('test.')
+        self.assertIsNone(results.get('x'))
+        results.set('x', {'a': [1, 2, 3]})
+        self.assertEqual({'a': [1, 2, 3]}, results.get('x'))
+
+    def test_shared(self):
+        ResultCache('test.').set('x', [1, 2])
+        self.assertEqual([1, 2], ResultCache('test.').get('x'))
+
+    def test_compressed(self):
+        results = ResultCache('test.')
+        results.set('x', 'a' * 100000)
+        self.assertLess(results.entries.size, 1000)
+
+    def test_large_values_are_not_cached(self):
+        results = ResultCache('test.', max_entry_size=100)
+        results.set('x', bytes(range(256)))
+        self.assertIsNone(results.get('x'))
+
+
+class IDCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        for ids in (build_ids, environment_ids, suite_ids):
+            ids.clear()
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+
+    def test_get_or_create(self):
+        build = build_ids.get_or_create(self.project, '1.0')
+        self.assertEqual(build, self.project.builds.get(version='1.0'))
+        with self.assertNumQueries(0):
+            cached = build_ids.get_or_create(self.project, '1.0')
+        self.assertEqual(build, cached)
+        self.assertEqual('1.0', cached.version)
+        self.assertEqual(self.project, cached.project)
+
+    def test_rc_build(self):
+        build = build_ids.get_or_create(self.project, '1.0-rc1')
+        self.assertEqual('1.0~rc1', self.project.builds.get(id=build.id).version)
+        with self.assertNumQueries(0):
+            cached = build_ids.get_or_create(self.project, '1.0-rc1')
+        self.assertEqual(build, cached)
+        self.assertEqual(1, self.project.builds.count())
+
+    def test_existing_build_with_another_name(self):
+        build = self.project.builds.create(name='1.0~rc1')
+        self.assertEqual(build, build_ids.get_or_create(self.project, '1.0-rc1'))
+        self.assertEqual(build, build_ids.get(self.project, '1.0-rc1'))
+
+    def test_expires(self):
+        env = environment_ids.get_or_create(self.project, 'myenv')
+        self.assertEqual(env, environment_ids.get(self.project, 'myenv'))
+        with patch('squad.core.cache.time.monotonic', return_value=time.monotonic() + environment_ids.ttl + 1):
+            self.assertIsNone(environment_ids.get(self.project, 'myenv'))
+
+    def test_rechecks_expired_entries(self):
+        env = environment_ids.get_or_create(self.project, 'myenv')
+        # renamed without this process noticing
+        self.project.environments.filter(id=env.id).update(slug='otherenv')
+        self.assertEqual(env, environment_ids.get_or_create(self.project, 'myenv'))
+        with patch('squad.core.cache.time.monotonic', return_value=time.monotonic() + environment_ids.ttl + 1):
+            new = environment_ids.get_or_create(self.project, 'myenv')
+        self.assertNotEqual(env, new)
+        self.assertEqual('myenv', self.project.environments.get(id=new.id).slug)
+
+    def test_loads_other_fields_on_demand(self):
+        build = build_ids.get_or_create(self.project, '1.0')
+        cached = build_ids.get(self.project, '1.0')
+        with self.assertNumQueries(1):
+            self.assertEqual(build.datetime, cached.datetime)
+
+    def test_per_project(self):
+        other = self.project.group.projects.create(slug='other')
+        env = environment_ids.get_or_create(self.project, 'myenv')
+        self.assertIsNone(environment_ids.get(other, 'myenv'))
+        self.assertNotEqual(env, environment_ids.get_or_create(other, 'myenv'))
+
+    def test_not_cached_until_commit(self):
+        with transaction.atomic():
+            environment_ids.get_or_create(self.project, 'myenv')
+            self.assertIsNone(environment_ids.get(self.project, 'myenv'))
+        self.assertIsNotNone(environment_ids.get(self.project, 'myenv'))
+
+    def test_not_cached_on_rollback(self):
+        try:
+            with transaction.atomic():
+                environment_ids.get_or_create(self.project, 'myenv')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertIsNone(environment_ids.get(self.project, 'myenv'))
+        self.assertEqual(0, self.project.environments.count())
+
+    def test_get_many(self):
+        suite = self.project.suites.create(slug='foo')
+        suite_ids.add(suite)
+        self.assertEqual({'foo': suite}, suite_ids.get_many(self.project, ['foo', 'bar']))
+
+    def test_invalidated_on_rename(self):
+        env = environment_ids.get_or_create(self.project, 'myenv')
+        env.slug = 'otherenv'
+        env.save()
+        self.assertIsNone(environment_ids.get(self.project, 'myenv'))
+
+    def test_invalidated_on_delete(self):
+        env = environment_ids.get_or_create(self.project, 'myenv')
+        env.delete()
+        self.assertIsNone(environment_ids.get(self.project, 'myenv'))
+
+    def test_invalidated_by_other_processes(self):
+        environment_ids.get_or_create(self.project, 'myenv')
+        environment_ids.get(self.project, 'myenv')
+        # what another process does when renaming or deleting
+        cache.set(environment_ids.key, 10)
+        self.assertIsNone(environment_ids.get(self.project, 'myenv'))
+
+    def test_receive_test_run_with_warm_cache(self):
+        receive = ReceiveTestRun(self.project)
+        receive('1.0', 'myenv', tests_file='{"foo/test1": "pass", "bar/test2": "fail"}')
+        with CaptureQueriesContext(connection) as queries:
+            receive('1.0', 'myenv', tests_file='{"foo/test1": "pass", "bar/test2": "pass"}')
+        tables = ['core_build', 'core_environment', 'core_suite']
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and any('FROM "%s"' % t in q['sql'] for t in tables)]
+        # The build row itself is read by ID once, to check its datetime; it
+        # is locked with an UPDATE, not read, while the build summaries are
+        # updated.
+        by_id = [sql for sql in selects if sql.endswith('WHERE "core_build"."id" = %d' % Build.objects.get().id)]
+        self.assertEqual(1, len(by_id))
+        # After the commit, the build is checked for having been moved back
+        # while the test run was parsed (see UpdateBuildDatetime).
+        moved = [sql for sql in selects if sql.startswith('SELECT (1) AS "a" FROM "core_build"')]
+        self.assertEqual(1, len(moved))
+        # The environment row is read by ID too, to lock it while test
+        # transitions are recorded.
+        environment_id = self.project.environments.get().id
+        locks = [sql for sql in selects if sql.endswith('WHERE "core_environment"."id" IN (%d) ORDER BY "core_environment"."id" ASC' % environment_id)]
+        self.assertEqual(1, len(locks))
+        # The only other lookups are those of the previous and next builds,
+        # to record test transitions; no build, environment or suite is
+        # looked up by version or slug.
+        lookups = [sql for sql in selects if sql not in by_id + moved + locks]
+        self.assertEqual(2, len(lookups))
+        self.assertIn('"core_build"."datetime" <', lookups[0])
+        self.assertIn('"core_build"."datetime" >', lookups[1])
+        self.assertEqual(1, Build.objects.count())
+        self.assertEqual(2, self.project.suites.count())
+
+
+class TokenCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        token_acl.clear()
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+
+    def test_project_token(self):
+        token = self.project.tokens.create()
+        self.assertEqual(frozenset([self.project.id]), token_acl.projects(token.key))
+        self.assertTrue(token_acl.permits(token.key, self.project))
+
+    def test_global_token(self):
+        token = Token.objects.create()
+        self.assertEqual(ALL_PROJECTS, token_acl.projects(token.key))
+        self.assertTrue(token_acl.permits(token.key, self.project))
+        self.assertFalse(token_acl.permits(token.key, self.project, global_tokens=False))
+
+    def test_unknown_token(self):
+        Token.objects.create()
+        self.assertEqual(frozenset(), token_acl.projects('unknown'))
+        self.assertFalse(token_acl.permits('unknown', self.project))
+        self.assertFalse(token_acl.permits(None, self.project))
+
+    def test_cached(self):
+        token = self.project.tokens.create()
+        token_acl.projects(token.key)
+        with self.assertNumQueries(0):
+            self.assertTrue(token_acl.permits(token.key, self.project))
+
+    def test_expires(self):
+        token = self.project.tokens.create()
+        with patch('squad.core.cache.time.monotonic', return_value=0):
+            token_acl.projects(token.key)
+        with patch('squad.core.cache.time.monotonic', return_value=token_acl.ttl + 1):
+            with self.assertNumQueries(1):
+                token_acl.projects(token.key)
+
+    def test_invalidated_on_save(self):
+        self.assertFalse(token_acl.permits('thekey', self.project))
+        self.project.tokens.create(key='thekey')
+        self.assertTrue(token_acl.permits('thekey', self.project))
+
+    def test_invalidated_on_delete(self):
+        token = self.project.tokens.create()
+        self.assertTrue(token_acl.permits(token.key, self.project))
+        token.delete()
+        self.assertFalse(token_acl.permits(token.key, self.project))
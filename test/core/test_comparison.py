@@ -1,11 +1,13 @@
 import json
 
 
+from django.core.cache import cache
 from django.test import TestCase
+from unittest.mock import patch
 
 
 from squad.core import models
-from squad.core.comparison import TestComparison
+from squad.core.comparison import TestComparison, ResultMatrix, comparison_cache
 from squad.core.tasks import ReceiveTestRun
 
 
@@ -77,7 +79,7 @@ class TestComparisonTest(TestCase):
 
     def test_tests_are_sorted(self):
         comp = compare(self.build1, self.build2)
-        self.assertEqual(['a', 'b', 'c', 'd/e', 'z'], list(comp.results.keys()))
+        self.assertEqual(['a', 'b', 'c', 'd/e'], list(comp.results.keys()))
 
     def test_test_results(self):
         comp = compare(self.build1, self.build2)
@@ -130,3 +132,176 @@ class TestComparisonTest(TestCase):
         # same build! so no regressions, by definition
         comparison = TestComparison.compare_builds(self.build1, self.build1)
         self.assertEqual({}, comparison.regressions)
+
+    def test_only_tests_from_compared_builds(self):
+        comparison = compare(self.build1, self.build2)
+        self.assertNotIn('z', comparison.results)
+        self.assertNotIn('z', comparison.diff)
+
+    def test_diff_does_not_load_all_results(self):
+        comparison = compare(self.build1, self.build2)
+        self.assertEqual(['a', 'c'], list(comparison.diff.keys()))
+        self.assertEqual(['a'], comparison.regressions['myenv'])
+        self.assertIsNone(comparison.__matrix__)
+
+    def test_diff_with_results_loaded(self):
+        comparison = compare(self.build1, self.build2)
+        comparison.results
+        self.assertEqual(['a', 'c'], list(comparison.diff.keys()))
+        self.assertEqual(['a'], comparison.regressions['myenv'])
+
+    def test_diff_full_rows(self):
+        comparison = compare(self.build1, self.build2)
+        self.assertEqual(comparison.results['a'], comparison.diff['a'])
+
+    def test_diff_uses_latest_result(self):
+        build3 = self.project1.builds.create(version='3')
+        self.receive_test_run(self.project1, '3', 'myenv', {'a': 'fail', 'b': 'pass'})
+        self.receive_test_run(self.project1, '3', 'myenv', {'a': 'pass'})
+        self.receive_test_run(self.project1, '3', 'otherenv', {'a': 'pass', 'b': 'pass'})
+        comparison = compare(self.build1, build3)
+        self.assertEqual(['c', 'd/e'], list(comparison.diff.keys()))
+        self.assertEqual({}, comparison.regressions)
+
+    def test_diff_test_missing_in_one_build(self):
+        build3 = self.project1.builds.create(version='3')
+        self.receive_test_run(self.project1, '3', 'myenv', {'a': 'pass', 'b': 'pass', 'c': 'fail', 'd/e': 'pass'})
+        self.receive_test_run(self.project1, '3', 'otherenv', {'a': 'pass', 'c': 'fail', 'd/e': 'pass'})
+        comparison = compare(self.build1, build3)
+        self.assertEqual(['b'], list(comparison.diff.keys()))
+
+
+class ResultMatrixTest(TestCase):
+
+    def setUp(self):
+        self.matrix = ResultMatrix(['a', 'b', 'c'], [('b1', 'e1'), ('b1', 'e2'), ('b2', 'e1')])
+        self.matrix.set('a', ('b1', 'e1'), True)
+        self.matrix.set('a', ('b2', 'e1'), False)
+        self.matrix.set('b', ('b1', 'e1'), True)
+        self.matrix.set('b', ('b1', 'e2'), None)
+        self.matrix.set('b', ('b2', 'e1'), True)
+        self.matrix.set('c', ('b2', 'e1'), True)
+
+    def test_views(self):
+        results = self.matrix.view()
+        self.assertEqual(['a', 'b', 'c'], list(results))
+        self.assertEqual({('b1', 'e1'): 'pass', ('b1', 'e2'): 'skip/unknown', ('b2', 'e1'): 'pass'}, dict(results['b']))
+        self.assertIsNone(results['c'].get(('b1', 'e1')))
+        self.assertIsNone(results['c'].get(('b3', 'e1')))
+        self.assertNotIn('d', results)
+
+    def test_subset_view(self):
+        results = self.matrix.view([0, 2])
+        self.assertEqual(['a', 'c'], list(results))
+        self.assertNotIn('b', results)
+        self.assertEqual(2, len(results))
+
+    def test_differing_rows(self):
+        pairs = [(('b1', 'e1'), ('b2', 'e1')), (('b1', 'e2'), ('b2', 'e2'))]
+        self.assertEqual([0, 1, 2], self.matrix.differing_rows(pairs))
+        self.assertEqual([0, 2], self.matrix.differing_rows(pairs[:1]))
+
+    def test_regressed_rows(self):
+        self.assertEqual([0], self.matrix.regressed_rows(('b1', 'e1'), ('b2', 'e1')))
+        self.assertEqual([], self.matrix.regressed_rows(('b1', 'e2'), ('b2', 'e2')))
+
+    def test_without_numpy(self):
+        with patch('squad.core.comparison.numpy', None):
+            self.test_differing_rows()
+            self.test_regressed_rows()
+
+    def test_empty(self):
+        matrix = ResultMatrix([], [('b1', 'e1')])
+        self.assertEqual([], matrix.differing_rows([(('b1', 'e1'), ('b2', 'e1'))]))
+        self.assertEqual([], matrix.regressed_rows(('b1', 'e1'), ('b2', 'e1')))
+        self.assertFalse(matrix.view())
+
+
+class ComparisonCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        comparison_cache.clear()
+        self.project = models.Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        self.receive = ReceiveTestRun(self.project)
+        self.receive('1', 'myenv', tests_file='{"a": "pass", "b": "pass", "c": "pass"}')
+        self.receive('2', 'myenv', tests_file='{"a": "fail", "b": "pass", "c": "pass"}')
+        self.build1, self.build2 = self.project.builds.all()
+
+    def test_cached(self):
+        first = compare(self.build1, self.build2)
+        self.assertEqual(['a'], list(first.diff.keys()))
+        self.assertEqual({'myenv': ['a']}, first.regressions)
+        self.assertEqual(['a', 'b', 'c'], list(first.results.keys()))
+
+        comparison = compare(self.build1, self.build2)
+        with self.assertNumQueries(0):
+            self.assertEqual(['a'], list(comparison.diff.keys()))
+            self.assertEqual({'myenv': ['a']}, comparison.regressions)
+            self.assertEqual(['a', 'b', 'c'], list(comparison.results.keys()))
+            self.assertEqual('fail', comparison.diff['a'][(self.build2, 'myenv')])
+        self.assertIs(self.build2, list(comparison.diff['a'].keys())[1][0])
+
+    def test_cached_in_other_processes(self):
+        compare(self.build1, self.build2).diff
+        comparison_cache.clear()
+        comparison = compare(self.build1, self.build2)
+        with self.assertNumQueries(0):
+            self.assertEqual(['a'], list(comparison.diff.keys()))
+
+    def test_builds_order_matters(self):
+        compare(self.build1, self.build2).regressions
+        self.assertEqual({}, compare(self.build2, self.build1).regressions)
+
+    def test_new_test_run_invalidates(self):
+        compare(self.build1, self.build2).diff
+        self.receive('2', 'myenv', tests_file='{"b": "fail"}')
+        build1, build2 = self.project.builds.all()
+        self.assertEqual(['a', 'b'], list(compare(build1, build2).diff.keys()))
+
+    def test_not_cached_while_test_runs_are_not_processed(self):
+        self.receive('2', 'otherenv', tests_file='{"a": "pass"}', process=False)
+        comparison = compare(self.build1, self.build2)
+        self.assertIsNone(comparison.cache_key)
+        comparison.diff
+        with self.assertNumQueries(2):
+            compare(self.build1, self.build2).diff
+
+
+class StreamingComparisonTest(TestCase):
+
+    receive_test_run = TestComparisonTest.receive_test_run
+    setUp = TestComparisonTest.setUp
+
+    def test_iter_results(self):
+        comparison = compare(self.build1, self.build2)
+        results = list(comparison.iter_results())
+        self.assertEqual(['a', 'b', 'c', 'd/e'], [test for test, _ in results])
+        for test, row in results:
+            self.assertEqual(dict(comparison.results[test]), dict(row))
+
+    def test_iter_diff(self):
+        comparison = compare(self.build1, self.build2)
+        self.assertEqual(['a', 'c'], [test for test, _ in comparison.iter_diff()])
+        self.assertEqual('fail', dict(comparison.iter_diff())['a'][(self.build2, 'myenv')])
+
+    def test_iter_diff_same_build(self):
+        comparison = compare(self.build1, self.build1)
+        self.assertEqual([], list(comparison.iter_diff()))
+
+    def test_iter_regressions(self):
+        comparison = compare(self.build1, self.build2)
+        self.assertEqual([('myenv', 'a'), ('otherenv', 'a')], list(comparison.iter_regressions()))
+        self.assertEqual([], list(TestComparison(self.build1).iter_regressions()))
+
+    def test_iter_uses_latest_result(self):
+        self.receive_test_run(self.project1, '3', 'myenv', {'a': 'fail', 'b': 'pass'})
+        self.receive_test_run(self.project1, '3', 'myenv', {'a': 'pass'})
+        build3 = self.project1.builds.get(version='3')
+        comparison = TestComparison(build3)
+        self.assertEqual({(build3, 'myenv'): 'pass'}, dict(dict(comparison.iter_results())['a']))
+
+    def test_sorted_by_code_point(self):
+        self.receive_test_run(self.project1, '3', 'myenv', {'s/B': 'pass', 's/a': 'pass', 's/_c': 'pass', 's/é': 'pass'})
+        build3 = self.project1.builds.get(version='3')
+        self.assertEqual(['s/B', 's/_c', 's/a', 's/é'], [test for test, _ in TestComparison(build3).iter_results()])
@@ -0,0 +1,38 @@
+from django.core.management import call_command
+from django.test import TestCase
+
+
+from squad.core.models import Group, Test, Metric
+from squad.core.tasks import ReceiveTestRun
+
+
+class FillDenormalizedFieldsTest(TestCase):
+
+    def setUp(self):
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        receive = ReceiveTestRun(self.project)
+        for i in range(3):
+            receive(
+                str(i), 'myenv',
+                tests_file='{"foo/test1": "pass", "foo/test2": "fail"}',
+                metrics_file='{"foo/m1": %d}' % (i + 1),
+            )
+        # as if received before the fields existed
+        for model in (Test, Metric):
+            model.objects.update(project=None, environment=None, build=None, build_datetime=None)
+
+    def test_fills_fields(self):
+        call_command('fill_denormalized_fields', '--silent', '--batch-size=2')
+        self.assertEqual(0, Test.objects.filter(build=None).count() + Metric.objects.filter(build=None).count())
+        for model in (Test, Metric):
+            for obj in model.objects.select_related('test_run__build'):
+                test_run = obj.test_run
+                self.assertEqual(self.project.id, obj.project_id)
+                self.assertEqual(test_run.environment_id, obj.environment_id)
+                self.assertEqual(test_run.build_id, obj.build_id)
+                self.assertEqual(test_run.build.datetime, obj.build_datetime)
+
+    def test_history_after_filling(self):
+        call_command('fill_denormalized_fields', '--silent')
+        test = Test.objects.filter(known_test__name='test1').order_by('-build_datetime').first()
+        self.assertEqual(2, test.history.count)
@@ -0,0 +1,74 @@
+from datetime import timedelta
+import os
+
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+
+from squad.core.models import Group, Blob
+from squad.core.storage import get_blob_store
+
+
+class GcBlobsTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        project = group.projects.create(slug='myproject')
+        build = project.builds.create(version='1')
+        env = project.environments.create(slug='myenv')
+        self.kept = build.test_runs.create(environment=env, tests_file='{"a": "pass"}', log_file='the log')
+        self.deleted = build.test_runs.create(environment=env, tests_file='{"b": "pass"}', log_file='the log')
+        self.kept.attachments.create(filename='foo.txt', data=b'foo', length=3)
+        self.store = get_blob_store()
+
+    def age_blobs(self):
+        Blob.objects.update(touched_at=timezone.now() - timedelta(days=2))
+
+    def test_deletes_blobs_of_deleted_test_runs(self):
+        blob = self.deleted.tests_file_blob
+        self.deleted.delete()
+        self.age_blobs()
+        call_command('gc_blobs', '--silent')
+
+        self.assertFalse(Blob.objects.filter(key=blob.key).exists())
+        self.assertFalse(self.store.exists(blob.storage_key))
+        # shared with the remaining test run
+        self.assertTrue(Blob.objects.filter(key=self.deleted.log_file_blob_id).exists())
+        self.assertEqual(3, Blob.objects.count())
+        for blob in Blob.objects.all():
+            self.assertTrue(self.store.exists(blob.storage_key))
+
+    def test_deletes_old_files_without_blobs(self):
+        key = self.store.key(b'rolled back')
+        self.store.put(key, b'rolled back')
+        os.utime(self.store.path(key), (0, 0))
+        call_command('gc_blobs', '--silent')
+        self.assertFalse(self.store.exists(key))
+        self.assertEqual(4, Blob.objects.count())
+        for blob in Blob.objects.all():
+            self.assertTrue(self.store.exists(blob.storage_key))
+
+    def test_keeps_recent_files_without_blobs(self):
+        key = self.store.key(b'being written')
+        self.store.put(key, b'being written')
+        call_command('gc_blobs', '--silent')
+        self.assertTrue(self.store.exists(key))
+
+    def test_keeps_recently_stored_blobs(self):
+        blob = self.deleted.tests_file_blob
+        self.deleted.delete()
+        call_command('gc_blobs', '--silent')
+        self.assertTrue(Blob.objects.filter(key=blob.key).exists())
+        self.assertTrue(self.store.exists(blob.storage_key))
+
+    def test_storing_again_keeps_blob(self):
+        blob = self.deleted.tests_file_blob
+        self.deleted.delete()
+        self.age_blobs()
+        # e.g. by a submission with the same tests that is being received
+        self.assertEqual(blob.key, Blob.objects.store('{"b": "pass"}').key)
+        call_command('gc_blobs', '--silent')
+        self.assertTrue(Blob.objects.filter(key=blob.key).exists())
+        self.assertTrue(self.store.exists(blob.storage_key))
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 
 
 from django.core.management import call_command
@@ -52,3 +54,51 @@ class TestDryRun(TestCase):
         self.assertEqual(0, Project.objects.count())
         self.assertEqual(0, Build.objects.count())
         self.assertEqual(0, TestRun.objects.count())
+
+
+class TestResumableImport(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.input = os.path.join(self.tmp, 'input')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'test_import_data_input'), self.input)
+        self.checkpoint = os.path.join(self.tmp, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def import_data(self, *args):
+        call_command('import_data', '--silent', '--checkpoint', self.checkpoint, *(args + ('foo/bar', self.input)))
+
+    def test_records_imported_test_runs(self):
+        self.import_data()
+        self.assertEqual(['1/default/1', '2/default/2'], sorted(open(self.checkpoint).read().split()))
+
+    def test_skips_imported_test_runs(self):
+        with open(self.checkpoint, 'w') as f:
+            f.write('1/default/1\n')
+        self.import_data()
+        self.assertEqual(['2'], [b.version for b in Build.objects.all()])
+        self.assertEqual(1, TestRun.objects.count())
+
+    def test_resume_after_failure(self):
+        broken = os.path.join(self.input, '2', 'default', '2', 'tests.json')
+        original = open(broken).read()
+        with open(broken, 'w') as f:
+            f.write('{')
+
+        with self.assertRaises(Exception):
+            self.import_data('--batch-size=1')
+        self.assertEqual(['1/default/1'], open(self.checkpoint).read().split())
+        self.assertEqual(1, TestRun.objects.count())
+
+        with open(broken, 'w') as f:
+            f.write(original)
+        self.import_data('--batch-size=1')
+        self.assertEqual(2, TestRun.objects.count())
+        self.assertEqual(1, Test.objects.count())
+
+    def test_parallel_import(self):
+        # SQLite falls back to importing serially
+        self.import_data('--jobs=2')
+        self.assertEqual(2, TestRun.objects.count())
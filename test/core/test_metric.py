@@ -1,8 +1,12 @@
+from array import array
+from django.core import serializers
+from django.db import connection
 from django.test import TestCase
 from unittest.mock import patch
 
 
-from squad.core.models import Metric, Suite
+from squad.core.fields import float_array, pack_floats
+from squad.core.models import Group, Metric, Suite
 
 
 class MetricTest(TestCase):
@@ -24,3 +28,56 @@ class MetricTest(TestCase):
         s = Suite()
         m = Metric(suite=s)
         self.assertEqual('woooops', m.full_name)
+
+
+class MetricMeasurementsTest(TestCase):
+
+    def setUp(self):
+        project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        build = project.builds.create(version='1')
+        env = project.environments.create(slug='myenv')
+        self.test_run = build.test_runs.create(environment=env)
+        self.suite = project.suites.create(slug='mysuite')
+
+    def create(self, measurements):
+        return Metric.objects.create(test_run=self.test_run, suite=self.suite, name='foo', result=1, measurements=measurements)
+
+    def test_stored_packed(self):
+        metric = self.create([1, 2.5, 3])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT measurements FROM core_metric WHERE id = %s', [metric.id])
+            stored = bytes(cursor.fetchone()[0])
+        self.assertEqual(24, len(stored))
+        self.assertEqual(pack_floats([1, 2.5, 3]), stored)
+
+    def test_read_as_array(self):
+        self.create([1, 2.5, 3])
+        metric = Metric.objects.get()
+        self.assertEqual(array('d', [1, 2.5, 3]), metric.measurements)
+        self.assertEqual([1, 2.5, 3], metric.measurement_list)
+
+    def test_values_list(self):
+        self.create([1, 2.5])
+        self.assertEqual([array('d', [1, 2.5])], list(Metric.objects.values_list('measurements', flat=True)))
+
+    def test_empty(self):
+        self.create([])
+        self.assertEqual([], Metric.objects.get().measurement_list)
+
+    def test_serialization(self):
+        self.create([1, 2.5])
+        data = serializers.serialize('json', Metric.objects.all())
+        obj = list(serializers.deserialize('json', data))[0].object
+        self.assertEqual([1, 2.5], obj.measurement_list)
+
+
+class FloatArrayTest(TestCase):
+
+    def test_float_array(self):
+        expected = array('d', [1, 2.5])
+        self.assertEqual(expected, float_array([1, 2.5]))
+        self.assertEqual(expected, float_array('1,2.5'))
+        self.assertEqual(expected, float_array(pack_floats([1, 2.5])))
+        self.assertEqual(expected, float_array(memoryview(pack_floats([1, 2.5]))))
+        self.assertEqual(array('d'), float_array(None))
+        self.assertEqual(array('d'), float_array(''))
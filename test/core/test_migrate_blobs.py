@@ -0,0 +1,40 @@
+from django.core.management import call_command
+from django.test import TestCase
+
+
+from squad.core.models import Group, TestRun, Attachment, Blob
+
+
+class MigrateBlobsTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        project = group.projects.create(slug='myproject')
+        build = project.builds.create(version='1')
+        env = project.environments.create(slug='myenv')
+        for i in range(3):
+            test_run = build.test_runs.create(environment=env)
+            TestRun.objects.filter(id=test_run.id).update(
+                tests_file_inline='{"test%d": "pass"}' % i,
+                log_file_inline='the log',
+            )
+            attachment = test_run.attachments.create(filename='foo.txt', length=3)
+            Attachment.objects.filter(id=attachment.id).update(data_inline=b'foo')
+
+    def test_moves_data_to_blob_store(self):
+        call_command('migrate_blobs', '--silent', '--batch-size=2')
+
+        self.assertFalse(TestRun.objects.filter(tests_file_inline__isnull=False).exists())
+        self.assertFalse(TestRun.objects.filter(log_file_inline__isnull=False).exists())
+        self.assertFalse(Attachment.objects.filter(data_inline__isnull=False).exists())
+
+        test_runs = TestRun.objects.order_by('id')
+        self.assertEqual('{"test0": "pass"}', test_runs[0].tests_file)
+        self.assertEqual('the log', test_runs[2].log_file)
+        self.assertIsNone(test_runs[0].metrics_file)
+        self.assertEqual(b'foo', Attachment.objects.first().data)
+
+    def test_deduplicates_contents(self):
+        call_command('migrate_blobs', '--silent')
+        # 3 distinct tests files, 1 log, 1 attachment
+        self.assertEqual(5, Blob.objects.count())
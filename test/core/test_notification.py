@@ -1,3 +1,6 @@
+from collections import OrderedDict
+
+
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core import mail
@@ -8,23 +11,44 @@ from unittest.mock import patch, MagicMock, PropertyMock
 
 from squad.core.models import Group, Project, Build, ProjectStatus
 from squad.core.notification import Notification, send_notification
+from squad.core.tasks import ReceiveTestRun
 
 
 class NotificationTest(TestCase):
 
-    @patch("squad.core.comparison.TestComparison.diff", new_callable=PropertyMock)
-    def test_delegates_diff_to_test_comparison_object(self, diff):
-        the_diff = {}
-        diff.return_value = the_diff
-
+    def setUp(self):
         group = Group.objects.create(slug='mygroup')
         project = group.projects.create(slug='myproject')
-        build1 = project.builds.create(version='1')
-        build2 = project.builds.create(version='2')
-
-        notification = Notification(build2, build1)
+        self.build1 = project.builds.create(version='1')
+        self.build2 = project.builds.create(version='2')
+        self.env = project.environments.create(slug='myenv')
 
-        self.assertIs(the_diff, notification.diff)
+    @patch("squad.core.comparison.TestComparison.diff", new_callable=PropertyMock)
+    def test_delegates_diff_to_test_comparison_object(self, diff):
+        the_diff = fake_diff()
+        diff.return_value = OrderedDict(the_diff)
+        notification = Notification(self.build2, self.build1)
+        self.assertEqual(the_diff, notification.diff)
+        self.assertTrue(notification.has_changes)
+
+    @patch("squad.core.comparison.TestComparison.iter_diff")
+    def test_streams_diff_when_not_cacheable(self, iter_diff):
+        # tests not stored yet
+        self.build2.test_runs.create(environment=self.env)
+        the_diff = fake_diff()
+        iter_diff.return_value = iter(the_diff)
+        notification = Notification(self.build2, self.build1)
+        self.assertIsNone(notification.comparison.cache_key)
+        self.assertTrue(notification.has_changes)
+        self.assertEqual(the_diff, notification.diff)
+        self.assertEqual(the_diff, notification.diff)
+        iter_diff.assert_called_once_with()
+
+    @patch("squad.core.comparison.TestComparison.iter_diff")
+    def test_no_changes(self, iter_diff):
+        self.build2.test_runs.create(environment=self.env)
+        iter_diff.return_value = iter([])
+        self.assertFalse(Notification(self.build2, self.build1).has_changes)
 
 
 def fake_diff():
@@ -32,10 +56,10 @@ def fake_diff():
     build2 = MagicMock()
     env1 = MagicMock()
     env2 = MagicMock()
-    return {
-        'test1': {build1: {env1: True, env2: True}, build2: {env1: True, env2: False}},
-        'test2': {build1: {env1: True, env2: True}, build2: {env1: True, env2: False}},
-    }
+    return [
+        ('test1', {build1: {env1: True, env2: True}, build2: {env1: True, env2: False}}),
+        ('test2', {build1: {env1: True, env2: True}, build2: {env1: True, env2: False}}),
+    ]
 
 
 class TestSendNotificationFirstTime(TestCase):
@@ -69,14 +93,14 @@ class TestSendNotification(TestCase):
         ProjectStatus.create(self.project)
         self.project.builds.create(version='2', datetime=t)
 
-    @patch("squad.core.comparison.TestComparison.diff", new_callable=PropertyMock)
+    @patch("squad.core.notification.Notification.diff", new_callable=PropertyMock)
     def test_send_notification(self, diff):
         self.project.subscriptions.create(email='foo@example.com')
         diff.return_value = fake_diff()
         send_notification(self.project)
         self.assertEqual(1, len(mail.outbox))
 
-    @patch("squad.core.comparison.TestComparison.diff", new_callable=PropertyMock)
+    @patch("squad.core.notification.Notification.diff", new_callable=PropertyMock)
     def test_send_notification_for_all_builds(self, diff):
         t = timezone.now() - relativedelta(hours=2.5)
         self.project.builds.create(version='3', datetime=t)
@@ -92,7 +116,7 @@ class TestSendNotification(TestCase):
         send_notification(self.project)
         self.assertEqual(0, len(mail.outbox))
 
-    @patch("squad.core.comparison.TestComparison.diff", new_callable=PropertyMock)
+    @patch("squad.core.notification.Notification.diff", new_callable=PropertyMock)
     def test_send_notification_on_change_only(self, diff):
         diff.return_value = fake_diff()
         self.project.notification_strategy = Project.NOTIFY_ON_CHANGE
@@ -101,8 +125,45 @@ class TestSendNotification(TestCase):
         send_notification(self.project)
         self.assertEqual(1, len(mail.outbox))
 
-    @patch("squad.core.comparison.TestComparison.diff", new_callable=PropertyMock)
+    @patch("squad.core.notification.Notification.diff", new_callable=PropertyMock)
     def test_no_recipients_no_email(self, diff):
         diff.return_value = fake_diff()
         send_notification(self.project)
         self.assertEqual(0, len(mail.outbox))
+
+
+class TestSendNotificationWithResults(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        self.project = group.projects.create(slug='myproject', notification_strategy=Project.NOTIFY_ON_CHANGE)
+        self.project.subscriptions.create(email='foo@example.com')
+        self.receive(3, '1', '{"a": "pass", "b": "pass", "c": "fail"}')
+        ProjectStatus.create(self.project)
+
+    def receive(self, hours_ago, version, tests_file):
+        datetime = timezone.now() - relativedelta(hours=hours_ago)
+        metadata = '{"job_id": "%s", "datetime": "%s"}' % (version, datetime.isoformat())
+        ReceiveTestRun(self.project)(version, 'myenv', tests_file=tests_file, metadata_file=metadata)
+
+    def test_changes(self):
+        self.receive(2, '2', '{"a": "pass", "b": "fail", "c": "fail"}')
+        send_notification(self.project)
+        self.assertEqual(1, len(mail.outbox))
+        message = mail.outbox[0]
+        self.assertIn('pass fail b', message.body)
+        self.assertNotIn(' a\n', message.body)
+        self.assertIn('<th>b</th>', message.alternatives[0][0])
+        self.assertNotIn('<th>a</th>', message.alternatives[0][0])
+
+    def test_uses_cached_diff(self):
+        self.receive(2, '2', '{"a": "pass", "b": "fail", "c": "fail"}')
+        with patch('squad.core.comparison.TestComparison.iter_diff') as iter_diff:
+            send_notification(self.project)
+        iter_diff.assert_not_called()
+        self.assertIn('pass fail b', mail.outbox[0].body)
+
+    def test_no_changes(self):
+        self.receive(2, '2', '{"a": "pass", "b": "pass", "c": "fail"}')
+        send_notification(self.project)
+        self.assertEqual(0, len(mail.outbox))
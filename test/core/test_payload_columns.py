@@ -0,0 +1,107 @@
+import re
+
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+
+from squad.core.comparison import TestComparison
+from squad.core.history import TestHistory
+from squad.core.models import Group, TestRun
+from squad.core.notification import Notification, notify_build
+from squad.core.tasks import ReceiveTestRun
+
+
+# payload columns being selected, as opposed to e.g. having their length
+# calculated in the database
+PAYLOAD_COLUMN = re.compile(r'(?<!LENGTH\()(?<!CAST\()"core_testrun"\."(tests|metrics|log|metadata)_file"')
+
+
+class PayloadColumnsTest(TestCase):
+    """
+    The in-database payload columns of TestRun can be huge, and must not be
+    loaded by anything other than the download views.
+    """
+
+    def setUp(self):
+        self.group = Group.objects.create(slug='mygroup')
+        self.project = self.group.projects.create(slug='myproject', is_public=True)
+        receive = ReceiveTestRun(self.project)
+        for version in ('1', '2'):
+            for env in ('env1', 'env2'):
+                receive(
+                    version, env,
+                    metadata_file='{"job_id": "%s-%s"}' % (version, env),
+                    tests_file='{"suite/test1": "pass", "suite/test2": "fail"}',
+                    metrics_file='{"suite/metric1": 1}',
+                )
+        # simulate test runs that were not moved to the blob store
+        TestRun.objects.update(log_file_inline='log', tests_file_inline='{}')
+
+        self.client = Client()
+        self.client.force_login(User.objects.create(username='theuser'))
+
+    def assertNoPayloadColumns(self, queries):
+        for query in queries:
+            sql = query['sql']
+            if sql.startswith('SELECT'):
+                self.assertIsNone(PAYLOAD_COLUMN.search(sql), sql)
+
+    def test_frontend(self):
+        for url in [
+            '/mygroup/myproject/',
+            '/mygroup/myproject/builds/',
+            '/mygroup/myproject/build/2/',
+            '/mygroup/myproject/build/2/testrun/2-env1/',
+            '/mygroup/myproject/tests/',
+            '/mygroup/myproject/tests/suite/test1',
+            '/mygroup/myproject/metrics/',
+            '/_/compare/?project=mygroup/myproject&project=mygroup/myproject',
+        ]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(200, response.status_code, url)
+            self.assertNoPayloadColumns(queries)
+
+    def test_api(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/data/mygroup/myproject?metric=:tests:&environment=env1')
+        self.assertNoPayloadColumns(queries)
+
+    def test_comparison(self):
+        builds = list(self.project.builds.all())
+        with CaptureQueriesContext(connection) as queries:
+            comparison = TestComparison(*builds)
+            comparison.regressions
+        self.assertNoPayloadColumns(queries)
+
+    def test_history(self):
+        with CaptureQueriesContext(connection) as queries:
+            history = TestHistory(self.project, 'suite/test1')
+            [r.test_run.job_id for results in history.results.values() for r in results.values()]
+        self.assertNoPayloadColumns(queries)
+
+    def test_notification(self):
+        previous, build = self.project.builds.all()
+        with CaptureQueriesContext(connection) as queries:
+            list(Notification(build, previous).diff)
+            build.test_summary
+        self.assertNoPayloadColumns(queries)
+
+    def test_notification_payload_sizes(self):
+        self.project.subscriptions.create(email='foo@example.com')
+        build = self.project.builds.last()
+        with CaptureQueriesContext(connection) as queries:
+            notify_build(build)
+        self.assertNoPayloadColumns(queries)
+        # the sizes of all test runs with failures are read at once
+        self.assertEqual(1, len([q for q in queries if 'LENGTH(' in q['sql']]))
+
+    def test_download_loads_payloads(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/mygroup/myproject/build/2/testrun/2-env1/log')
+        self.assertEqual(b'log', b''.join(response.streaming_content))
+        self.assertTrue(any(PAYLOAD_COLUMN.search(q['sql']) for q in queries))
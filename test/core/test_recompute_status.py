@@ -0,0 +1,55 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+
+from squad.core.models import Group, Status
+from squad.core.statistics import geomean
+from squad.core.tasks import ReceiveTestRun
+
+
+class RecomputeStatusTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        self.project = group.projects.create(slug='myproject')
+        self.other = group.projects.create(slug='other')
+        for project in (self.project, self.other):
+            receive = ReceiveTestRun(project)
+            for i in range(3):
+                receive(
+                    str(i), 'myenv',
+                    tests_file='{"foo/test1": "pass", "foo/test2": "fail", "bar/test3": "pass"}',
+                    metrics_file='{"foo/m1": [1, 2, 3], "bar/m2": %d}' % (i + 1),
+                )
+        self.expected = self.statuses(self.project)
+        Status.objects.update(tests_pass=0, tests_fail=0, metrics_summary=0)
+
+    def statuses(self, project):
+        return sorted(
+            Status.objects.filter(test_run__build__project=project).values_list(
+                'test_run_id', 'suite__slug', 'tests_pass', 'tests_fail', 'metrics_summary'
+            ),
+            key=lambda s: (s[0], s[1] or ''),
+        )
+
+    def test_recompute_project(self):
+        call_command('recompute_status', '--silent', '--batch-size=2', 'mygroup/myproject')
+        self.assertEqual(self.expected, self.statuses(self.project))
+        self.assertEqual(0, Status.objects.filter(test_run__build__project=self.other).exclude(tests_pass=0).count())
+
+    def test_recompute_all(self):
+        call_command('recompute_status', '--silent')
+        self.assertEqual(self.expected, self.statuses(self.project))
+        self.assertEqual(9, Status.objects.filter(test_run__build__project=self.other).exclude(tests_pass=0).count())
+
+    def test_metrics_summary(self):
+        call_command('recompute_status', '--silent', 'mygroup/myproject')
+        status = Status.objects.get(test_run__build__project=self.project, test_run__build__version='2', suite__slug='foo')
+        self.assertAlmostEqual(geomean([1, 2, 3]), status.metrics_summary)
+        overall = Status.objects.get(test_run__build__project=self.project, test_run__build__version='2', suite=None)
+        self.assertAlmostEqual(geomean([1, 2, 3, 3]), overall.metrics_summary)
+
+    def test_invalid_project(self):
+        with self.assertRaises(CommandError):
+            call_command('recompute_status', '--silent', 'mygroup/nonexisting')
@@ -1,7 +1,11 @@
+from array import array
+from math import exp, fsum, log
 from unittest import TestCase
+from unittest.mock import patch
 
 
-from squad.core.statistics import geomean
+from squad.core import statistics
+from squad.core.statistics import geomean, geomean_of_logs, logarithms
 
 
 class GeomeanTest(TestCase):
@@ -20,3 +24,37 @@ class GeomeanTest(TestCase):
 
     def test_set_with_only_invalid_values(self):
         self.assertAlmostEqual(0, geomean([0]))
+
+
+class LogarithmsTest(TestCase):
+
+    def test_only_positive_values(self):
+        self.assertEqual([0.0, log(10)], logarithms([1, 10, 0, -1]))
+
+    def test_packed_floats(self):
+        self.assertEqual([0.0, log(10)], logarithms(array('d', [1, 10, 0, -1])))
+
+    def test_empty(self):
+        self.assertEqual([], logarithms(array('d')))
+        self.assertEqual(0, geomean_of_logs([]))
+
+    def test_same_geomean_without_numpy(self):
+        if not statistics.numpy:
+            self.skipTest('NumPy is not available')
+        values = array('d', [1e-100, 1e100] * 1000 + [4] + [1.1 ** i for i in range(-1500, 1500)])
+        with_numpy = geomean_of_logs(logarithms(values))
+        with patch('squad.core.statistics.numpy', None):
+            without_numpy = geomean_of_logs(logarithms(values))
+        self.assertEqual(without_numpy, with_numpy)
+
+
+class StableGeomeanTest(TestCase):
+
+    def test_many_values(self):
+        values = [1e-300, 1e300] * 10000 + [4]
+        self.assertAlmostEqual(exp(log(4) / len(values)), geomean(values))
+
+    def test_independent_of_order(self):
+        values = [1.1 ** i for i in range(-1500, 1500)]
+        self.assertEqual(geomean(values), geomean(list(reversed(values))))
+        self.assertEqual(exp(fsum(log(v) for v in values) / len(values)), geomean(values))
@@ -0,0 +1,105 @@
+import io
+import os
+import tempfile
+import shutil
+import time
+from unittest import skipUnless
+
+
+from django.test import TestCase
+
+
+from squad.core.storage import FileSystemBlobStore, CODECS, get_codec
+
+
+class FileSystemBlobStoreTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = FileSystemBlobStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_and_read(self):
+        key = self.store.key(b'foo')
+        self.store.put(key, b'foo')
+        self.assertTrue(self.store.exists(key))
+        self.assertEqual(b'foo', self.store.read(key))
+
+    def test_key_is_content_hash(self):
+        self.assertEqual(
+            '2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae',
+            self.store.key(b'foo'),
+        )
+
+    def test_fan_out(self):
+        key = self.store.key(b'foo')
+        self.store.put(key, b'foo')
+        self.assertTrue(os.path.exists(os.path.join(self.root, '2c', '26', key)))
+
+    def test_put_existing_blob(self):
+        key = self.store.key(b'foo')
+        self.store.put(key, b'foo')
+        self.store.put(key, b'foo')
+        self.assertEqual(b'foo', self.store.read(key))
+        self.assertEqual([key], os.listdir(os.path.dirname(self.store.path(key))))
+
+    def test_put_file(self):
+        key = self.store.key(b'foo')
+        self.store.put_file(key, io.BytesIO(b'foo'))
+        self.assertEqual(b'foo', self.store.read(key))
+
+    def test_keys(self):
+        foo = self.store.key(b'foo')
+        bar = self.store.key(b'bar')
+        self.store.put(foo, b'foo')
+        self.store.put(bar, b'bar')
+        os.utime(self.store.path(foo), (0, 0))
+        self.assertEqual({foo, bar}, set(self.store.keys()))
+        self.assertEqual([foo], list(self.store.keys(written_before=time.time() - 60)))
+
+    def test_put_existing_blob_marks_it_as_written(self):
+        key = self.store.key(b'foo')
+        self.store.put(key, b'foo')
+        os.utime(self.store.path(key), (0, 0))
+        self.store.put(key, b'foo')
+        self.assertEqual([], list(self.store.keys(written_before=time.time() - 60)))
+
+    def test_delete(self):
+        key = self.store.key(b'foo')
+        self.store.put(key, b'foo')
+        self.store.delete(key)
+        self.assertFalse(self.store.exists(key))
+        self.store.delete(key)  # no error
+
+
+class CodecsTest(TestCase):
+
+    data = b'[    0.000000] Booting Linux on physical CPU 0x0\n' * 1000
+
+    def roundtrip(self, codec):
+        compressed = codec.compress(self.data)
+        self.assertLess(len(compressed), len(self.data) / 10)
+        with codec.decompressing_reader(io.BytesIO(compressed)) as f:
+            self.assertEqual(self.data, f.read())
+
+        compressor = codec.compressor()
+        streamed = b''.join(compressor.compress(self.data[i:i + 1000]) for i in range(0, len(self.data), 1000))
+        streamed += compressor.flush()
+        with codec.decompressing_reader(io.BytesIO(streamed)) as f:
+            self.assertEqual(self.data, f.read())
+
+    def test_gzip(self):
+        self.roundtrip(get_codec('gzip'))
+
+    @skipUnless('zstd' in CODECS, 'zstandard not available')
+    def test_zstd(self):
+        self.roundtrip(get_codec('zstd'))
+
+    def test_no_codec(self):
+        self.assertIsNone(get_codec(None))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            get_codec('foo')
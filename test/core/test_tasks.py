@@ -1,20 +1,32 @@
+import io
 import json
+import re
 
 
 from dateutil.relativedelta import relativedelta
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from unittest.mock import patch
 
 
-from squad.core.models import Group, TestRun, Status, Build
+from squad.core.data import JSONObjectReader
+from squad.core.models import Group, TestRun, Status, Build, Suite, KnownTest, Test, Metric, DuplicateSubmission, Receipt
+from squad.core.models import build_ids, environment_ids, suite_ids
+from squad.core.statistics import logarithms
 from squad.core.tasks import ParseTestRunData
 from squad.core.tasks import RecordTestRunStatus
 from squad.core.tasks import ProcessTestRun
 from squad.core.tasks import ProcessAllTestRuns
 from squad.core.tasks import ReceiveTestRun
+from squad.core.tasks import ReceiveTestRunBatch
+from squad.core.tasks import UpdateBuildDatetime
 from squad.core.tasks import ValidateTestRun
 from squad.core.tasks import exceptions
+from squad.core.tasks import process_test_run
 
 
 class CommonTestCase(TestCase):
@@ -46,6 +58,46 @@ class ParseTestRunDataTest(CommonTestCase):
         self.assertEqual(3, self.testrun.tests.count())
         self.assertEqual(2, self.testrun.metrics.count())
 
+    def test_reuses_existing_suites(self):
+        suite = self.testrun.build.project.suites.create(slug='foobar')
+        ParseTestRunData()(self.testrun)
+
+        self.assertEqual(1, Suite.objects.filter(slug='foobar').count())
+        self.assertEqual(suite, self.testrun.tests.get(known_test__name='test1', known_test__suite__slug='foobar').suite)
+
+    def test_number_of_queries_does_not_depend_on_number_of_tests(self):
+        self.testrun.tests_file = json.dumps({'suite%d/test%d' % (i % 3, i): 'pass' for i in range(100)})
+        self.testrun.metrics_file = json.dumps({'suite%d/metric%d' % (i % 3, i): i + 1 for i in range(100)})
+        self.testrun.save()
+
+        # including one query per model to remove duplicate names
+        with self.assertNumQueries(17):
+            ParseTestRunData()(self.testrun)
+        self.assertEqual(100, self.testrun.tests.count())
+        self.assertEqual(100, self.testrun.metrics.count())
+
+    def test_creates_known_tests(self):
+        ParseTestRunData()(self.testrun)
+        project = self.testrun.build.project
+        self.assertEqual(3, project.known_tests.count())
+        self.assertEqual(
+            sorted(json.loads(self.testrun.tests_file).keys()),
+            sorted(test.full_name for test in self.testrun.tests.all()),
+        )
+
+    def test_reuses_known_tests(self):
+        ParseTestRunData()(self.testrun)
+        other = TestRun.objects.create(
+            build=self.testrun.build.project.builds.create(version='2.0.0'),
+            environment=self.testrun.environment,
+            tests_file='{"foobar/test1": "fail", "foobar/test2": "pass"}',
+        )
+        ParseTestRunData()(other)
+
+        self.assertEqual(4, KnownTest.objects.count())
+        test1 = self.testrun.tests.get(known_test__suite__slug='foobar', known_test__name='test1')
+        self.assertEqual(test1.known_test, other.tests.get(known_test__name='test1').known_test)
+
 
 class ProcessAllTestRunsTest(CommonTestCase):
 
@@ -54,6 +106,44 @@ class ProcessAllTestRunsTest(CommonTestCase):
         self.assertEqual(3, self.testrun.tests.count())
         self.assertEqual(4, self.testrun.status.count())
 
+    def test_skips_queued_test_runs(self):
+        Receipt.objects.create(test_run=self.testrun)
+        ProcessAllTestRuns()()
+        self.assertEqual(0, self.testrun.tests.count())
+
+        Receipt.objects.update(status=Receipt.FAILED)
+        ProcessAllTestRuns()()
+        self.assertEqual(3, self.testrun.tests.count())
+
+    def test_processes_test_runs_queued_for_too_long(self):
+        receipt = Receipt.objects.create(test_run=self.testrun)
+        Receipt.objects.update(created_at=timezone.now() - Receipt.QUEUED_TIMEOUT - relativedelta(minutes=1))
+        ProcessAllTestRuns()()
+        self.assertEqual(3, self.testrun.tests.count())
+        receipt.refresh_from_db()
+        self.assertEqual(Receipt.PROCESSED, receipt.status)
+
+
+class ProcessTestRunTaskTest(CommonTestCase):
+
+    def test_processed(self):
+        receipt = Receipt.objects.create(test_run=self.testrun)
+        process_test_run(receipt.id)
+        receipt.refresh_from_db()
+        self.assertEqual(Receipt.PROCESSED, receipt.status)
+        self.assertEqual(3, self.testrun.tests.count())
+
+    def test_unexpected_error(self):
+        receipt = Receipt.objects.create(test_run=self.testrun)
+        with patch('squad.core.tasks.RecordTestTransitions.__call__', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                process_test_run(receipt.id)
+        receipt.refresh_from_db()
+        self.assertEqual(Receipt.FAILED, receipt.status)
+        self.assertIn('boom', receipt.error)
+        self.assertEqual(self.testrun, receipt.test_run)
+        self.assertEqual(0, self.testrun.tests.count())
+
 
 class RecordTestRunStatusTest(CommonTestCase):
 
@@ -86,6 +176,40 @@ class ProcessTestRunTest(CommonTestCase):
         self.assertEqual(3, self.testrun.tests.count())
         self.assertEqual(4, self.testrun.status.count())
 
+    def test_records_status_while_parsing(self):
+        ProcessTestRun()(self.testrun)
+
+        status = Status.objects.filter(suite=None).last()
+        self.assertEqual(status.tests_pass, 2)
+        self.assertEqual(status.tests_fail, 1)
+        self.assertAlmostEqual(status.metrics_summary, 3.1622, 3)
+
+        foobar = Status.objects.get(suite__slug='foobar')
+        self.assertEqual(foobar.tests_pass, 1)
+        self.assertEqual(foobar.tests_fail, 0)
+        self.assertAlmostEqual(foobar.metrics_summary, 10)
+
+        testrun = TestRun.objects.get(pk=self.testrun.id)
+        self.assertTrue(testrun.data_processed)
+        self.assertTrue(testrun.status_recorded)
+
+    @patch('squad.core.tasks.RecordTestRunStatus.__call__')
+    def test_does_not_read_tests_back(self, record_status):
+        ProcessTestRun()(self.testrun)
+        record_status.assert_not_called()
+        self.assertEqual(4, self.testrun.status.count())
+
+    def test_calculates_geomeans_once_per_suite(self):
+        with patch('squad.core.tasks.logarithms', wraps=logarithms) as calculate:
+            ProcessTestRun()(self.testrun)
+        self.assertEqual(2, calculate.call_count)
+        self.assertAlmostEqual(Status.objects.get(suite=None).metrics_summary, 3.1622, 3)
+
+    def test_records_status_of_already_parsed_test_run(self):
+        ParseTestRunData()(self.testrun)
+        ProcessTestRun()(self.testrun)
+        self.assertEqual(4, self.testrun.status.count())
+
 
 class ReceiveTestRunTest(TestCase):
 
@@ -171,15 +295,219 @@ class ReceiveTestRunTest(TestCase):
 
         receive('199', 'myenv', metadata_file=json.dumps(metadata), tests_file=json.dumps(tests))
         testrun = TestRun.objects.last()
-        values = [t.result for t in testrun.tests.order_by('name')]
+        values = [t.result for t in testrun.tests.order_by('known_test__name')]
         self.assertEqual([True, False, None], values)
 
+    def test_data_files_are_decoded_only_once(self):
+        receive = ReceiveTestRun(self.project)
+        with patch('squad.core.tasks.JSONObjectReader', wraps=JSONObjectReader) as reader:
+            receive('199', 'myenv', tests_file='{"test1": "pass"}', metrics_file='{"metric1": 1}')
+        self.assertEqual(2, reader.call_count)
+        self.assertEqual(1, TestRun.objects.last().tests.count())
+
+    def test_data_files_are_streamed(self):
+        tests = {'test%d' % i: 'pass' for i in range(1000)}
+        receive = ReceiveTestRun(self.project)
+        with patch('squad.core.tasks.JSONObjectReader', wraps=JSONObjectReader) as reader:
+            testrun = receive(
+                '199', 'myenv',
+                tests_file=io.BytesIO(json.dumps(tests).encode()),
+                log_file=io.BytesIO(b'log\n' * 10000),
+                attachments={'foo.txt': io.BytesIO(b'foo')},
+            )
+        # parsed from a file, and not from the whole contents read at once
+        self.assertTrue(hasattr(reader.call_args[0][0], 'read'))
+
+        testrun = TestRun.objects.get(id=testrun.id)
+        self.assertEqual(1000, testrun.tests.count())
+        self.assertEqual(tests, json.loads(testrun.tests_file))
+        self.assertEqual('log\n' * 10000, testrun.log_file)
+        self.assertEqual(b'foo', testrun.attachments.get().data)
+        self.assertEqual(3, testrun.attachments.get().length)
+
+    def test_duplicate_names(self):
+        receive = ReceiveTestRun(self.project)
+        testrun = receive(
+            '199', 'myenv',
+            tests_file='{"a/test1": "pass", "a/test2": "pass", "a/test1": "fail"}',
+            metrics_file='{"a/metric1": 1, "a/metric1": 4}',
+        )
+        self.assertEqual([('test1', False), ('test2', True)], sorted(testrun.tests.values_list('known_test__name', 'result')))
+        self.assertEqual([('metric1', 4)], list(testrun.metrics.values_list('name', 'result')))
+        status = Status.objects.get(test_run=testrun, suite=None)
+        self.assertEqual((1, 1, 4), (status.tests_pass, status.tests_fail, status.metrics_summary))
+
+    def test_invalid_tests_are_not_stored(self):
+        receive = ReceiveTestRun(self.project)
+        with self.assertRaises(exceptions.InvalidMetricsData):
+            receive('199', 'myenv', tests_file='{"test1": "pass"}', metrics_file='{"metric1": 1, "metric2": "foo"}')
+        self.assertEqual(0, TestRun.objects.count())
+        self.assertEqual(0, Test.objects.count())
+
     def test_generate_job_id_when_not_present(self):
         receive = ReceiveTestRun(self.project)
         receive('199', 'myenv')
         testrun = TestRun.objects.last()
         self.assertIsNotNone(testrun.job_id)
 
+    def test_duplicate_submission(self):
+        receive = ReceiveTestRun(self.project)
+        metadata = json.dumps({'job_id': '999'})
+        tests = '{"test1": "pass", "test2": "fail"}'
+        first = receive('199', 'myenv', metadata_file=metadata, tests_file=tests)
+        second = receive('199', 'myenv', metadata_file=metadata, tests_file=tests)
+
+        self.assertFalse(first.duplicate)
+        self.assertTrue(second.duplicate)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(1, TestRun.objects.count())
+        self.assertEqual(2, Test.objects.count())
+
+    def test_duplicate_submission_without_job_id(self):
+        receive = ReceiveTestRun(self.project)
+        first = receive('199', 'myenv', tests_file='{"test1": "pass"}', attachments={'foo.txt': b'foo'})
+        second = receive('199', 'myenv', tests_file='{"test1": "pass"}', attachments={'foo.txt': b'foo'})
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(1, TestRun.objects.count())
+
+    def test_duplicate_submission_is_not_parsed(self):
+        receive = ReceiveTestRun(self.project)
+        receive('199', 'myenv', tests_file='{"test1": "pass"}', metrics_file='{"metric1": 1}')
+        with patch('squad.core.tasks.JSONObjectReader', wraps=JSONObjectReader) as reader:
+            with CaptureQueriesContext(connection) as queries:
+                receive('199', 'myenv', tests_file='{"test1": "pass"}', metrics_file='{"metric1": 1}')
+        reader.assert_not_called()
+        writes = [q['sql'] for q in queries if re.match('(INSERT|UPDATE|DELETE)', q['sql'])]
+        self.assertEqual(1, len(writes))
+        self.assertIn('core_duplicatesubmission', writes[0])
+
+    def test_duplicate_submission_is_not_stored(self):
+        receive = ReceiveTestRun(self.project)
+        receive('199', 'myenv', tests_file='{"test1": "pass"}', log_file=io.BytesIO(b'log'), attachments={'foo.txt': b'foo'})
+        with patch('squad.core.models.BlobManager.store') as store:
+            testrun = receive('199', 'myenv', tests_file='{"test1": "pass"}', log_file=io.BytesIO(b'log'), attachments={'foo.txt': b'foo'})
+        store.assert_not_called()
+        self.assertTrue(testrun.duplicate)
+
+    def test_duplicate_submission_is_recorded(self):
+        receive = ReceiveTestRun(self.project)
+        tests = '{"test1": "pass", "test2": "fail"}'
+        metrics = '{"metric1": 1}'
+        testrun = receive('199', 'myenv', tests_file=tests, metrics_file=metrics, log_file='log')
+        receive('199', 'myenv', tests_file=tests, metrics_file=metrics, log_file='log')
+
+        duplicate = DuplicateSubmission.objects.get()
+        self.assertEqual(testrun, duplicate.test_run)
+        self.assertEqual(len(tests) + len(metrics) + len('log'), duplicate.size)
+        self.assertEqual(3, duplicate.rows)
+
+    def test_different_submissions_are_not_duplicates(self):
+        receive = ReceiveTestRun(self.project)
+        receive('199', 'myenv', tests_file='{"test1": "pass"}')
+        receive('199', 'otherenv', tests_file='{"test1": "pass"}')
+        receive('200', 'myenv', tests_file='{"test1": "pass"}')
+        receive('199', 'myenv', tests_file='{"test1": "pass"}', log_file='')
+        receive('199', 'myenv', tests_file='{"test1": "pass"}', attachments={'foo.txt': b'foo'})
+        receive('199', 'myenv', tests_file='{"test1": "pass"}', attachments={'bar.txt': b'foo'})
+        self.assertEqual(6, TestRun.objects.count())
+        self.assertEqual(0, DuplicateSubmission.objects.count())
+
+    def test_same_job_id_with_different_data(self):
+        receive = ReceiveTestRun(self.project)
+        metadata = json.dumps({'job_id': '999'})
+        receive('199', 'myenv', metadata_file=metadata, tests_file='{"test1": "pass"}')
+        with self.assertRaises(exceptions.InvalidMetadata):
+            receive('199', 'myenv', metadata_file=metadata, tests_file='{"test1": "fail"}')
+
+
+class ReceiveTestRunBuildDatetimeTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        for ids in (build_ids, environment_ids, suite_ids):
+            ids.clear()
+        self.group = Group.objects.create(slug='mygroup')
+        self.project = self.group.projects.create(slug='mygroup')
+
+    def test_build_datetime_is_copied_to_tests_and_metrics(self):
+        receive = ReceiveTestRun(self.project)
+        receive('199', 'myenv', tests_file='{"test1": "pass"}', metrics_file='{"metric1": 1}')
+
+        last_week = timezone.now() - relativedelta(days=7)
+        metadata = {"datetime": last_week.isoformat(), "job_id": '999'}
+        receive('199', 'myenv', metadata_file=json.dumps(metadata), tests_file='{"test1": "fail"}', metrics_file='{"metric1": 2}')
+
+        build = Build.objects.get(version='199')
+        self.assertEqual(last_week, build.datetime)
+        for model in (Test, Metric):
+            self.assertEqual([last_week, last_week], [o.build_datetime for o in model.objects.all()])
+            for obj in model.objects.all():
+                self.assertEqual(self.project.id, obj.project_id)
+                self.assertEqual(build.id, obj.build_id)
+                self.assertEqual(obj.test_run.environment_id, obj.environment_id)
+
+    def test_build_datetime_is_updated_in_batches(self):
+        receive = ReceiveTestRun(self.project)
+        tests = {'test%d' % i: 'pass' for i in range(5)}
+        receive('199', 'myenv', tests_file=json.dumps(tests))
+
+        last_week = timezone.now() - relativedelta(days=7)
+        metadata = {"datetime": last_week.isoformat(), "job_id": '999'}
+        with patch.object(UpdateBuildDatetime, 'BATCH_SIZE', 2):
+            receive('199', 'myenv', metadata_file=json.dumps(metadata), tests_file='{"test1": "fail"}')
+
+        self.assertEqual({last_week}, set(Test.objects.values_list('build_datetime', flat=True)))
+
+    def test_build_datetime_is_only_moved_back(self):
+        receive = ReceiveTestRun(self.project)
+        receive('199', 'myenv', tests_file='{"test1": "pass"}')
+        build = Build.objects.get(version='199')
+        last_week = timezone.now() - relativedelta(days=7)
+        Test.objects.update(build_datetime=last_week)
+
+        UpdateBuildDatetime()(build.id)
+
+        self.assertEqual([last_week], [t.build_datetime for t in Test.objects.all()])
+
+
+class ReceiveTestRunBatchTest(TestCase):
+
+    def setUp(self):
+        self.group = Group.objects.create(slug='mygroup')
+        self.project = self.group.projects.create(slug='mygroup')
+
+    def test_receive_batch(self):
+        receive = ReceiveTestRunBatch(self.project)
+        result = receive('199', [
+            {'environment_slug': 'env1', 'tests_file': '{"test1": "pass"}'},
+            {'environment_slug': 'env2', 'tests_file': '{"test1": "fail"}'},
+            {'environment_slug': 'env1', 'metrics_file': '{"metric1": 1}'},
+        ])
+        self.assertEqual(3, len(result))
+        self.assertEqual(1, Build.objects.count())
+        self.assertEqual(2, self.project.environments.count())
+        self.assertEqual(['env1', 'env2', 'env1'], [t.environment.slug for t in result])
+
+    def test_invalid_test_run_is_skipped(self):
+        receive = ReceiveTestRunBatch(self.project)
+        result = receive('199', [
+            {'environment_slug': 'env1', 'tests_file': '{'},
+            {'environment_slug': 'env1', 'tests_file': '{"test1": "pass"}'},
+        ])
+        self.assertIsInstance(result[0], exceptions.InvalidTestsDataJSON)
+        self.assertIsInstance(result[1], TestRun)
+        self.assertEqual(1, TestRun.objects.count())
+
+    def test_atomic(self):
+        receive = ReceiveTestRunBatch(self.project)
+        with self.assertRaises(exceptions.InvalidTestsDataJSON):
+            receive('199', [
+                {'environment_slug': 'env1', 'tests_file': '{"test1": "pass"}'},
+                {'environment_slug': 'env1', 'tests_file': '{'},
+            ], atomic=True)
+        self.assertEqual(0, TestRun.objects.count())
+        self.assertEqual(0, Build.objects.count())
+
 
 class TestValidateTestRun(TestCase):
 
@@ -192,6 +520,18 @@ class TestValidateTestRun(TestCase):
     def test_invalid_metadata_json(self):
         self.assertInvalidMetadata('{', exceptions.InvalidMetadataJSON)
 
+    def test_returns_decoded_data(self):
+        validate = ValidateTestRun()
+        submission = validate(
+            metadata_file='{"job_id": "1"}',
+            metrics_file='{"foo": 1}',
+            tests_file='{"bar": "pass"}',
+        )
+        self.assertEqual({"job_id": "1"}, submission.metadata)
+        self.assertEqual({"foo": 1}, dict(submission.metrics))
+        self.assertEqual({"bar": "pass"}, dict(submission.tests))
+        self.assertEqual('{"bar": "pass"}', submission.tests_file)
+
     def test_invalid_metadata_type(self):
         self.assertInvalidMetadata('[]')
 
@@ -227,3 +567,12 @@ class TestValidateTestRun(TestCase):
 
     def test_invalid_tests_type(self):
         self.assertInvalidTests('[]')
+
+    def test_invalid_json_message_includes_input(self):
+        validate = ValidateTestRun()
+        with self.assertRaises(exceptions.InvalidTestsDataJSON) as tests:
+            validate(tests_file='{"foo": pass}')
+        self.assertTrue(str(tests.exception).endswith('\n{"foo": pass}'))
+        with self.assertRaises(exceptions.InvalidMetricsDataJSON) as metrics:
+            validate(metrics_file=io.BytesIO(b'{"foo": 1,}'))
+        self.assertTrue(str(metrics.exception).endswith('\n{"foo": 1,}'))
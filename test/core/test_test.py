@@ -3,7 +3,7 @@ from django.test import TestCase
 from django.utils import timezone
 
 from unittest.mock import patch
-from squad.core.models import Group, Test, Suite
+from squad.core.models import Group, Test, Suite, KnownTest
 
 
 class TestTest(TestCase):
@@ -11,7 +11,7 @@ class TestTest(TestCase):
     @patch("squad.core.models.join_name", lambda x, y: 'woooops')
     def test_full_name(self):
         s = Suite()
-        t = Test(suite=s)
+        t = Test(known_test=KnownTest(suite=s))
         self.assertEqual('woooops', t.full_name)
 
     def test_status_na(self):
@@ -27,6 +27,29 @@ class TestTest(TestCase):
         self.assertEqual('fail', t.status)
 
 
+class KnownTestTest(TestCase):
+
+    def setUp(self):
+        self.project = Group.objects.create(slug='group').projects.create(slug='project')
+        self.suite = self.project.suites.create(slug='suite')
+        build = self.project.builds.create(version='1')
+        environment = self.project.environments.create(slug='environment')
+        self.test_run = build.test_runs.create(environment=environment)
+
+    def test_suite_and_name(self):
+        known_test = self.project.known_tests.create(suite=self.suite, name='foo')
+        test = Test.objects.get(id=self.test_run.tests.create(known_test=known_test, result=True).id)
+        self.assertEqual(self.suite, test.suite)
+        self.assertEqual('foo', test.name)
+        self.assertEqual('suite/foo', test.full_name)
+
+    def test_by_full_name(self):
+        known_test = self.project.known_tests.create(suite=self.suite, name='foo')
+        self.assertEqual(known_test, KnownTest.by_full_name(self.project, 'suite/foo'))
+        self.assertEqual('suite/foo', known_test.full_name)
+        self.assertIsNone(KnownTest.by_full_name(self.project, 'suite/bar'))
+
+
 class TestFailureHistoryTest(TestCase):
 
     def setUp(self):
@@ -44,7 +67,8 @@ class TestFailureHistoryTest(TestCase):
             version=self.date.strftime("%Y%m%d"),
         )
         test_run = build.test_runs.create(environment=environment)
-        test = test_run.tests.create(suite=self.suite, name=test, result=result)
+        known_test, _ = self.project.known_tests.get_or_create(suite=self.suite, name=test)
+        test = test_run.tests.create(known_test=known_test, result=result)
 
         self.date = self.date + relativedelta(days=1)
         return test
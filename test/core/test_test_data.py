@@ -1,6 +1,8 @@
+import json
+from io import BytesIO
 from unittest import TestCase
 
-from squad.core.data import JSONTestDataParser
+from squad.core.data import JSONTestDataParser, JSONObjectReader, JSONObjectExpected
 
 
 TEST_DATA = """
@@ -57,3 +59,83 @@ class JSONTestDataParserTest(TestCase):
         test1 = [t for t in data if t['test_name'] == 'mytest1'][0]
         self.assertEqual('/', test1['group_name'])
         self.assertEqual("mytest1", test1['test_name'])
+
+
+class DuplicateKeysTest(TestCase):
+
+    def test_last_value_wins(self):
+        data = json_parser('{"a": "pass", "b": "pass", "a": "fail"}')
+        self.assertEqual([('a', False), ('b', True)], [(t['test_name'], t['pass']) for t in data])
+
+
+class JSONObjectReaderTest(TestCase):
+
+    def read(self, data, chunk_size=None):
+        reader = JSONObjectReader(data)
+        if chunk_size:
+            reader.CHUNK_SIZE = chunk_size
+        return list(reader)
+
+    def test_same_as_json_loads(self):
+        expected = list(json.loads(TEST_DATA).items())
+        self.assertEqual(expected, self.read(TEST_DATA))
+
+    def test_values_split_across_chunks(self):
+        data = json.dumps({'foo%d' % i: [i * 1234567, "bar" * i, None, True] for i in range(50)}, indent=4)
+        expected = list(json.loads(data).items())
+        for chunk_size in (1, 2, 3, 7, 64):
+            self.assertEqual(expected, self.read(BytesIO(data.encode('utf-8')), chunk_size))
+
+    def test_numbers_split_across_chunks(self):
+        numbers = ['123.456', '1e5', '1.5E-3', '-2.5e+30', '0.1', '10', '-7', '[1.5, 2e3]']
+        data = '{%s}' % ','.join('"foo%d":%s' % (i, n) for i, n in enumerate(numbers))
+        expected = list(json.loads(data).items())
+        for chunk_size in (1, 2, 3, 7, 64):
+            for offset in range(chunk_size):
+                # pads the document so that the chunk boundaries fall on
+                # every position of the numbers
+                padded = ' ' * offset + data
+                self.assertEqual(expected, self.read(BytesIO(padded.encode('utf-8')), chunk_size))
+
+    def test_number_split_across_chunks_at_the_top_level(self):
+        with self.assertRaises(JSONObjectExpected) as e:
+            self.read(BytesIO(b'1.5e-3'), 2)
+        self.assertEqual(1.5e-3, e.exception.obj)
+
+    def test_multibyte_characters_split_across_chunks(self):
+        self.assertEqual([('ção', 'pass')], self.read(BytesIO('{"ção": "pass"}'.encode('utf-8')), 1))
+
+    def test_empty_object(self):
+        self.assertEqual([], self.read(' { } '))
+
+    def test_not_an_object(self):
+        with self.assertRaises(JSONObjectExpected):
+            self.read('[1, 2]')
+
+    def test_invalid_json(self):
+        for data in ('', '{', '{"foo"}', '{"foo": }', '{"foo": 1,}', '{"foo": 1 "bar": 2}', '{1: 2}', '{} {}'):
+            with self.assertRaises(json.JSONDecodeError):
+                self.read(data, 2)
+
+    def test_error_position_in_the_whole_document(self):
+        data = '{\n' + ''.join('  "test%d": "pass",\n' % i for i in range(100)) + '  "foo": pass\n}'
+        with self.assertRaises(json.JSONDecodeError) as expected:
+            json.loads(data)
+        for chunk_size in (2, 7, 64):
+            with self.assertRaises(json.JSONDecodeError) as error:
+                self.read(BytesIO(data.encode('utf-8')), chunk_size)
+            self.assertEqual(str(expected.exception), str(error.exception))
+            self.assertEqual(expected.exception.pos, error.exception.pos)
+
+    def test_duplicate_keys(self):
+        self.assertEqual([('a', 1), ('b', 2), ('a', 3)], self.read('{"a": 1, "b": 2, "a": 3}'))
+
+    def test_incremental(self):
+        stream = BytesIO(('{' + ','.join('"test%d": "pass"' % i for i in range(100000)) + '}').encode('utf-8'))
+        reader = iter(JSONObjectReader(stream))
+        self.assertEqual(('test0', 'pass'), next(reader))
+        self.assertLess(stream.tell(), 100000)
+
+    def test_parser_iterate(self):
+        data = json_parser.iterate(BytesIO(TEST_DATA.encode('utf-8')))
+        self.assertEqual('ungrouped_pass', next(data)['test_name'])
@@ -1,5 +1,12 @@
+import gzip
+import hashlib
+import io
+from unittest import skipUnless
+from unittest.mock import patch
 from django.test import TestCase
-from squad.core.models import TestRun
+from django.test import override_settings
+from squad.core.models import Group, TestRun, Blob, open_payload, payload_size
+from squad.core.storage import CODECS, GzipCodec
 
 
 class TestRunTest(TestCase):
@@ -10,3 +17,199 @@ class TestRunTest(TestCase):
 
     def test_no_metadata(self):
         self.assertEqual({}, TestRun().metadata)
+
+    @patch('squad.core.models.json.loads')
+    def test_metadata_is_decoded_only_once(self, loads):
+        loads.return_value = {"1": 2}
+        t = TestRun(metadata_file='{"1": 2}')
+        t.metadata
+        t.metadata
+        self.assertEqual(1, loads.call_count)
+
+
+class TestRunPayloadsTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        project = group.projects.create(slug='myproject')
+        self.build = project.builds.create(version='1')
+        self.env = project.environments.create(slug='myenv')
+
+    def test_payloads_go_to_the_blob_store(self):
+        t = self.build.test_runs.create(environment=self.env, tests_file='{"test1": "pass"}', log_file='log')
+        t = TestRun.objects.get(pk=t.pk)
+        self.assertIsNone(t.tests_file_inline)
+        self.assertEqual('{"test1": "pass"}', t.tests_file)
+        self.assertEqual('log', t.log_file)
+        self.assertIsNone(t.metrics_file)
+        self.assertIsNone(t.metrics_file_blob)
+        self.assertEqual(17, t.tests_file_blob.size)
+
+    def test_same_contents_are_stored_once(self):
+        self.build.test_runs.create(environment=self.env, job_id='1', tests_file='{}', metrics_file='{}')
+        self.build.test_runs.create(environment=self.env, job_id='2', tests_file='{}')
+        self.assertEqual(1, Blob.objects.count())
+
+    def test_legacy_inline_payload(self):
+        t = self.build.test_runs.create(environment=self.env)
+        TestRun.objects.filter(pk=t.pk).update(log_file_inline='old log')
+        t = TestRun.objects.get(pk=t.pk)
+        self.assertEqual('old log', t.log_file)
+        self.assertEqual(b'old log', open_payload(t, 'log_file').read())
+        self.assertEqual(7, payload_size(t, 'log_file'))
+
+    def test_open_payload(self):
+        t = self.build.test_runs.create(environment=self.env, log_file='log')
+        t = TestRun.objects.get(pk=t.pk)
+        with open_payload(t, 'log_file') as f:
+            self.assertEqual(b'log', f.read())
+        self.assertIsNone(open_payload(t, 'tests_file'))
+        self.assertEqual(3, payload_size(t, 'log_file'))
+        self.assertIsNone(payload_size(t, 'tests_file'))
+
+    def test_replace_payload(self):
+        t = self.build.test_runs.create(environment=self.env, log_file='log')
+        t.log_file = None
+        t.save()
+        t = TestRun.objects.get(pk=t.pk)
+        self.assertIsNone(t.log_file_blob)
+        self.assertIsNone(t.log_file)
+
+
+LOG = 'the same log line, over and over again\n' * 1000
+
+
+class BlobCompressionTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        project = group.projects.create(slug='myproject')
+        self.build = project.builds.create(version='1')
+        self.env = project.environments.create(slug='myenv')
+
+    def log_blob(self):
+        t = self.build.test_runs.create(environment=self.env, log_file=LOG)
+        t = TestRun.objects.get(pk=t.pk)
+        self.assertEqual(LOG, t.log_file)
+        with open_payload(t, 'log_file') as f:
+            self.assertEqual(LOG.encode(), f.read())
+        return t.log_file_blob
+
+    def test_compressed_with_gzip_by_default(self):
+        blob = self.log_blob()
+        self.assertEqual('gzip', blob.compression)
+        self.assertEqual(len(LOG), blob.size)
+        self.assertLess(blob.stored_size, blob.size / 10)
+
+    @skipUnless('zstd' in CODECS, 'zstandard not available')
+    @override_settings(SQUAD_BLOB_COMPRESSION='zstd')
+    def test_compressed_with_zstd(self):
+        blob = self.log_blob()
+        self.assertEqual('zstd', blob.compression)
+        self.assertLess(blob.stored_size, blob.size / 10)
+
+    @override_settings(SQUAD_BLOB_COMPRESSION=None)
+    def test_no_compression(self):
+        blob = self.log_blob()
+        self.assertIsNone(blob.compression)
+        self.assertEqual(blob.size, blob.stored_size)
+
+    def test_incompressible_data_is_stored_as_is(self):
+        t = self.build.test_runs.create(environment=self.env, log_file='log')
+        blob = TestRun.objects.get(pk=t.pk).log_file_blob
+        self.assertIsNone(blob.compression)
+        self.assertEqual(3, blob.stored_size)
+
+    def test_stored_contents_are_not_compressed_again(self):
+        self.log_blob()
+        with patch('squad.core.storage.GzipCodec.compressor') as compressor:
+            self.build.test_runs.create(environment=self.env, job_id='2', log_file=LOG)
+        compressor.assert_not_called()
+
+    @patch.object(Blob.objects, 'BLOCK_SIZE', 1000)
+    def test_compressed_in_blocks(self):
+        blob = self.log_blob()
+        self.assertEqual(1000, blob.block_size)
+        # still a valid gzip file, as sent to clients
+        with open_payload(TestRun.objects.get(log_file_blob=blob), 'log_file') as f:
+            self.assertEqual(LOG.encode(), f.read())
+        self.assertEqual(LOG.encode(), gzip.decompress(blob.open_stored().read()))
+
+    @patch.object(Blob.objects, 'BLOCK_SIZE', 1000)
+    def test_seek_only_decompresses_one_block(self):
+        blob = self.log_blob()
+        decompressed = []
+
+        def decompressing_reader(f):
+            reader = gzip.GzipFile(fileobj=f, mode='rb')
+            read = reader.read
+
+            def counting_read(size=-1):
+                data = read(size)
+                decompressed.append(len(data))
+                return data
+            reader.read = counting_read
+            return reader
+
+        with patch.object(GzipCodec, 'decompressing_reader', decompressing_reader):
+            with blob.open() as f:
+                f.seek(len(LOG) - 1500)
+                self.assertEqual(LOG.encode()[-1500:], f.read())
+                f.seek(10)
+                self.assertEqual(LOG.encode()[10:20], f.read(10))
+        self.assertLess(sum(decompressed), 3000)
+
+    def test_blocks_of_different_sizes_are_stored_apart(self):
+        blob = self.log_blob()
+        self.assertEqual(blob.key + '.%d.gz' % Blob.objects.BLOCK_SIZE, blob.storage_key)
+        self.assertEqual(blob.key + '.1000.gz', Blob(key=blob.key, compression='gzip', block_size=1000).storage_key)
+        self.assertEqual(blob.key + '.gz', Blob(key=blob.key, compression='gzip').storage_key)
+
+    @skipUnless('zstd' in CODECS, 'zstandard not available')
+    @override_settings(SQUAD_BLOB_COMPRESSION='zstd')
+    @patch.object(Blob.objects, 'BLOCK_SIZE', 1000)
+    def test_zstd_compressed_in_blocks(self):
+        blob = self.log_blob()
+        with blob.open() as f:
+            f.seek(2500)
+            self.assertEqual(LOG.encode()[2500:], f.read())
+
+    def test_streamed_from_file(self):
+        data = LOG.encode() * 100
+        with patch.object(Blob.objects, 'SPOOL_SIZE', 1024):
+            t = self.build.test_runs.create(environment=self.env, log_file=io.BytesIO(data))
+        blob = TestRun.objects.get(pk=t.pk).log_file_blob
+        self.assertEqual(len(data), blob.size)
+        self.assertEqual('gzip', blob.compression)
+        self.assertEqual(data, blob.read())
+        self.assertEqual(blob.key, hashlib.sha256(data).hexdigest())
+
+
+class TestRunPayloadSizesTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        project = group.projects.create(slug='myproject')
+        self.build = project.builds.create(version='1')
+        self.env = project.environments.create(slug='myenv')
+
+    def test_payload_sizes(self):
+        t = self.build.test_runs.create(environment=self.env, tests_file='{}', log_file='')
+        TestRun.objects.filter(pk=t.pk).update(metadata_file_inline='{"a": "b"}')
+        t = TestRun.objects.get(pk=t.pk)
+        self.assertEqual(
+            {'tests_file': 2, 'metrics_file': None, 'log_file': 0, 'metadata_file': 10},
+            t.payload_sizes,
+        )
+
+    def test_payload_sizes_in_bytes(self):
+        t = self.build.test_runs.create(environment=self.env, log_file='ação ✓')
+        TestRun.objects.filter(pk=t.pk).update(metadata_file_inline='{"a": "ç"}')
+        t = TestRun.objects.get(pk=t.pk)
+        self.assertEqual(len('ação ✓'.encode('utf-8')), t.payload_sizes['log_file'])
+        self.assertEqual(len('{"a": "ç"}'.encode('utf-8')), t.payload_sizes['metadata_file'])
+
+    def test_payload_columns_are_deferred(self):
+        t = self.build.test_runs.create(environment=self.env, tests_file='{}')
+        self.assertEqual(set(TestRun.PAYLOAD_COLUMNS), TestRun.objects.get(pk=t.pk).get_deferred_fields())
+        self.assertEqual(set(), TestRun.objects.with_payloads().get(pk=t.pk).get_deferred_fields())
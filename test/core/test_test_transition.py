@@ -0,0 +1,219 @@
+import threading
+
+
+from dateutil.relativedelta import relativedelta
+from unittest import skipUnless
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+
+from squad.core.models import Group, Project, BuildSummary, TestTransition
+from squad.core.models import build_ids, environment_ids, suite_ids
+from squad.core.notification import Notification
+from squad.core.tasks import ReceiveTestRun, RecomputeTestRunStatus, RecordTestTransitions
+
+
+class TestTransitionTest(TestCase):
+
+    def setUp(self):
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        self.receive = ReceiveTestRun(self.project)
+        self.receive('1', 'myenv', tests_file='{"a": "pass", "b": "fail", "c": "pass", "d": "skip"}')
+        self.receive('1', 'otherenv', tests_file='{"a": "pass"}')
+
+    def transitions(self, version, kind):
+        return TestTransition.by_environment(self.project.builds.get(version=version), kind)
+
+    def test_regressions_and_fixes(self):
+        self.receive('2', 'myenv', tests_file='{"a": "fail", "b": "pass", "c": "pass", "d": "fail"}')
+        self.assertEqual({'myenv': ['a']}, self.transitions('2', TestTransition.REGRESSION))
+        self.assertEqual({'myenv': ['b']}, self.transitions('2', TestTransition.FIX))
+
+    def test_no_previous_build(self):
+        self.assertEqual(0, TestTransition.objects.count())
+
+    def test_relative_to_previous_build_in_the_same_environment(self):
+        self.receive('2', 'myenv', tests_file='{"a": "pass"}')
+        self.receive('3', 'otherenv', tests_file='{"a": "fail"}')
+        transition = TestTransition.objects.get()
+        self.assertEqual('1', transition.previous_build.version)
+        self.assertEqual({'otherenv': ['a']}, self.transitions('3', TestTransition.REGRESSION))
+
+    def test_latest_test_run_replaces_previous_results(self):
+        self.receive('2', 'myenv', tests_file='{"a": "fail", "c": "fail"}')
+        self.receive('2', 'myenv', tests_file='{"a": "pass"}')
+        self.assertEqual({'myenv': ['c']}, self.transitions('2', TestTransition.REGRESSION))
+
+    def test_uses_latest_previous_result(self):
+        self.receive('1', 'myenv', tests_file='{"a": "fail"}')
+        self.receive('2', 'myenv', tests_file='{"a": "pass"}')
+        self.assertEqual({'myenv': ['a']}, self.transitions('2', TestTransition.FIX))
+
+    def test_suites(self):
+        self.receive('1', 'myenv', tests_file='{"foo/a": "pass", "bar/a": "pass"}')
+        self.receive('2', 'myenv', tests_file='{"foo/a": "fail", "bar/a": "pass"}')
+        self.assertEqual({'myenv': ['foo/a']}, self.transitions('2', TestTransition.REGRESSION))
+
+    def test_build_received_out_of_order(self):
+        self.receive_at(2, '3', 'myenv', tests_file='{"a": "fail", "b": "fail"}')
+        self.receive_at(1, '2', 'myenv', tests_file='{"a": "pass", "b": "pass"}')
+        self.assertEqual({'myenv': ['b']}, self.transitions('2', TestTransition.FIX))
+        self.assertEqual({'myenv': ['a', 'b']}, self.transitions('3', TestTransition.REGRESSION))
+        self.assertEqual({'2'}, {t.previous_build.version for t in self.project.builds.get(version='3').transitions.all()})
+
+    @patch.object(RecordTestTransitions, 'BATCH_SIZE', 1)
+    def test_in_batches(self):
+        self.receive('2', 'myenv', tests_file='{"a": "fail", "b": "pass", "c": "pass", "d": "fail"}')
+        self.receive_at(-1, '0', 'myenv', tests_file='{"a": "fail", "b": "fail"}')
+        self.receive('2', 'myenv', tests_file='{"c": "fail"}')
+        self.assertEqual({'myenv': ['a', 'c']}, self.transitions('2', TestTransition.REGRESSION))
+        self.assertEqual({'myenv': ['b']}, self.transitions('2', TestTransition.FIX))
+        self.assertEqual({'myenv': ['a']}, self.transitions('1', TestTransition.FIX))
+        self.assertEqual({}, self.transitions('1', TestTransition.REGRESSION))
+
+    def receive_at(self, hours, version, environment, tests_file):
+        datetime = timezone.now() + relativedelta(minutes=int(60 * hours))
+        self.project.builds.get_or_create(version=version, defaults={'datetime': datetime})
+        metadata = '{"job_id": "%s-%s", "datetime": "%s"}' % (version, environment, datetime.isoformat())
+        self.receive(version, environment, tests_file=tests_file, metadata_file=metadata)
+
+    def test_locks_only_the_environment(self):
+        locked = []
+
+        def lock(environment_ids):
+            locked.append(set(environment_ids))
+
+        with patch.object(RecordTestTransitions, 'lock', lock), patch.object(Project.objects, 'select_for_update') as project_lock:
+            self.receive('2', 'myenv', tests_file='{"a": "fail"}')
+            self.receive('2', 'otherenv', tests_file='{"a": "fail"}')
+        environments = self.project.environments
+        self.assertEqual([{environments.get(slug='myenv').id}, {environments.get(slug='otherenv').id}], locked)
+        project_lock.assert_not_called()
+
+    def test_recompute(self):
+        self.receive('2', 'myenv', tests_file='{"a": "fail", "b": "pass"}')
+        TestTransition.objects.all().delete()
+        build = self.project.builds.get(version='2')
+        RecomputeTestRunStatus()(list(build.test_runs.all()))
+        self.assertEqual({'myenv': ['a']}, self.transitions('2', TestTransition.REGRESSION))
+        self.assertEqual({'myenv': ['b']}, self.transitions('2', TestTransition.FIX))
+
+
+class BuildMovedBackTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        for ids in (build_ids, environment_ids, suite_ids):
+            ids.clear()
+        TestTransitionTest.setUp(self)
+
+    transitions = TestTransitionTest.transitions
+    receive_at = TestTransitionTest.receive_at
+
+    def test_build_moved_back(self):
+        self.receive_at(1, '2', 'myenv', tests_file='{"a": "fail"}')
+        self.receive_at(2, '3', 'myenv', tests_file='{"a": "pass", "b": "pass"}')
+        # build 3 now comes before build 2
+        self.receive_at(0.5, '3', 'otherenv', tests_file='{"a": "pass"}')
+        self.assertEqual({'myenv': ['b']}, self.transitions('3', TestTransition.FIX))
+        self.assertEqual({'myenv': ['a']}, self.transitions('2', TestTransition.REGRESSION))
+        self.assertEqual({}, self.transitions('2', TestTransition.FIX))
+
+    def test_build_moved_back_after_commit(self):
+        self.receive_at(1, '2', 'myenv', tests_file='{"a": "fail"}')
+        self.receive_at(2, '3', 'myenv', tests_file='{"a": "pass"}')
+        moved = RecordTestTransitions.moved
+        in_transaction = []
+
+        def check_moved(build, old_datetime):
+            in_transaction.append(connection.in_atomic_block)
+            moved(build, old_datetime)
+
+        with patch.object(RecordTestTransitions, 'moved', check_moved):
+            self.receive_at(0.5, '3', 'otherenv', tests_file='{"a": "pass"}')
+        self.assertEqual([False], in_transaction)
+        self.assertEqual({'myenv': ['a']}, self.transitions('2', TestTransition.REGRESSION))
+
+
+class NotificationRegressionsTest(TestCase):
+
+    def setUp(self):
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        receive = ReceiveTestRun(self.project)
+        now = timezone.now()
+        for i, tests in enumerate(['{"a": "pass", "b": "pass"}', '{"a": "fail", "b": "pass"}', '{"a": "fail", "b": "fail"}']):
+            self.project.builds.create(version=str(i), datetime=now + relativedelta(hours=i))
+            receive(str(i), 'myenv', tests_file=tests)
+        self.builds = list(self.project.builds.all())
+
+    def test_reads_recorded_regressions(self):
+        notification = Notification(self.builds[1], self.builds[0])
+        with self.assertNumQueries(2):
+            self.assertEqual({'myenv': ['a']}, notification.regressions)
+        self.assertEqual(notification.comparison.regressions, notification.regressions)
+
+    def test_compares_with_older_build(self):
+        notification = Notification(self.builds[2], self.builds[0])
+        self.assertEqual({'myenv': ['a', 'b']}, notification.regressions)
+
+    def test_no_previous_build(self):
+        self.assertEqual({}, Notification(self.builds[0], None).regressions)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs row locks')
+class ConcurrentTestTransitionsTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        for ids in (build_ids, environment_ids, suite_ids):
+            ids.clear()
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject')
+        receive = ReceiveTestRun(self.project)
+        yesterday = timezone.now() - relativedelta(days=1)
+        self.project.builds.create(version='1', datetime=yesterday)
+        self.project.builds.create(version='2', datetime=yesterday + relativedelta(hours=1))
+        # the suite and known tests already exist, so that neither of the
+        # test runs below waits for the other one to create them
+        receive('1', 'myenv', tests_file='{"a": "pass"}')
+        receive('1', 'otherenv', tests_file='{"a": "pass"}')
+
+    def test_environments_of_the_same_build_in_parallel(self):
+        record = RecordTestTransitions.record
+        paused = threading.Event()
+        resume = threading.Event()
+        errors = []
+
+        def record_slowly(testrun):
+            if testrun.environment.slug == 'myenv':
+                paused.set()
+                resume.wait(30)
+            record(testrun)
+
+        def receive(environment, tests_file):
+            try:
+                ReceiveTestRun(self.project)('2', environment, tests_file=tests_file)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        myenv = threading.Thread(target=receive, args=('myenv', '{"a": "fail"}'))
+        otherenv = threading.Thread(target=receive, args=('otherenv', '{"a": "fail", "b": "pass"}'))
+        with patch.object(RecordTestTransitions, 'record', record_slowly):
+            myenv.start()
+            self.assertTrue(paused.wait(30))
+            otherenv.start()
+            otherenv.join(30)
+            finished = not otherenv.is_alive()
+            resume.set()
+            myenv.join(30)
+            otherenv.join(30)
+
+        self.assertEqual([], errors)
+        self.assertTrue(finished)
+        build = self.project.builds.get(version='2')
+        self.assertEqual({'myenv': ['a'], 'otherenv': ['a']}, TestTransition.by_environment(build, TestTransition.REGRESSION))
+        self.assertEqual(2, BuildSummary.overall(build).test_runs_total)
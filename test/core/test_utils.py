@@ -1,5 +1,6 @@
+from io import BytesIO, StringIO
 from django.test import TestCase
-from squad.core.utils import join_name, parse_name
+from squad.core.utils import join_name, parse_name, read_file, read_text
 
 
 class TestParseName(TestCase):
@@ -24,3 +25,26 @@ class TestJoinName(TestCase):
 
     def test_join_group(self):
         self.assertEqual('foo/bar', join_name('foo', 'bar'))
+
+
+class TestReadFile(TestCase):
+
+    def test_none(self):
+        self.assertIsNone(read_file(None))
+        self.assertIsNone(read_text(None))
+
+    def test_bytes_and_strings(self):
+        self.assertEqual(b'foo', read_file(b'foo'))
+        self.assertEqual(b'\xc3\xa9', read_file('\xe9'))
+        self.assertEqual('\xe9', read_text(b'\xc3\xa9'))
+        self.assertEqual('foo', read_text('foo'))
+
+    def test_file_like(self):
+        data = b'x' * 1000000 + b'\xc3\xa9'
+        self.assertEqual(data, read_file(BytesIO(data)))
+        self.assertEqual(data.decode('utf-8'), read_text(BytesIO(data)))
+
+    def test_text_stream(self):
+        data = 'x' * 1000000 + '\xe9'
+        self.assertEqual(data.encode('utf-8'), read_file(StringIO(data)))
+        self.assertEqual(data, read_text(StringIO(data)))
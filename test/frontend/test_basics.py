@@ -1,9 +1,16 @@
+import gzip
+from unittest import skipUnless
+from unittest.mock import patch
+
+
 from django.test import TestCase
 from django.test import Client
+from django.test import override_settings
 from django.contrib.auth.models import User
 
 
 from squad.core import models
+from squad.core.storage import CODECS
 from squad.core.tasks import ReceiveTestRun
 
 
@@ -44,15 +51,166 @@ class FrontendTest(TestCase):
     def test_builds(self):
         self.hit('/mygroup/myproject/builds/')
 
+    def test_builds_with_test_summary(self):
+        receive = ReceiveTestRun(self.project)
+        for version in ('2.0', '3.0'):
+            receive(version, 'myenv', tests_file='{"foo/test1": "pass", "foo/test2": "fail", "foo/test3": "pass"}')
+        response = self.hit('/mygroup/myproject/builds/')
+        self.assertIn('<td>3</td>\n        <td>2</td>\n        <td>1</td>', response.content.decode('utf-8'))
+
+    def test_build_with_regressions_and_fixes(self):
+        receive = ReceiveTestRun(self.project)
+        receive('2.0', 'myenv', tests_file='{"foo/test1": "pass", "foo/test2": "fail"}')
+        receive('3.0', 'myenv', tests_file='{"foo/test1": "fail", "foo/test2": "pass"}')
+        response = self.hit('/mygroup/myproject/build/3.0/')
+        content = response.content.decode('utf-8')
+        self.assertIn('Regressions', content)
+        self.assertIn('<a href="/mygroup/myproject/tests/foo/test1">foo/test1</a>', content)
+        self.assertIn('Fixes', content)
+        self.assertIn('<a href="/mygroup/myproject/tests/foo/test2">foo/test2</a>', content)
+
     def test_attachment(self):
         data = bytes('text file', 'utf-8')
         self.test_run.attachments.create(filename='foo.txt', data=data, length=len(data))
         response = self.hit('/mygroup/myproject/build/1.0/testrun/1/attachments/foo.txt')
         self.assertEqual('text/plain', response['Content-Type'])
+        self.assertEqual(b'text file', b''.join(response.streaming_content))
 
     def test_log(self):
         response = self.hit('/mygroup/myproject/build/1.0/testrun/1/log')
         self.assertEqual('text/plain', response['Content-Type'])
+        self.assertEqual(b'log file contents ...', b''.join(response.streaming_content))
+
+    def test_compressed_log(self):
+        log = 'log line\n' * 1000
+        self.test_run.log_file = log
+        self.test_run.save()
+
+        response = self.hit('/mygroup/myproject/build/1.0/testrun/1/log')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(log.encode(), b''.join(response.streaming_content))
+
+    def test_compressed_log_passthrough(self):
+        log = 'log line\n' * 1000
+        self.test_run.log_file = log
+        self.test_run.save()
+
+        response = self.client.get('/mygroup/myproject/build/1.0/testrun/1/log', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(str(self.test_run.log_file_blob.stored_size), response['Content-Length'])
+        self.assertEqual(log.encode(), gzip.decompress(b''.join(response.streaming_content)))
+
+    def test_log_headers(self):
+        response = self.hit('/mygroup/myproject/build/1.0/testrun/1/log')
+        self.assertEqual('21', response['Content-Length'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertEqual('"%s"' % self.test_run.log_file_blob.key, response['ETag'])
+
+    def test_log_not_modified(self):
+        etag = self.hit('/mygroup/myproject/build/1.0/testrun/1/log')['ETag']
+        response = self.client.get('/mygroup/myproject/build/1.0/testrun/1/log', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+
+    def test_log_modified(self):
+        response = self.client.get('/mygroup/myproject/build/1.0/testrun/1/log', HTTP_IF_NONE_MATCH='"outdated"')
+        self.assertEqual(200, response.status_code)
+
+    def get_range(self, range, **headers):
+        return self.client.get('/mygroup/myproject/build/1.0/testrun/1/log', HTTP_RANGE=range, **headers)
+
+    def test_log_range(self):
+        response = self.get_range('bytes=4-7')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('bytes 4-7/21', response['Content-Range'])
+        self.assertEqual('4', response['Content-Length'])
+        self.assertEqual(b'file', b''.join(response.streaming_content))
+
+    def test_log_open_ended_range(self):
+        response = self.get_range('bytes=18-')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'...', b''.join(response.streaming_content))
+
+    def test_log_suffix_range(self):
+        response = self.get_range('bytes=-3')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('bytes 18-20/21', response['Content-Range'])
+        self.assertEqual(b'...', b''.join(response.streaming_content))
+
+    def test_log_range_not_satisfiable(self):
+        response = self.get_range('bytes=100-')
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */21', response['Content-Range'])
+
+    def test_log_range_with_outdated_if_range(self):
+        response = self.get_range('bytes=4-7', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'log file contents ...', b''.join(response.streaming_content))
+
+    def test_compressed_log_range(self):
+        log = 'log line\n' * 1000
+        self.test_run.log_file = log
+        self.test_run.save()
+        self.assertEqual('gzip', self.test_run.log_file_blob.compression)
+
+        # ranges are taken from the decompressed log, e.g. to resume a
+        # download, or to get its tail
+        for headers in ({}, {'HTTP_ACCEPT_ENCODING': 'gzip'}):
+            response = self.get_range('bytes=8982-', **headers)
+            self.assertEqual(206, response.status_code)
+            self.assertEqual('bytes', response['Accept-Ranges'])
+            self.assertEqual('bytes 8982-8999/9000', response['Content-Range'])
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(b'log line\nlog line\n', b''.join(response.streaming_content))
+
+    def test_compressed_log_range_across_chunks(self):
+        log = ''.join('line %d\n' % i for i in range(100000))
+        self.test_run.log_file = log
+        self.test_run.save()
+
+        response = self.get_range('bytes=500000-500099')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(log.encode()[500000:500100], b''.join(response.streaming_content))
+
+    def test_compressed_log_range_across_blocks(self):
+        log = ''.join('line %d\n' % i for i in range(10000))
+        with patch.object(models.Blob.objects, 'BLOCK_SIZE', 1000):
+            self.test_run.log_file = log
+            self.test_run.save()
+
+        response = self.get_range('bytes=45500-47499')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(log.encode()[45500:47500], b''.join(response.streaming_content))
+
+        # the whole log is still sent compressed as a single gzip stream
+        response = self.client.get('/mygroup/myproject/build/1.0/testrun/1/log', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(log.encode(), gzip.decompress(b''.join(response.streaming_content)))
+
+    @skipUnless('zstd' in CODECS, 'zstandard not available')
+    @override_settings(SQUAD_BLOB_COMPRESSION='zstd')
+    def test_zstd_compressed_log_range(self):
+        log = 'log line\n' * 1000
+        self.test_run.log_file = log
+        self.test_run.save()
+        self.assertEqual('zstd', self.test_run.log_file_blob.compression)
+
+        response = self.get_range('bytes=-9')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'log line\n', b''.join(response.streaming_content))
+
+    def test_legacy_inline_log_range(self):
+        models.TestRun.objects.filter(pk=self.test_run.pk).update(log_file_blob=None, log_file_inline='inline log')
+        response = self.get_range('bytes=0-5')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'inline', b''.join(response.streaming_content))
+
+    def test_attachment_range(self):
+        data = bytes('text file', 'utf-8')
+        self.test_run.attachments.create(filename='foo.txt', data=data, length=len(data))
+        response = self.client.get('/mygroup/myproject/build/1.0/testrun/1/attachments/foo.txt', HTTP_RANGE='bytes=5-')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'file', b''.join(response.streaming_content))
 
     def test_no_log(self):
         self.test_run.log_file = None
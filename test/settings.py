@@ -1,5 +1,8 @@
 from squad.settings import *  # noqa
+import atexit
 import logging
+import shutil
+import tempfile
 
 
 LOGGING['loggers']['django']['level'] = 999  # noqa
@@ -12,3 +15,6 @@ STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 CELERY_ALWAYS_EAGER = True
 CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 BROKER_BACKEND = 'memory'
+
+SQUAD_BLOB_STORE['OPTIONS']['root'] = tempfile.mkdtemp(prefix='squad-test-blobs-')  # noqa
+atexit.register(shutil.rmtree, SQUAD_BLOB_STORE['OPTIONS']['root'], True)  # noqa
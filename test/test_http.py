@@ -0,0 +1,135 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.test import TestCase
+from django.test import RequestFactory
+
+
+from squad.core.models import Group, Token, token_acl
+from squad.http import auth, accepts_encoding, etag_matches, parse_range, RangeNotSatisfiable
+
+
+@auth
+def view(request, group_slug, project_slug):
+    return HttpResponse(request.project.full_name)
+
+
+class AuthTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        token_acl.clear()
+        self.project = Group.objects.create(slug='mygroup').projects.create(slug='myproject', is_public=False)
+        self.token = self.project.tokens.create()
+
+    def get(self, token=None, group='mygroup', project='myproject'):
+        headers = {}
+        if token:
+            headers['HTTP_AUTH_TOKEN'] = token
+        request = RequestFactory().get('/', **headers)
+        request.user = AnonymousUser()
+        return view(request, group, project)
+
+    def test_token(self):
+        response = self.get(self.token.key)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'mygroup/myproject', response.content)
+
+    def test_no_token(self):
+        self.assertEqual(401, self.get().status_code)
+
+    def test_invalid_token(self):
+        self.assertEqual(401, self.get('invalid').status_code)
+
+    def test_token_for_another_project(self):
+        other = self.project.group.projects.create(slug='other')
+        self.assertEqual(401, self.get(other.tokens.create().key).status_code)
+
+    def test_global_token(self):
+        token = Token.objects.create(project=None)
+        self.assertEqual(401, self.get(token.key).status_code)
+
+    def test_project_not_found(self):
+        with self.assertRaises(Http404):
+            self.get(self.token.key, project='nonexisting')
+
+    def test_cached_token(self):
+        self.get(self.token.key)
+        # only the project itself (with its group) is fetched
+        with self.assertNumQueries(1):
+            response = self.get(self.token.key)
+        self.assertEqual(200, response.status_code)
+
+
+class AcceptsEncodingTest(TestCase):
+
+    def accepts(self, header, encoding='gzip'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header)
+        return accepts_encoding(request, encoding)
+
+    def test_accepted(self):
+        self.assertTrue(self.accepts('gzip'))
+        self.assertTrue(self.accepts('deflate, gzip;q=1.0, *;q=0.5'))
+        self.assertTrue(self.accepts('*'))
+
+    def test_not_accepted(self):
+        self.assertFalse(self.accepts(''))
+        self.assertFalse(self.accepts('deflate, br'))
+        self.assertFalse(self.accepts('gzip;q=0'))
+        self.assertFalse(self.accepts('zstd', 'gzip'))
+
+    def test_no_header(self):
+        request = RequestFactory().get('/')
+        self.assertFalse(accepts_encoding(request, 'gzip'))
+
+
+class ETagMatchesTest(TestCase):
+
+    def matches(self, header, etag='"abc"'):
+        return etag_matches(RequestFactory().get('/', HTTP_IF_NONE_MATCH=header), etag)
+
+    def test_matches(self):
+        self.assertTrue(self.matches('"abc"'))
+        self.assertTrue(self.matches('"xyz", "abc"'))
+        self.assertTrue(self.matches('W/"abc"'))
+        self.assertTrue(self.matches('*'))
+
+    def test_does_not_match(self):
+        self.assertFalse(self.matches('"xyz"'))
+        self.assertFalse(self.matches('abc'))
+        self.assertFalse(etag_matches(RequestFactory().get('/'), '"abc"'))
+
+
+class ParseRangeTest(TestCase):
+
+    def parse(self, header, size=100, **headers):
+        request = RequestFactory().get('/', HTTP_RANGE=header, **headers)
+        return parse_range(request, size, '"etag"')
+
+    def test_no_range(self):
+        self.assertIsNone(parse_range(RequestFactory().get('/'), 100))
+
+    def test_range(self):
+        self.assertEqual((0, 9), self.parse('bytes=0-9'))
+        self.assertEqual((90, 99), self.parse('bytes=90-'))
+        self.assertEqual((90, 99), self.parse('bytes=-10'))
+        self.assertEqual((0, 99), self.parse('bytes=-1000'))
+        self.assertEqual((50, 99), self.parse('bytes=50-1000'))
+
+    def test_unsupported_or_invalid_range(self):
+        self.assertIsNone(self.parse('bytes=0-9,20-29'))
+        self.assertIsNone(self.parse('items=0-9'))
+        self.assertIsNone(self.parse('bytes=9-0'))
+        self.assertIsNone(self.parse('bytes=-'))
+
+    def test_not_satisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            self.parse('bytes=100-')
+        with self.assertRaises(RangeNotSatisfiable):
+            self.parse('bytes=-0')
+        with self.assertRaises(RangeNotSatisfiable):
+            self.parse('bytes=-10', size=0)
+
+    def test_if_range(self):
+        self.assertEqual((0, 9), self.parse('bytes=0-9', HTTP_IF_RANGE='"etag"'))
+        self.assertIsNone(self.parse('bytes=0-9', HTTP_IF_RANGE='"other"'))